@@ -1,92 +1,891 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, g, request, jsonify, send_file, stream_with_context
 from flask_cors import CORS
 import pandas as pd
-import io
 import json
-from datetime import datetime
+import os
+import uuid
+from collections import Counter
+
+from column_store import concat_frames
+from compression import enable_compression
+from config import (
+    COMPRESS_MIN_BYTES, DATA_DIR, DATASET_DISK_BUDGET_BYTES, EXCEL_ENGINE, EXCEL_WORKERS, JOB_MAX_PENDING,
+    JOB_WORKERS, MAX_REQUEST_BYTES, OUT_OF_CORE_BUCKET_ROWS, OUT_OF_CORE_MIN_ROWS, OUT_OF_CORE_WORKERS,
+    PROFILE_INTERVAL_MS, PROFILE_SLOW_REQUEST_MS
+)
+from dataset_store import DatasetStore
+from deltas import frame_delta
+from dtypes import conform_frame, memory_report, optimize_frame, to_numeric
+from errors import ApiError
+from export import exporter
+from expressions import parse_expressions
+from financials import (
+    APPEND_OPERATION, PERIOD_RESULT_KEYS, check_columns, period_totals, pl_aggregate, pl_report, refresh_pl_aggregates
+)
+from ingest import CsvIngest
+from jobs import JobManager
+from metrics import PROMETHEUS_MIMETYPE, count_rows, instrument, phase, registry
+from out_of_core import OutOfCoreExecutor, steps_changed_columns
+from persistence import DatasetPersistence, open_persisted_frame
+from pipeline import RecipeStore, Step, execute, parse_steps, plan
+from profiling import SlowRequestProfiler
+from query import FrameIndexes, dataset_indexes, filter_columns, parse_filter, parse_sort_keys, select_rows
+from row_windows import DEFAULT_PAGE_ROWS, MAX_PAGE_ROWS, row_window
+from serialization import (
+    ARROW_PARAMS_KEY, ARROW_RESPONSE_KEY, ARROW_STREAM_MIMETYPE, ORIENTS,
+    arrow_stream_to_frame, frame_to_arrow_stream, serialize_frame
+)
+from sketches import dataset_sketch, seed_sketches, sketch_frame
+from stats import column_stats, compute_column_stats, parse_quantiles
+from time_buckets import date_index, parse_fiscal_year_start, parse_granularities
+import tasks
+import text_cleaning
+from workbooks import EXCEL_EXTENSIONS, WorkbookReader, read_sheet, resolve_engine, schema_report
 
 app = Flask(__name__)
 CORS(app)
 
-# Global variable to store current dataset
-current_dataset = None
+# Server-side datasets, addressed by the dataset_id returned from /upload;
+# every version is also persisted under DATA_DIR/datasets
+store = DatasetStore(persistence=DatasetPersistence(os.path.join(DATA_DIR, 'datasets'), DATASET_DISK_BUDGET_BYTES))
+
+# Saved transformation pipelines
+recipes = RecipeStore(os.path.join(DATA_DIR, 'recipes.json'))
+
+# Background jobs for requests sent with "async": true; their state is shared
+# through DATA_DIR/jobs so any server process can report on them
+jobs = JobManager(JOB_WORKERS, JOB_MAX_PENDING, state_dir=os.path.join(DATA_DIR, 'jobs'))
+
+# Transformations of datasets too big to load run part by part on their files
+out_of_core = OutOfCoreExecutor(OUT_OF_CORE_WORKERS, OUT_OF_CORE_BUCKET_ROWS)
+
+# Batch Excel uploads parse their sheets in parallel
+workbook_reader = WorkbookReader(EXCEL_WORKERS, EXCEL_ENGINE)
+
+# Phase timings in a Server-Timing header and /metrics; optionally, profiles of slow requests
+profiler = (SlowRequestProfiler(os.path.join(DATA_DIR, 'profiles'), PROFILE_SLOW_REQUEST_MS, PROFILE_INTERVAL_MS)
+            if PROFILE_SLOW_REQUEST_MS > 0 else None)
+instrument(app, profiler)
+
+# gzip/zstd response bodies and request bodies; registered after instrument so
+# the compression time is part of the request's timing
+enable_compression(app, COMPRESS_MIN_BYTES, MAX_REQUEST_BYTES)
+registry.gauge('dataset_store_datasets', 'Datasets held in memory.', lambda: store.memory_usage()['datasets'])
+registry.gauge('dataset_store_versions', 'Dataset versions held in memory.', lambda: store.memory_usage()['versions'])
+registry.gauge('dataset_store_memory_bytes', 'Memory retained by the datasets held in memory.',
+               lambda: store.memory_usage()['bytes'])
+registry.gauge('background_jobs', 'Background jobs by status.',
+               lambda: Counter(job['status'] for job in jobs.list()), label='status')
+
+# Number of rows returned as a preview (the first page) with every dataset response
+PREVIEW_ROWS = DEFAULT_PAGE_ROWS
+
+
+def is_arrow_request():
+    return request.mimetype == ARROW_STREAM_MIMETYPE
+
+
+def arrow_body():
+    """``(df, params)`` of an Arrow IPC request body, decoded once per request."""
+    if 'arrow_body' not in g:
+        df, metadata = arrow_stream_to_frame(request.get_data())
+        try:
+            params = json.loads(metadata.get(ARROW_PARAMS_KEY, b'{}'))
+        except ValueError:
+            raise ApiError('Arrow params metadata must be a JSON object')
+        if not isinstance(params, dict):
+            raise ApiError('Arrow params metadata must be a JSON object')
+        g.arrow_body = (df, params)
+    return g.arrow_body
+
+
+def request_payload():
+    with phase('parse'):
+        if is_arrow_request():
+            # The body is the table itself; parameters come from its schema
+            # metadata, or from the query string
+            return {**request.args.to_dict(), **arrow_body()[1]}
+        return request.get_json(silent=True) or {}
+
+
+def wants_arrow():
+    """Whether the client prefers an Arrow IPC stream over JSON (JSON wins ties)."""
+    return request.accept_mimetypes.best_match(['application/json', ARROW_STREAM_MIMETYPE]) == ARROW_STREAM_MIMETYPE
+
+
+def response_orient(payload=None):
+    """Row layout for dataset rows in a response: 'records' (default) or 'columns'."""
+    orient = (payload or {}).get('orient') or request.args.get('orient', 'records')
+    if orient not in ORIENTS:
+        raise ApiError(f"Unsupported orient '{orient}', expected one of {', '.join(ORIENTS)}")
+    return orient
+
+
+def int_arg(name, default, payload=None):
+    value = (payload or {}).get(name, request.args.get(name))
+    if value in (None, ''):
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ApiError(f'{name} must be an integer')
+
+
+def wants_async(payload=None):
+    """Whether a request asked to run as a background job ("async" in the body, form or query)."""
+    value = (payload or {}).get('async')
+    if value is None:
+        value = request.form.get('async') or request.args.get('async')
+    return value in (True, 1, '1', 'true', 'yes')
+
+
+def wants_delta(payload=None):
+    """Whether a transformation should respond with only what changed ("delta" in the body or query)."""
+    value = (payload or {}).get('delta')
+    if value is None:
+        value = request.args.get('delta')
+    return value in (True, 1, '1', 'true', 'yes')
+
+
+def runs_out_of_core(payload, dataset_id):
+    """
+    Whether to transform a stored dataset part by part on disk: when asked
+    ("out_of_core" in the body or query), or when its current version is
+    not in memory and has at least ``OUT_OF_CORE_MIN_ROWS`` rows.
+    """
+    if store.persistence is None:
+        return False
+    node = store.get(dataset_id).node
+    if node.file is None:
+        return False
+    value = payload.get('out_of_core', request.args.get('out_of_core'))
+    if value is not None:
+        return value in (True, 1, '1', 'true', 'yes')
+    return not node.loaded and node.source.rows >= OUT_OF_CORE_MIN_ROWS
+
+
+def job_frame(payload):
+    """
+    A request's frame as a background job argument: the path of a stored
+    dataset's persisted file, so the worker reads it from disk instead of
+    having it pickled across, or the DataFrame itself.
+    """
+    dataset_id = payload.get('dataset_id')
+    if dataset_id and store.persistence is not None:
+        node = store.get(dataset_id).node
+        if node.file is not None:
+            return store.persistence.frame_path(dataset_id, node.file)
+    return load_frame(payload)
+
+
+def job_accepted(job):
+    """202 response pointing at the status endpoint of a submitted job."""
+    return jsonify({
+        'success': True,
+        'job_id': job.job_id,
+        'status': job.status,
+        'status_url': f'/jobs/{job.job_id}'
+    }), 202
+
+
+def load_frame(payload):
+    """
+    Return the DataFrame a request operates on.
+
+    Requests normally reference a stored dataset by ``dataset_id``; posting
+    the rows inline as ``data`` (or as an Arrow IPC request body) is still
+    accepted for older clients.
+    """
+    with phase('load'):
+        dataset_id = payload.get('dataset_id')
+        if dataset_id:
+            df = store.get_frame(dataset_id)
+        elif is_arrow_request():
+            df = optimize_frame(arrow_body()[0])
+        else:
+            data = payload.get('data', [])
+            if not data:
+                raise ApiError('No data provided')
+            df = optimize_frame(pd.DataFrame(data))
+    count_rows(len(df))
+    return df
+
+
+def frame_response(body, df, rows_key, orient='records'):
+    """
+    Respond with ``body`` plus the rows of ``df`` under ``rows_key``.
+
+    Clients sending ``Accept: application/vnd.apache.arrow.stream`` get ``df``
+    as an Arrow IPC stream instead, with ``body`` as JSON in the schema
+    metadata under ``response``; everyone else gets JSON.
+    """
+    with phase('serialize'):
+        if wants_arrow():
+            metadata = {ARROW_RESPONSE_KEY: json.dumps(body, default=str).encode()}
+            return Response(frame_to_arrow_stream(df, metadata), mimetype=ARROW_STREAM_MIMETYPE)
+        rows = serialize_frame(df, orient)
+    return jsonify({**body, rows_key: rows})
+
+
+def dataset_metadata(entry):
+    metadata = entry.metadata()
+    metadata['success'] = True
+    return metadata
+
+
+def dataset_summary(entry, orient='records'):
+    """Metadata plus a small preview of a stored dataset's current frame."""
+    summary = dataset_metadata(entry)
+    with phase('serialize'):
+        summary['preview'] = serialize_frame(entry.head(PREVIEW_ROWS), orient)
+    return summary
+
+
+def dataset_response(entry, orient='records', details=None):
+    """``dataset_summary`` as a response, in JSON or Arrow."""
+    return frame_response({**dataset_metadata(entry), **(details or {})},
+                          entry.head(PREVIEW_ROWS), 'preview', orient)
+
+
+def apply_transformation(payload, transform, details=None, steps=None):
+    """
+    Run ``transform(df) -> new_df`` for a request and build the response.
+
+    For a stored dataset the result becomes its new current version (named
+    after the endpoint in the version history) and only metadata and a
+    preview are returned. Inline ``data`` requests get the full transformed
+    rows back, as before. ``details`` (a dict the transform may fill in) is
+    merged into the response.
+
+    With ``"delta": true`` the preview (or the inline rows) is replaced by a
+    ``delta`` against the rows the client already holds, when the
+    transformation only added columns or dropped rows.
+
+    ``steps`` (pipeline ``Step``s doing what ``transform`` does) allow a
+    stored dataset too big to load to be transformed out of core instead.
+    """
+    orient = response_orient(payload)
+    dataset_id = payload.get('dataset_id')
+    if dataset_id and steps is not None and runs_out_of_core(payload, dataset_id):
+        return apply_out_of_core(dataset_id, steps, orient, details)
+
+    delta = wants_delta(payload)
+    frames = {}
+
+    def timed_transform(df):
+        count_rows(len(df))
+        with phase('compute'):
+            result = transform(df)
+        if delta:
+            frames['before'], frames['after'] = df, result
+        return result
+
+    if dataset_id:
+        # Storing the new version (and writing it to disk) is the 'store' phase
+        with phase('store'):
+            entry = store.transform(dataset_id, timed_transform, operation=request.path.lstrip('/'))
+        if delta:
+            with phase('serialize'):
+                changes = frame_delta(frames['before'], frames['after'], PREVIEW_ROWS, orient)
+            if changes is not None:
+                return jsonify({**dataset_metadata(entry), **(details or {}), 'delta': changes})
+        return dataset_response(entry, orient, details)
+
+    df = timed_transform(load_frame(payload))
+    body = {
+        'success': True,
+        'rows': len(df),
+        'columns': list(df.columns),
+        **(details or {})
+    }
+    if delta:
+        with phase('serialize'):
+            changes = frame_delta(frames['before'], df, orient=orient)
+        if changes is not None:
+            return jsonify({**body, 'delta': changes})
+    return frame_response(body, df, 'data', orient)
+
+
+def apply_out_of_core(dataset_id, steps, orient='records', details=None):
+    """Run ``steps`` on a stored dataset part by part, without loading it, and respond as ``apply_transformation``."""
+    def run(source_path, output_path):
+        dataset, timings = out_of_core.run(source_path, steps, output_path)
+        count_rows(timings[0]['rows_in'])
+        if details is not None:
+            details['steps'] = timings
+            details['total_ms'] = round(sum(timing['ms'] for timing in timings), 3)
+        return steps_changed_columns(steps, timings[0]['rows_in'], dataset.rows)
+
+    with phase('compute'):
+        entry = store.transform_out_of_core(dataset_id, run, operation=request.path.lstrip('/'))
+    return dataset_response(entry, orient, {**(details or {}), 'out_of_core': True})
+
+
+def apply_step(payload, op, params=None):
+    """``apply_transformation`` for one pipeline operation (see pipeline.OPERATIONS)."""
+    step = Step(op, params)
+    return apply_transformation(payload, step.run, steps=[step])
+
+
+def filtered_frame(payload, row_filter, original=False):
+    """
+    ``(df, rows)``: the request's frame and the positions of its rows
+    matching ``row_filter`` (a parsed "filter", see query.py), or None for
+    every row. A stored dataset's column indexes are memoized on its entry.
+    """
+    if payload.get('dataset_id'):
+        with phase('load'):
+            indexes = dataset_indexes(store.get(payload['dataset_id']), original)
+        count_rows(len(indexes.df))
+    else:
+        indexes = FrameIndexes(load_frame(payload))
+    if row_filter is None:
+        return indexes.df, None
+    with phase('filter'):
+        return indexes.df, select_rows(indexes, row_filter)
+
+
+def filtered_column(df, column, rows):
+    """``df[column]``, only at the positions ``rows`` when given."""
+    if column not in df.columns:
+        raise ApiError(f'Column {column} not found')
+    return df[column] if rows is None else df[column].iloc[rows]
+
+
+def column_statistic(payload, statistic):
+    """
+    One statistic of ``payload['column']``, over the rows matching the
+    request's "filter" if it has one; memoized for unfiltered stored datasets.
+    """
+    column = payload.get('column')
+    row_filter = parse_filter(payload.get('filter'))
+    if payload.get('dataset_id') and row_filter is None:
+        with phase('compute'):
+            stats, _ = column_stats(store.get(payload['dataset_id']), column)
+    else:
+        df, rows = filtered_frame(payload, row_filter)
+        values = filtered_column(df, column, rows)
+        with phase('compute'):
+            stats = compute_column_stats(values)
+    return stats[statistic]
+
+
+def pipeline_transform(steps, optimize=True):
+    """
+    A transform running a recipe's steps, the dict it fills with the
+    executed plan and per-step timings, and the planned steps.
+    """
+    parsed = parse_steps(steps)
+    planned = plan(parsed) if optimize else parsed
+    details = {}
+
+    def transform(df):
+        df, timings = execute(df, planned)
+        details['steps'] = timings
+        details['total_ms'] = round(sum(timing['ms'] for timing in timings), 3)
+        return df
+
+    return transform, details, planned
+
+
+def submit_upload_job(file, recipe_id, orient):
+    """Save an upload and parse it in a background job; the dataset is registered when it finishes."""
+    dataset_id = store.new_id()
+    upload_dir = os.path.join(DATA_DIR, 'uploads')
+    os.makedirs(upload_dir, exist_ok=True)
+    upload_path = os.path.join(upload_dir, dataset_id + os.path.splitext(file.filename)[1].lower())
+    file.save(upload_path)
+
+    def on_done(job, result):
+        path = store.persistence.frame_path(dataset_id, result['file'])
+        entry = store.create(name=file.filename, dataset_id=dataset_id,
+                             source=open_persisted_frame(path), source_file=result['file'])
+        details = {}
+        if recipe_id:
+            transform, details, _ = pipeline_transform(recipes.get(recipe_id)['steps'])
+            entry = store.transform(dataset_id, transform, operation=f'recipes/{recipe_id}/apply')
+        return {**dataset_summary(entry, orient), **details}
+
+    return jobs.submit('upload', tasks.ingest_upload_job, upload_path, file.filename,
+                       store.persistence.dataset_dir(dataset_id), on_done=on_done)
 
 @app.route('/upload', methods=['POST'])
 def upload_file():
-    global current_dataset
-    
     try:
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file provided'}), 400
-        
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
-        
-        # Read file based on extension
-        filename = file.filename.lower()
-        
-        if filename.endswith('.csv'):
-            df = pd.read_csv(file)
-        elif filename.endswith(('.xls', '.xlsx')):
-            df = pd.read_excel(file)
+        if is_arrow_request():
+            # The request body is the dataset as an Arrow IPC stream
+            df, params = arrow_body()
+            name = request.args.get('name') or params.get('name') or 'upload.arrows'
+            recipe_id = request.args.get('recipe_id') or params.get('recipe_id')
         else:
-            return jsonify({'error': 'Unsupported file type'}), 400
-        
-        # Store dataset
-        current_dataset = df
-        
-        # Convert full dataset to JSON
-        full_data = df.to_dict('records')
-        
-        # Replace NaN with None for JSON serialization
-        for record in full_data:
-            for key, value in record.items():
-                if pd.isna(value):
-                    record[key] = None
-        
-        # Also create preview (first 100 rows) for display
-        preview_data = full_data[:100]
-        
-        return jsonify({
+            if 'file' not in request.files:
+                return jsonify({'error': 'No file provided'}), 400
+
+            file = request.files['file']
+            if file.filename == '':
+                return jsonify({'error': 'No file selected'}), 400
+
+            # Read file based on extension
+            filename = file.filename.lower()
+
+            if wants_async() and filename.endswith(('.csv',) + EXCEL_EXTENSIONS):
+                # Parse in a worker process; poll /jobs/<job_id> for the dataset
+                if store.persistence is None:
+                    raise ApiError('Background uploads need persistent storage')
+                job = submit_upload_job(file, request.form.get('recipe_id'), response_orient())
+                return job_accepted(job)
+
+            with phase('load'):
+                if filename.endswith('.csv'):
+                    df = pd.read_csv(file)
+                elif filename.endswith(EXCEL_EXTENSIONS):
+                    df = read_sheet(file.stream, engine=EXCEL_ENGINE)
+                elif filename.endswith(('.arrow', '.arrows')):
+                    df, _ = arrow_stream_to_frame(file.read())
+                else:
+                    return jsonify({'error': 'Unsupported file type'}), 400
+
+            name = file.filename
+            recipe_id = request.form.get('recipe_id')
+
+        # Store dataset with compact dtypes; the client refers to it by dataset_id from now on
+        count_rows(len(df))
+        with phase('optimize'):
+            df = optimize_frame(df)
+        with phase('store'):
+            entry = store.create(df, name=name)
+
+        # Optionally replay a saved recipe on the new upload
+        details = {}
+        if recipe_id:
+            transform, details, _ = pipeline_transform(recipes.get(recipe_id)['steps'])
+            entry = store.transform(entry.dataset_id, transform, operation=f'recipes/{recipe_id}/apply')
+
+        return dataset_response(entry, response_orient(), details)
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/upload/batch', methods=['POST'])
+def upload_batch():
+    """
+    Several Excel workbooks, or several sheets of one, in one upload.
+
+    Form fields: ``files`` (one or more workbooks), ``sheets`` ('all', the
+    default, 'first', or comma-separated sheet names every file has),
+    ``combine`` ('concat', the default, stacks every sheet into one dataset
+    over the union of their columns; 'separate' stores one dataset per
+    sheet), ``source_column`` (with 'concat', a column naming each row's
+    file:sheet) and ``recipe_id``. Sheets are parsed in parallel; the
+    response reports each source and how their columns line up.
+    """
+    upload_paths = []
+    try:
+        files = [file for file in request.files.getlist('files') + request.files.getlist('file') if file.filename]
+        if not files:
+            return jsonify({'error': 'No file provided'}), 400
+        unsupported = [file.filename for file in files if not file.filename.lower().endswith(EXCEL_EXTENSIONS)]
+        if unsupported:
+            raise ApiError(f"Batch uploads take Excel files only: {', '.join(unsupported)}")
+
+        sheets = request.form.get('sheets', 'all')
+        if sheets not in ('first', 'all'):
+            sheets = [name.strip() for name in sheets.split(',') if name.strip()]
+            if not sheets:
+                raise ApiError("sheets must be 'first', 'all' or a comma-separated list of sheet names")
+        combine = request.form.get('combine', 'concat')
+        if combine not in ('concat', 'separate'):
+            raise ApiError("combine must be 'concat' or 'separate'")
+        source_column = request.form.get('source_column') or None
+        recipe_id = request.form.get('recipe_id')
+        orient = response_orient()
+
+        upload_dir = os.path.join(DATA_DIR, 'uploads')
+        os.makedirs(upload_dir, exist_ok=True)
+        for file in files:
+            path = os.path.join(upload_dir, uuid.uuid4().hex + os.path.splitext(file.filename)[1].lower())
+            file.save(path)
+            upload_paths.append((path, file.filename))
+
+        # Separate datasets get compact dtypes in the workers; concatenated ones once combined
+        with phase('load'):
+            parsed = workbook_reader.read(workbook_reader.sources(upload_paths, sheets),
+                                          compact=combine == 'separate')
+        sources = [{'file': filename, 'sheet': sheet, 'rows': len(df), 'columns': df.shape[1],
+                    'parse_ms': round(ms, 1)} for filename, sheet, df, ms in parsed]
+        # Sheets without even a header row have nothing to store
+        frames = [(f'{filename}:{sheet}', df) for filename, sheet, df, _ in parsed if df.shape[1]]
+        if not frames:
+            raise ApiError('The uploaded workbooks have no data')
+        details = {'engine': resolve_engine(EXCEL_ENGINE), 'sources': sources,
+                   'schema': schema_report(frames)}
+        count_rows(sum(len(df) for _, df in frames))
+
+        if combine == 'separate':
+            datasets = []
+            for label, df in frames:
+                with phase('store'):
+                    entry = store.create(df, name=label)
+                recipe_details = {}
+                if recipe_id:
+                    transform, recipe_details, _ = pipeline_transform(recipes.get(recipe_id)['steps'])
+                    entry = store.transform(entry.dataset_id, transform, operation=f'recipes/{recipe_id}/apply')
+                datasets.append({**dataset_metadata(entry), 'source': label, **recipe_details})
+            return jsonify({'success': True, 'datasets': datasets, **details})
+
+        with phase('optimize'):
+            df = pd.concat([df for _, df in frames], ignore_index=True, sort=False)
+            if source_column:
+                if source_column in df.columns:
+                    raise ApiError(f"source_column '{source_column}' is already a column")
+                labels = pd.Series([label for label, _ in frames])
+                df.insert(0, source_column, labels.repeat([len(frame) for _, frame in frames]).to_numpy())
+            df = optimize_frame(df)
+        with phase('store'):
+            entry = store.create(df, name=', '.join(dict.fromkeys(filename for _, filename in upload_paths)))
+
+        if recipe_id:
+            transform, recipe_details, _ = pipeline_transform(recipes.get(recipe_id)['steps'])
+            entry = store.transform(entry.dataset_id, transform, operation=f'recipes/{recipe_id}/apply')
+            details.update(recipe_details)
+
+        return dataset_response(entry, orient, details)
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        for path, _ in upload_paths:
+            os.remove(path)
+
+@app.route('/upload/stream', methods=['POST'])
+def upload_file_streaming():
+    """
+    Chunked CSV ingest for large files.
+
+    The file is parsed in chunks into an on-disk columnar store and the
+    response is newline-delimited JSON: one {"event": "progress", ...} line
+    per chunk, then {"event": "complete", ...dataset summary} (or
+    {"event": "error", "error": ...}).
+    """
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file provided'}), 400
+
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': 'No file selected'}), 400
+    if not file.filename.lower().endswith('.csv'):
+        return jsonify({'error': 'Streaming upload supports CSV files only'}), 400
+
+    orient = response_orient()
+    dataset_id = store.new_id()
+    dataset_dir = store.persistence.parts_dir(dataset_id)
+    recipe_id = request.form.get('recipe_id')
+
+    def events():
+        completed = False
+        try:
+            ingest = CsvIngest(file.stream, dataset_dir)
+            for progress in ingest.run():
+                yield json.dumps({'event': 'progress', **progress}) + '\n'
+
+            entry = store.create(name=file.filename, dataset_id=dataset_id, source=ingest.dataset)
+            if ingest.sketch is not None:
+                seed_sketches(entry, ingest.sketch)
+
+            # Optionally replay a saved recipe on the new upload
+            details = {}
+            if recipe_id:
+                transform, details, _ = pipeline_transform(recipes.get(recipe_id)['steps'])
+                entry = store.transform(dataset_id, transform, operation=f'recipes/{recipe_id}/apply')
+
+            completed = True
+            yield json.dumps({'event': 'complete', **dataset_summary(entry, orient), **details}) + '\n'
+
+        except Exception as e:
+            yield json.dumps({'event': 'error', 'error': str(e)}) + '\n'
+
+        finally:
+            # Also when the client disconnected (GeneratorExit) mid-upload
+            if not completed:
+                try:
+                    store.delete(dataset_id)
+                except ApiError:
+                    # Failed before the dataset was registered: remove the parts written so far
+                    store.persistence.delete(dataset_id)
+
+    return Response(stream_with_context(events()), mimetype='application/x-ndjson')
+
+@app.route('/datasets', methods=['GET'])
+def list_datasets():
+    return jsonify({'success': True, 'datasets': store.list()})
+
+@app.route('/datasets/<dataset_id>', methods=['GET'])
+def get_dataset(dataset_id):
+    try:
+        orient = response_orient()
+        entry = store.get(dataset_id)
+
+        # Preview of the dataset as uploaded, for the "Original" view
+        if request.args.get('view') == 'original':
+            summary = dataset_metadata(entry)
+            summary['rows'] = len(entry.original)
+            summary['columns'] = list(entry.original.columns)
+            return frame_response(summary, entry.original.head(PREVIEW_ROWS), 'preview', orient)
+
+        return dataset_response(entry, orient)
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+
+@app.route('/datasets/<dataset_id>/rows', methods=['GET'])
+def get_dataset_rows(dataset_id):
+    """
+    One window of rows: ?offset=&limit=&sort=[-]column&filter=[column:]text&view=original
+    """
+    try:
+        orient = response_orient()
+        original = request.args.get('view') == 'original'
+        offset = int_arg('offset', 0)
+        limit = int_arg('limit', DEFAULT_PAGE_ROWS)
+
+        entry = store.get(dataset_id)
+        with entry.lock:
+            df, cache, version = entry.frame(original), entry.cache(original), entry.version
+
+        window, total_rows = row_window(
+            df, cache,
+            offset=offset,
+            limit=limit,
+            sort=request.args.get('sort') or None,
+            filter_text=request.args.get('filter') or None
+        )
+
+        return frame_response({
             'success': True,
-            'rows': len(df),
-            'columns': list(df.columns),
-            'preview': preview_data,  # For display
-            'data': full_data  # Full dataset for operations
-        })
-    
+            'dataset_id': dataset_id,
+            'version': 0 if original else version,
+            'offset': offset,
+            'limit': limit,
+            'total_rows': total_rows,
+            'columns': list(df.columns)
+        }, window, 'rows', orient)
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/datasets/<dataset_id>/query', methods=['POST'])
+def query_dataset(dataset_id):
+    """
+    Filter, sort and project a stored dataset on the server.
+    Expects JSON body: { "filter": {"column": ..., "op": ..., "value": ...} (or "and"/"or"/"not" trees,
+    or an expression string such as "region == 'APAC' and revenue > 10000"), "sort": ["-revenue", ...],
+    "columns": [...], "offset": 0, "limit": 100, "view": "original" }
+    """
+    try:
+        payload = request_payload()
+        orient = response_orient(payload)
+        original = payload.get('view') == 'original'
+        offset = int_arg('offset', 0, payload)
+        limit = int_arg('limit', DEFAULT_PAGE_ROWS, payload)
+        if offset < 0:
+            raise ApiError('offset must be >= 0')
+        if not 0 < limit <= MAX_PAGE_ROWS:
+            raise ApiError(f'limit must be between 1 and {MAX_PAGE_ROWS}')
+        row_filter = parse_filter(payload.get('filter'))
+        sort_keys = parse_sort_keys(payload.get('sort'))
+
+        entry = store.get(dataset_id)
+        with entry.lock:
+            indexes = dataset_indexes(entry, original)
+            version = 0 if original else entry.version
+        df = indexes.df
+
+        columns = payload.get('columns') or list(df.columns)
+        if not isinstance(columns, list):
+            raise ApiError('columns must be a list of column names')
+        missing = [col for col in columns if col not in df.columns]
+        if missing:
+            raise ApiError(f"Columns not found: {', '.join(map(str, missing))}")
+
+        count_rows(len(df))
+        with phase('filter'):
+            positions = select_rows(indexes, row_filter, sort_keys)
+        window = df.iloc[positions[offset:offset + limit]][columns]
+
+        return frame_response({
+            'success': True,
+            'dataset_id': dataset_id,
+            'version': version,
+            'filter': row_filter,
+            'sort': [col if ascending else f'-{col}' for col, ascending in sort_keys],
+            'offset': offset,
+            'limit': limit,
+            'total_rows': len(positions),
+            'columns': columns
+        }, window, 'rows', orient)
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/datasets/<dataset_id>/memory', methods=['GET'])
+def get_dataset_memory(dataset_id):
+    """
+    Per-column memory of a stored dataset (?view=original for the upload):
+    bytes with its compact dtypes and with pandas' default dtypes.
+    """
+    try:
+        original = request.args.get('view') == 'original'
+        entry = store.get(dataset_id)
+        with entry.lock:
+            df, cache = entry.frame(original), entry.cache(original)
+
+        # Measuring object columns touches every value, so keep the report with the frame
+        report = cache.get('memory')
+        if report is None:
+            report = cache['memory'] = memory_report(df)
+
+        return jsonify({'success': True, 'dataset_id': dataset_id, **report})
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/datasets/<dataset_id>', methods=['DELETE'])
+def delete_dataset(dataset_id):
+    try:
+        store.delete(dataset_id)
+        return jsonify({'success': True})
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+
+@app.route('/datasets/<dataset_id>/reset', methods=['POST'])
+def reset_dataset(dataset_id):
+    try:
+        entry = store.reset(dataset_id)
+        return dataset_response(entry, response_orient(request_payload()))
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+
+@app.route('/datasets/<dataset_id>/versions', methods=['GET'])
+def list_versions(dataset_id):
+    """The dataset's version graph: every version with its parent and the operation that made it."""
+    try:
+        entry = store.get(dataset_id)
+        with entry.lock:
+            return jsonify({
+                'success': True,
+                'dataset_id': dataset_id,
+                'current_version': entry.version,
+                'can_undo': entry.can_undo(),
+                'can_redo': entry.can_redo(),
+                'retained_bytes': entry.retained_bytes(),
+                'versions': entry.history()
+            })
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+
+@app.route('/datasets/<dataset_id>/undo', methods=['POST'])
+def undo_dataset(dataset_id):
+    """Step back to the parent of the current version."""
+    try:
+        entry = store.undo(dataset_id)
+        return dataset_response(entry, response_orient(request_payload()))
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+
+@app.route('/datasets/<dataset_id>/redo', methods=['POST'])
+def redo_dataset(dataset_id):
+    """Step forward to the version last undone (or last created) from the current one."""
+    try:
+        entry = store.redo(dataset_id)
+        return dataset_response(entry, response_orient(request_payload()))
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+
+@app.route('/datasets/<dataset_id>/versions/<int:version>/checkout', methods=['POST'])
+def checkout_version(dataset_id, version):
+    """
+    Make any version current. Transforming it afterwards starts a new branch;
+    the versions it had been transformed into stay reachable.
+    """
+    try:
+        entry = store.checkout(dataset_id, version)
+        return dataset_response(entry, response_orient(request_payload()))
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+
+@app.route('/datasets/<dataset_id>/append', methods=['POST'])
+def append_rows(dataset_id):
+    """
+    Add rows at the end of a stored dataset, as a new version.
+
+    The rows are posted as {"data": [...]}, an Arrow IPC body, or a CSV or
+    Excel ``file``. They may leave out columns of the dataset (null in the
+    new rows) but not add any, and are converted to the dataset's column
+    types where no value is lost. P&L aggregates kept for the previous
+    version are brought up to date from the new rows alone.
+    """
+    try:
+        with phase('load'):
+            if is_arrow_request():
+                rows, _ = arrow_body()
+            elif 'file' in request.files:
+                file = request.files['file']
+                filename = file.filename.lower()
+                if filename.endswith('.csv'):
+                    rows = pd.read_csv(file)
+                elif filename.endswith(EXCEL_EXTENSIONS):
+                    rows = read_sheet(file.stream, engine=EXCEL_ENGINE)
+                else:
+                    return jsonify({'error': 'Unsupported file type'}), 400
+            else:
+                data = request_payload().get('data')
+                if not data:
+                    raise ApiError('No rows provided')
+                rows = pd.DataFrame(data)
+        count_rows(len(rows))
+        with phase('optimize'):
+            rows = optimize_frame(rows)
+
+        def append(df):
+            extra = [str(col) for col in rows.columns if col not in df.columns]
+            if extra:
+                raise ApiError(f"Columns not in the dataset: {', '.join(extra)}")
+            return concat_frames([df, conform_frame(rows, df)])
+
+        with phase('compute'):
+            entry = store.transform(dataset_id, append, operation=APPEND_OPERATION)
+            refreshed = refresh_pl_aggregates(entry)
+        return dataset_response(entry, response_orient(),
+                                {'appended_rows': len(rows), 'aggregates_updated': refreshed})
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/clean/remove-null', methods=['POST'])
 def remove_nulls():
     try:
-        data = request.json.get('data', [])
-        if not data:
-            return jsonify({'error': 'No data provided'}), 400
-        
-        df = pd.DataFrame(data)
-        
-        # Remove rows with any null values
-        df_cleaned = df.dropna()
-        
-        # Convert full dataset and clean NaN values
-        full_data = df_cleaned.to_dict('records')
-        for record in full_data:
-            for key, value in record.items():
-                if pd.isna(value):
-                    record[key] = None
-                elif isinstance(value, (pd.Timestamp, datetime)):
-                    record[key] = value.strftime('%Y-%m-%d %H:%M:%S')
-        
-        return jsonify({
-            'success': True,
-            'rows': len(df_cleaned),
-            'columns': list(df_cleaned.columns),
-            'data': full_data
-        })
-    
+        return apply_step(request_payload(), 'remove-null')
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         import traceback
         return jsonify({'error': str(e), 'traceback': traceback.format_exc()}), 500
@@ -94,31 +893,10 @@ def remove_nulls():
 @app.route('/clean/remove-duplicate', methods=['POST'])
 def remove_duplicates():
     try:
-        data = request.json.get('data', [])
-        if not data:
-            return jsonify({'error': 'No data provided'}), 400
-        
-        df = pd.DataFrame(data)
-        
-        # Remove duplicate rows
-        df_cleaned = df.drop_duplicates()
-        
-        # Convert full dataset and clean NaN values
-        full_data = df_cleaned.to_dict('records')
-        for record in full_data:
-            for key, value in record.items():
-                if pd.isna(value):
-                    record[key] = None
-                elif isinstance(value, (pd.Timestamp, datetime)):
-                    record[key] = value.strftime('%Y-%m-%d %H:%M:%S')
-        
-        return jsonify({
-            'success': True,
-            'rows': len(df_cleaned),
-            'columns': list(df_cleaned.columns),
-            'data': full_data
-        })
-    
+        return apply_step(request_payload(), 'remove-duplicate')
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         import traceback
         return jsonify({'error': str(e), 'traceback': traceback.format_exc()}), 500
@@ -126,33 +904,13 @@ def remove_duplicates():
 @app.route('/clean/rename-columns', methods=['POST'])
 def rename_columns():
     try:
-        data = request.json.get('data', [])
-        rename_map = request.json.get('rename_map', {})
-        
-        if not data:
-            return jsonify({'error': 'No data provided'}), 400
-        
-        df = pd.DataFrame(data)
-        
-        # Rename columns
-        df_renamed = df.rename(columns=rename_map)
-        
-        # Convert full dataset to dict and clean NaN values
-        full_data = df_renamed.to_dict('records')
-        for record in full_data:
-            for key, value in record.items():
-                if pd.isna(value):
-                    record[key] = None
-                elif isinstance(value, (pd.Timestamp, datetime)):
-                    record[key] = value.strftime('%Y-%m-%d %H:%M:%S')
-        
-        return jsonify({
-            'success': True,
-            'rows': len(df_renamed),
-            'columns': list(df_renamed.columns),
-            'data': full_data
-        })
-    
+        payload = request_payload()
+        rename_map = payload.get('rename_map', {})
+
+        return apply_step(payload, 'rename-columns', {'rename_map': rename_map})
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         import traceback
         return jsonify({'error': str(e), 'traceback': traceback.format_exc()}), 500
@@ -160,46 +918,13 @@ def rename_columns():
 @app.route('/clean/change-datatypes', methods=['POST'])
 def change_datatypes():
     try:
-        data = request.json.get('data', [])
-        dtype_map = request.json.get('dtype_map', {})
-        
-        if not data:
-            return jsonify({'error': 'No data provided'}), 400
-        
-        df = pd.DataFrame(data)
-        
-        # Convert data types
-        for col, dtype in dtype_map.items():
-            if col in df.columns:
-                try:
-                    if dtype == 'date':
-                        df[col] = pd.to_datetime(df[col], errors='coerce')
-                    elif dtype == 'int':
-                        df[col] = pd.to_numeric(df[col], errors='coerce').astype('Int64')
-                    elif dtype == 'float':
-                        df[col] = pd.to_numeric(df[col], errors='coerce')
-                    elif dtype == 'string':
-                        df[col] = df[col].astype(str)
-                except Exception as e:
-                    # If conversion fails, keep original
-                    pass
-        
-        # Convert full dataset and clean NaN values
-        full_data = df.to_dict('records')
-        for record in full_data:
-            for key, value in record.items():
-                if pd.isna(value):
-                    record[key] = None
-                elif isinstance(value, (pd.Timestamp, datetime)):
-                    record[key] = value.strftime('%Y-%m-%d %H:%M:%S')
-        
-        return jsonify({
-            'success': True,
-            'rows': len(df),
-            'columns': list(df.columns),
-            'data': full_data
-        })
-    
+        payload = request_payload()
+        dtype_map = payload.get('dtype_map', {})
+
+        return apply_step(payload, 'change-datatypes', {'dtype_map': dtype_map})
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         import traceback
         return jsonify({'error': str(e), 'traceback': traceback.format_exc()}), 500
@@ -207,189 +932,349 @@ def change_datatypes():
 @app.route('/clean/trim-whitespaces', methods=['POST'])
 def trim_whitespaces():
     try:
-        data = request.json.get('data', [])
-        if not data:
-            return jsonify({'error': 'No data provided'}), 400
-        
-        df = pd.DataFrame(data)
-        
-        # Trim whitespaces from string columns
-        for col in df.columns:
-            if df[col].dtype == 'object':
-                df[col] = df[col].astype(str).str.strip()
-                # Replace 'nan' string with None
-                df[col] = df[col].replace('nan', None)
-        
-        # Convert full dataset and clean NaN values
-        full_data = df.to_dict('records')
-        for record in full_data:
-            for key, value in record.items():
-                if pd.isna(value) or value == 'nan' or value == 'None':
-                    record[key] = None
-                elif isinstance(value, (pd.Timestamp, datetime)):
-                    record[key] = value.strftime('%Y-%m-%d %H:%M:%S')
-        
+        payload = request_payload()
+        return apply_step(payload, 'trim-whitespaces', text_cleaning.parse_options(payload))
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+    except Exception as e:
+        import traceback
+        return jsonify({'error': str(e), 'traceback': traceback.format_exc()}), 500
+
+@app.route('/pipeline', methods=['POST'])
+def run_pipeline():
+    """
+    Run several transformations in one request.
+    Expects JSON body: { "dataset_id": "...", "steps": [{"op": "remove-null"}, ...] }
+    (or "recipe_id" instead of "steps"); "optimize": false runs the steps exactly as given.
+    """
+    try:
+        payload = request_payload()
+        steps = payload.get('steps')
+        if steps is None and payload.get('recipe_id'):
+            steps = recipes.get(payload['recipe_id'])['steps']
+
+        transform, details, planned = pipeline_transform(steps, optimize=payload.get('optimize', True))
+        return apply_transformation(payload, transform, details, planned)
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+    except Exception as e:
+        import traceback
+        return jsonify({'error': str(e), 'traceback': traceback.format_exc()}), 500
+
+@app.route('/recipes', methods=['GET'])
+def list_recipes():
+    return jsonify({'success': True, 'recipes': recipes.list()})
+
+@app.route('/recipes', methods=['POST'])
+def save_recipe():
+    """Save a recipe. Expects JSON body: { "name": "...", "steps": [...] }"""
+    try:
+        payload = request_payload()
+        recipe = recipes.create(payload.get('name'), payload.get('steps'))
+        return jsonify({'success': True, **recipe}), 201
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+
+@app.route('/recipes/<recipe_id>', methods=['GET'])
+def get_recipe(recipe_id):
+    try:
+        return jsonify({'success': True, **recipes.get(recipe_id)})
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+
+@app.route('/recipes/<recipe_id>', methods=['DELETE'])
+def delete_recipe(recipe_id):
+    try:
+        recipes.delete(recipe_id)
+        return jsonify({'success': True})
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+
+@app.route('/recipes/<recipe_id>/apply', methods=['POST'])
+def apply_recipe(recipe_id):
+    """Replay a saved recipe. Expects JSON body: { "dataset_id": "..." }"""
+    try:
+        payload = request_payload()
+        transform, details, planned = pipeline_transform(recipes.get(recipe_id)['steps'],
+                                                         optimize=payload.get('optimize', True))
+        return apply_transformation(payload, transform, details, planned)
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+    except Exception as e:
+        import traceback
+        return jsonify({'error': str(e), 'traceback': traceback.format_exc()}), 500
+
+@app.route('/stats', methods=['POST'])
+def calculate_stats():
+    """
+    All column statistics in one call.
+    Expects JSON body: { "dataset_id": "...", "columns": [...] (default: all), "quantiles": [0.25, 0.5, 0.75],
+    "filter": ... (optional, see /datasets/<id>/query) }
+    """
+    try:
+        payload = request_payload()
+        quantiles = parse_quantiles(payload.get('quantiles'))
+        original = payload.get('view') == 'original'
+        row_filter = parse_filter(payload.get('filter'))
+
+        results = {}
+        cached_columns = []
+        if row_filter is not None:
+            # Statistics of a subset aren't memoized; the filter's column indexes are
+            df, rows = filtered_frame(payload, row_filter, original)
+            with phase('compute'):
+                for column in payload.get('columns') or list(df.columns):
+                    results[column] = compute_column_stats(filtered_column(df, column, rows), quantiles)
+        elif payload.get('dataset_id'):
+            entry = store.get(payload['dataset_id'])
+            with phase('compute'):
+                for column in payload.get('columns') or list(entry.frame(original).columns):
+                    results[column], cached = column_stats(entry, column, quantiles, original)
+                    if cached:
+                        cached_columns.append(column)
+        else:
+            df = load_frame(payload)
+            with phase('compute'):
+                for column in payload.get('columns') or list(df.columns):
+                    if column not in df.columns:
+                        raise ApiError(f'Column {column} not found')
+                    results[column] = compute_column_stats(df[column], quantiles)
+
         return jsonify({
             'success': True,
-            'rows': len(df),
-            'columns': list(df.columns),
-            'data': full_data
+            'stats': results,
+            'cached_columns': cached_columns
         })
-    
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
-        import traceback
-        return jsonify({'error': str(e), 'traceback': traceback.format_exc()}), 500
+        return jsonify({'error': str(e)}), 500
+
+def approx_sketch(dataset_id, payload, columns=None, sample=False):
+    """
+    The memoized sketch of a stored dataset (``view`` original or current),
+    built part by part across the out-of-core workers when its frame is on
+    disk and not in memory. Returns ``(entry, sketch, cached_columns)``.
+    """
+    original = payload.get('view') == 'original'
+    entry = store.get(dataset_id)
+    with entry.lock:
+        node = entry.versions[0] if original else entry.node
+        on_disk = store.persistence is not None and node.file is not None and not node.loaded
+        path = store.persistence.frame_path(dataset_id, node.file) if on_disk else None
+
+    def build(todo, sample_rows):
+        if path is not None:
+            return out_of_core.sketch(path, todo, sample_rows)
+        return sketch_frame(entry.frame(original), todo, sample_rows)
+
+    with phase('sketch'):
+        sketch, cached = dataset_sketch(entry, build, columns, sample, original)
+    return entry, sketch, cached
+
+@app.route('/datasets/<dataset_id>/approx/stats', methods=['POST'])
+def approx_stats(dataset_id):
+    """
+    Approximate column statistics from mergeable sketches, with their error bounds.
+    Expects JSON body: { "columns": [...] (default: all), "quantiles": [0.25, 0.5, 0.75], "view": "original" }
+    """
+    try:
+        payload = request_payload()
+        quantiles = parse_quantiles(payload.get('quantiles'))
+        columns = payload.get('columns') or None
+        if columns is not None and not isinstance(columns, list):
+            raise ApiError('columns must be a list of column names')
+
+        _, sketch, cached_columns = approx_sketch(dataset_id, payload, columns)
+        return jsonify({
+            'success': True,
+            'approximate': True,
+            'stats': {col: column.describe(quantiles) for col, column in sketch.columns.items()},
+            'cached_columns': cached_columns
+        })
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/datasets/<dataset_id>/approx/histogram', methods=['POST'])
+def approx_histogram(dataset_id):
+    """
+    Approximate histogram from the dataset's row sample: estimated counts per bin of a numeric column
+    (between its exact min and max), or of the most frequent values of any other column, each with its error.
+    Expects JSON body: { "column": "...", "bins": 20, "view": "original" }
+    """
+    try:
+        payload = request_payload()
+        column = payload.get('column')
+        if not column:
+            raise ApiError('column is required')
+        bins = int_arg('bins', 20, payload)
+        if not 0 < bins <= 1000:
+            raise ApiError('bins must be between 1 and 1000')
+
+        _, sketch, _ = approx_sketch(dataset_id, payload, [column], sample=True)
+        column_sketch = sketch.columns[column]
+        low = high = None
+        if column_sketch.kind == 'number' and column_sketch.quantiles.count:
+            low, high = column_sketch.quantiles.min, column_sketch.quantiles.max
+        histogram = sketch.sample.histogram(column, sketch.sample.seen, bins, low, high)
+
+        return jsonify({
+            'success': True,
+            'approximate': True,
+            'column': column,
+            'rows': sketch.sample.seen,
+            'sample_rows': len(sketch.sample.rows),
+            **histogram
+        })
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/datasets/<dataset_id>/approx/sample', methods=['POST'])
+def approx_sample(dataset_id):
+    """
+    A uniform random sample of the dataset's rows, for previews.
+    Expects JSON body: { "rows": 100, "columns": [...] (default: all), "view": "original" }
+    """
+    try:
+        payload = request_payload()
+        orient = response_orient(payload)
+        limit = int_arg('rows', DEFAULT_PAGE_ROWS, payload)
+        if not 0 < limit <= MAX_PAGE_ROWS:
+            raise ApiError(f'rows must be between 1 and {MAX_PAGE_ROWS}')
+
+        _, sketch, _ = approx_sketch(dataset_id, payload, [], sample=True)
+        rows = sketch.sample.rows
+        columns = payload.get('columns') or list(rows.columns)
+        missing = [col for col in columns if col not in rows.columns]
+        if missing:
+            raise ApiError(f"Columns not found: {', '.join(map(str, missing))}")
+
+        return frame_response({
+            'success': True,
+            'approximate': True,
+            'dataset_id': dataset_id,
+            'total_rows': sketch.sample.seen,
+            'sample_rows': min(limit, len(rows)),
+            'columns': columns
+        }, rows.head(limit)[columns], 'rows', orient)
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/math/sum', methods=['POST'])
 def calculate_sum():
     try:
-        data = request.json.get('data', [])
-        column = request.json.get('column')
-        
-        df = pd.DataFrame(data)
-        
-        if column not in df.columns:
-            return jsonify({'error': f'Column {column} not found'}), 400
-        
-        # Convert to numeric, ignoring errors
-        numeric_values = pd.to_numeric(df[column], errors='coerce')
-        result = numeric_values.sum()
-        
+        # Numeric statistics ignore values that can't be converted to numbers
+        result = column_statistic(request_payload(), 'sum')
+
         return jsonify({
             'success': True,
-            'value': float(result) if not pd.isna(result) else 0
+            'value': float(result) if result is not None else 0
         })
-    
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/math/average', methods=['POST'])
 def calculate_average():
     try:
-        data = request.json.get('data', [])
-        column = request.json.get('column')
-        
-        df = pd.DataFrame(data)
-        
-        if column not in df.columns:
-            return jsonify({'error': f'Column {column} not found'}), 400
-        
-        # Convert to numeric, ignoring errors
-        numeric_values = pd.to_numeric(df[column], errors='coerce')
-        result = numeric_values.mean()
-        
+        # Numeric statistics ignore values that can't be converted to numbers
+        result = column_statistic(request_payload(), 'average')
+
         return jsonify({
             'success': True,
-            'value': float(result) if not pd.isna(result) else 0
+            'value': float(result) if result is not None else 0
         })
-    
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/math/min', methods=['POST'])
 def calculate_min():
     try:
-        data = request.json.get('data', [])
-        column = request.json.get('column')
-        
-        df = pd.DataFrame(data)
-        
-        if column not in df.columns:
-            return jsonify({'error': f'Column {column} not found'}), 400
-        
-        # Convert to numeric, ignoring errors
-        numeric_values = pd.to_numeric(df[column], errors='coerce')
-        result = numeric_values.min()
-        
+        # Numeric statistics ignore values that can't be converted to numbers
+        result = column_statistic(request_payload(), 'min')
+
         return jsonify({
             'success': True,
-            'value': float(result) if not pd.isna(result) else 0
+            'value': float(result) if result is not None else 0
         })
-    
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/math/max', methods=['POST'])
 def calculate_max():
     try:
-        data = request.json.get('data', [])
-        column = request.json.get('column')
-        
-        df = pd.DataFrame(data)
-        
-        if column not in df.columns:
-            return jsonify({'error': f'Column {column} not found'}), 400
-        
-        # Convert to numeric, ignoring errors
-        numeric_values = pd.to_numeric(df[column], errors='coerce')
-        result = numeric_values.max()
-        
+        # Numeric statistics ignore values that can't be converted to numbers
+        result = column_statistic(request_payload(), 'max')
+
         return jsonify({
             'success': True,
-            'value': float(result) if not pd.isna(result) else 0
+            'value': float(result) if result is not None else 0
         })
-    
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/math/count', methods=['POST'])
 def calculate_count():
     try:
-        data = request.json.get('data', [])
-        column = request.json.get('column')
-        
-        df = pd.DataFrame(data)
-        
-        if column not in df.columns:
-            return jsonify({'error': f'Column {column} not found'}), 400
-        
         # Count non-null values
-        result = df[column].notna().sum()
-        
+        result = column_statistic(request_payload(), 'count')
+
         return jsonify({
             'success': True,
             'value': int(result)
         })
-    
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def column_operation(payload, operation):
+    """Apply one of the two-column arithmetic operations to the request's dataset."""
+    column1 = payload.get('column1')
+    column2 = payload.get('column2')
+    result_column = payload.get('result_column')
+
+    return apply_step(payload, operation, {
+        'column1': column1,
+        'column2': column2,
+        'result_column': result_column
+    })
+
 @app.route('/math/add', methods=['POST'])
 def calculate_add():
     try:
-        data = request.json.get('data', [])
-        column1 = request.json.get('column1')
-        column2 = request.json.get('column2')
-        result_column = request.json.get('result_column', f'{column1}_plus_{column2}')
-        
-        df = pd.DataFrame(data)
-        
-        if column1 not in df.columns or column2 not in df.columns:
-            return jsonify({'error': 'One or both columns not found'}), 400
-        
-        # Convert to numeric
-        col1 = pd.to_numeric(df[column1], errors='coerce')
-        col2 = pd.to_numeric(df[column2], errors='coerce')
-        
-        # Perform addition
-        df[result_column] = col1 + col2
-        
-        # Convert full dataset and clean NaN values
-        full_data = df.to_dict('records')
-        for record in full_data:
-            for key, value in record.items():
-                if pd.isna(value):
-                    record[key] = None
-                elif isinstance(value, (pd.Timestamp, datetime)):
-                    record[key] = value.strftime('%Y-%m-%d %H:%M:%S')
-        
-        return jsonify({
-            'success': True,
-            'rows': len(df),
-            'columns': list(df.columns),
-            'data': full_data
-        })
-    
+        return column_operation(request_payload(), 'add')
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         import traceback
         return jsonify({'error': str(e), 'traceback': traceback.format_exc()}), 500
@@ -397,39 +1282,10 @@ def calculate_add():
 @app.route('/math/subtract', methods=['POST'])
 def calculate_subtract():
     try:
-        data = request.json.get('data', [])
-        column1 = request.json.get('column1')
-        column2 = request.json.get('column2')
-        result_column = request.json.get('result_column', f'{column1}_minus_{column2}')
-        
-        df = pd.DataFrame(data)
-        
-        if column1 not in df.columns or column2 not in df.columns:
-            return jsonify({'error': 'One or both columns not found'}), 400
-        
-        # Convert to numeric
-        col1 = pd.to_numeric(df[column1], errors='coerce')
-        col2 = pd.to_numeric(df[column2], errors='coerce')
-        
-        # Perform subtraction
-        df[result_column] = col1 - col2
-        
-        # Convert full dataset and clean NaN values
-        full_data = df.to_dict('records')
-        for record in full_data:
-            for key, value in record.items():
-                if pd.isna(value):
-                    record[key] = None
-                elif isinstance(value, (pd.Timestamp, datetime)):
-                    record[key] = value.strftime('%Y-%m-%d %H:%M:%S')
-        
-        return jsonify({
-            'success': True,
-            'rows': len(df),
-            'columns': list(df.columns),
-            'data': full_data
-        })
-    
+        return column_operation(request_payload(), 'subtract')
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         import traceback
         return jsonify({'error': str(e), 'traceback': traceback.format_exc()}), 500
@@ -437,39 +1293,10 @@ def calculate_subtract():
 @app.route('/math/multiply', methods=['POST'])
 def calculate_multiply():
     try:
-        data = request.json.get('data', [])
-        column1 = request.json.get('column1')
-        column2 = request.json.get('column2')
-        result_column = request.json.get('result_column', f'{column1}_times_{column2}')
-        
-        df = pd.DataFrame(data)
-        
-        if column1 not in df.columns or column2 not in df.columns:
-            return jsonify({'error': 'One or both columns not found'}), 400
-        
-        # Convert to numeric
-        col1 = pd.to_numeric(df[column1], errors='coerce')
-        col2 = pd.to_numeric(df[column2], errors='coerce')
-        
-        # Perform multiplication
-        df[result_column] = col1 * col2
-        
-        # Convert full dataset and clean NaN values
-        full_data = df.to_dict('records')
-        for record in full_data:
-            for key, value in record.items():
-                if pd.isna(value):
-                    record[key] = None
-                elif isinstance(value, (pd.Timestamp, datetime)):
-                    record[key] = value.strftime('%Y-%m-%d %H:%M:%S')
-        
-        return jsonify({
-            'success': True,
-            'rows': len(df),
-            'columns': list(df.columns),
-            'data': full_data
-        })
-    
+        return column_operation(request_payload(), 'multiply')
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         import traceback
         return jsonify({'error': str(e), 'traceback': traceback.format_exc()}), 500
@@ -477,39 +1304,32 @@ def calculate_multiply():
 @app.route('/math/divide', methods=['POST'])
 def calculate_divide():
     try:
-        data = request.json.get('data', [])
-        column1 = request.json.get('column1')
-        column2 = request.json.get('column2')
-        result_column = request.json.get('result_column', f'{column1}_divided_by_{column2}')
-        
-        df = pd.DataFrame(data)
-        
-        if column1 not in df.columns or column2 not in df.columns:
-            return jsonify({'error': 'One or both columns not found'}), 400
-        
-        # Convert to numeric
-        col1 = pd.to_numeric(df[column1], errors='coerce')
-        col2 = pd.to_numeric(df[column2], errors='coerce')
-        
-        # Perform division (handle division by zero)
-        df[result_column] = col1.div(col2.replace(0, pd.NA))
-        
-        # Convert full dataset and clean NaN values
-        full_data = df.to_dict('records')
-        for record in full_data:
-            for key, value in record.items():
-                if pd.isna(value):
-                    record[key] = None
-                elif isinstance(value, (pd.Timestamp, datetime)):
-                    record[key] = value.strftime('%Y-%m-%d %H:%M:%S')
-        
-        return jsonify({
-            'success': True,
-            'rows': len(df),
-            'columns': list(df.columns),
-            'data': full_data
-        })
-    
+        return column_operation(request_payload(), 'divide')
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+    except Exception as e:
+        import traceback
+        return jsonify({'error': str(e), 'traceback': traceback.format_exc()}), 500
+
+@app.route('/math/expression', methods=['POST'])
+def calculate_expression():
+    """
+    Add columns computed from arithmetic and conditional expressions over the dataset's columns, in one pass
+    (see expressions.py for the grammar). Expects JSON body:
+    { "dataset_id": "...", "expressions": {"margin": "(revenue - cost) / revenue", "loss": "margin < 0"} }
+    or { ..., "expression": "revenue * 0.9", "result_column": "discounted" }
+    """
+    try:
+        payload = request_payload()
+        expressions = payload.get('expressions')
+        if expressions is None and payload.get('expression') is not None:
+            expressions = {payload.get('result_column') or payload['expression']: payload['expression']}
+        parse_expressions(expressions)
+        return apply_step(payload, 'expression', {'expressions': expressions})
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         import traceback
         return jsonify({'error': str(e), 'traceback': traceback.format_exc()}), 500
@@ -517,207 +1337,310 @@ def calculate_divide():
 @app.route('/advanced/pl/gross-profit', methods=['POST'])
 def calculate_gross_profit():
     try:
-        data = request.json.get('data', [])
-        revenue_col = request.json.get('revenue_column')
-        cost_col = request.json.get('cost_column')
-        
-        df = pd.DataFrame(data)
-        
+        payload = request_payload()
+        revenue_col = payload.get('revenue_column')
+        cost_col = payload.get('cost_column')
+        row_filter = parse_filter(payload.get('filter'))
+
+        if payload.get('dataset_id') and row_filter is None:
+            # Answered from the dataset's maintained totals
+            with phase('compute'):
+                aggregate, _ = pl_aggregate(store.get(payload['dataset_id']), revenue_col, cost_col)
+            return jsonify({'success': True, **aggregate.totals})
+
+        df, rows = filtered_frame(payload, row_filter)
+
         if revenue_col not in df.columns or cost_col not in df.columns:
             return jsonify({'error': 'Required columns not found'}), 400
-        
-        # Convert to numeric
-        revenue = pd.to_numeric(df[revenue_col], errors='coerce')
-        cost = pd.to_numeric(df[cost_col], errors='coerce')
-        
-        # Calculate gross profit
-        gross_profit = revenue - cost
-        total_gross_profit = gross_profit.sum()
-        
-        return jsonify({
-            'success': True,
-            'total_revenue': float(revenue.sum()),
-            'total_cost': float(cost.sum()),
-            'total_gross_profit': float(total_gross_profit)
-        })
-    
+
+        with phase('compute'):
+            # Convert to numeric
+            revenue = to_numeric(filtered_column(df, revenue_col, rows))
+            cost = to_numeric(filtered_column(df, cost_col, rows))
+
+            # Calculate gross profit
+            gross_profit = revenue - cost
+            totals = {
+                'total_revenue': float(revenue.sum()),
+                'total_cost': float(cost.sum()),
+                'total_gross_profit': float(gross_profit.sum())
+            }
+
+        return jsonify({'success': True, **totals})
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/advanced/pl/net-profit', methods=['POST'])
 def calculate_net_profit():
     try:
-        data = request.json.get('data', [])
-        revenue_col = request.json.get('revenue_column')
-        cost_col = request.json.get('cost_column')
-        tax_col = request.json.get('tax_column')
-        
-        df = pd.DataFrame(data)
-        
+        payload = request_payload()
+        revenue_col = payload.get('revenue_column')
+        cost_col = payload.get('cost_column')
+        tax_col = payload.get('tax_column')
+        row_filter = parse_filter(payload.get('filter'))
+
+        if payload.get('dataset_id') and row_filter is None:
+            # Answered from the dataset's maintained totals
+            if tax_col is None:
+                return jsonify({'error': 'Required columns not found'}), 400
+            with phase('compute'):
+                aggregate, _ = pl_aggregate(store.get(payload['dataset_id']), revenue_col, cost_col, tax_col)
+            totals = aggregate.totals
+            return jsonify({'success': True, **{key: totals[key] for key in (
+                'total_revenue', 'total_cost', 'total_tax', 'total_gross_profit', 'total_net_profit')}})
+
+        df, rows = filtered_frame(payload, row_filter)
+
         if revenue_col not in df.columns or cost_col not in df.columns or tax_col not in df.columns:
             return jsonify({'error': 'Required columns not found'}), 400
-        
-        # Convert to numeric
-        revenue = pd.to_numeric(df[revenue_col], errors='coerce')
-        cost = pd.to_numeric(df[cost_col], errors='coerce')
-        tax = pd.to_numeric(df[tax_col], errors='coerce')
-        
-        # Calculate gross profit and net profit
-        gross_profit = revenue - cost
-        net_profit = gross_profit - tax
-        
-        return jsonify({
-            'success': True,
-            'total_revenue': float(revenue.sum()),
-            'total_cost': float(cost.sum()),
-            'total_tax': float(tax.sum()),
-            'total_gross_profit': float(gross_profit.sum()),
-            'total_net_profit': float(net_profit.sum())
-        })
-    
+
+        with phase('compute'):
+            # Convert to numeric
+            revenue = to_numeric(filtered_column(df, revenue_col, rows))
+            cost = to_numeric(filtered_column(df, cost_col, rows))
+            tax = to_numeric(filtered_column(df, tax_col, rows))
+
+            # Calculate gross profit and net profit
+            gross_profit = revenue - cost
+            net_profit = gross_profit - tax
+            totals = {
+                'total_revenue': float(revenue.sum()),
+                'total_cost': float(cost.sum()),
+                'total_tax': float(tax.sum()),
+                'total_gross_profit': float(gross_profit.sum()),
+                'total_net_profit': float(net_profit.sum())
+            }
+
+        return jsonify({'success': True, **totals})
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def period_pl(periods, result_key=None):
+    """
+    Revenue, cost and profit per period for each granularity in ``periods``,
+    computed here or, with "async": true, in a background job reporting the
+    totals of the rows read so far as its partial result. A stored
+    dataset's report is rolled up from its maintained daily totals (see
+    financials.py); with a "filter" only the matching rows are aggregated,
+    reusing the dataset's cached parsed date column.
+    """
+    payload = request_payload()
+    revenue_col = payload.get('revenue_column')
+    cost_col = payload.get('cost_column')
+    date_col = payload.get('date_column')
+    fiscal_year_start = parse_fiscal_year_start(payload.get('fiscal_year_start'))
+    row_filter = parse_filter(payload.get('filter'))
+
+    if wants_async(payload):
+        frame = job_frame(payload)
+        columns = open_persisted_frame(frame).columns if isinstance(frame, str) else frame.columns
+        check_columns(columns, date_col, revenue_col, cost_col)
+        for column in filter_columns(row_filter):
+            if column not in columns:
+                raise ApiError(f'Column {column} not found')
+        job = jobs.submit(f"pl/{'+'.join(periods)}", tasks.period_pl_job, frame, date_col, revenue_col, cost_col,
+                          periods, fiscal_year_start, result_key, row_filter)
+        return job_accepted(job)
+
+    if payload.get('dataset_id') and row_filter is None:
+        # Rolled up from the dataset's maintained daily totals
+        if date_col is None:
+            raise ApiError('Required columns not found')
+        with phase('compute'):
+            aggregate, _ = pl_aggregate(store.get(payload['dataset_id']), revenue_col, cost_col, date_col=date_col)
+            totals = aggregate.period_totals(periods, fiscal_year_start)
+        return jsonify({'success': True, **pl_report(totals, fiscal_year_start, result_key)})
+
+    epoch = None
+    if payload.get('dataset_id'):
+        entry = store.get(payload['dataset_id'])
+        with entry.lock:
+            indexes = dataset_indexes(entry)
+            df = indexes.df
+            check_columns(df.columns, date_col, revenue_col, cost_col)
+            with phase('parse_dates'):
+                epoch, _ = date_index(entry, date_col)
+    else:
+        df = load_frame(payload)
+        indexes = FrameIndexes(df)
+        check_columns(df.columns, date_col, revenue_col, cost_col)
+
+    count_rows(len(df))
+    rows = None
+    if row_filter is not None:
+        with phase('filter'):
+            rows = select_rows(indexes, row_filter)
+    with phase('compute'):
+        totals = period_totals(df, date_col, revenue_col, cost_col, periods, fiscal_year_start, epoch, rows)
+    return jsonify({'success': True, **pl_report(totals, fiscal_year_start, result_key)})
+
+@app.route('/advanced/pl/periods', methods=['POST'])
+def calculate_period_pl():
+    """
+    P&L for several granularities in one call.
+    Expects JSON body: { "dataset_id": "...", "date_column", "revenue_column", "cost_column",
+    "granularities": ["day", "week", "month", "quarter", "year"] (default ["month"]),
+    "fiscal_year_start": 1-12 (default 1, calendar years) }
+    """
+    try:
+        return period_pl(parse_granularities(request_payload().get('granularities')))
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/advanced/pl/monthly', methods=['POST'])
 def calculate_monthly_pl():
     try:
-        data = request.json.get('data', [])
-        revenue_col = request.json.get('revenue_column')
-        cost_col = request.json.get('cost_column')
-        date_col = request.json.get('date_column')
-        
-        df = pd.DataFrame(data)
-        
-        if revenue_col not in df.columns or cost_col not in df.columns or date_col not in df.columns:
-            return jsonify({'error': 'Required columns not found'}), 400
-        
-        # Convert date column
-        df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
-        
-        # Convert to numeric
-        df[revenue_col] = pd.to_numeric(df[revenue_col], errors='coerce')
-        df[cost_col] = pd.to_numeric(df[cost_col], errors='coerce')
-        
-        # Remove rows with invalid dates
-        df = df.dropna(subset=[date_col])
-        
-        # Extract month-year
-        df['month'] = df[date_col].dt.to_period('M').astype(str)
-        
-        # Group by month
-        monthly = df.groupby('month').agg({
-            revenue_col: 'sum',
-            cost_col: 'sum'
-        }).reset_index()
-        
-        monthly['profit'] = monthly[revenue_col] - monthly[cost_col]
-        
-        monthly_data = []
-        for _, row in monthly.iterrows():
-            monthly_data.append({
-                'month': row['month'],
-                'revenue': float(row[revenue_col]),
-                'cost': float(row[cost_col]),
-                'profit': float(row['profit'])
-            })
-        
-        return jsonify({
-            'success': True,
-            'monthly_data': monthly_data
-        })
-    
+        return period_pl(['month'], PERIOD_RESULT_KEYS['month'])
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/advanced/pl/quarterly', methods=['POST'])
 def calculate_quarterly_pl():
     try:
-        data = request.json.get('data', [])
-        revenue_col = request.json.get('revenue_column')
-        cost_col = request.json.get('cost_column')
-        date_col = request.json.get('date_column')
-        
-        df = pd.DataFrame(data)
-        
-        if revenue_col not in df.columns or cost_col not in df.columns or date_col not in df.columns:
-            return jsonify({'error': 'Required columns not found'}), 400
-        
-        # Convert date column
-        df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
-        
-        # Convert to numeric
-        df[revenue_col] = pd.to_numeric(df[revenue_col], errors='coerce')
-        df[cost_col] = pd.to_numeric(df[cost_col], errors='coerce')
-        
-        # Remove rows with invalid dates
-        df = df.dropna(subset=[date_col])
-        
-        # Extract quarter
-        df['quarter'] = df[date_col].dt.quarter
-        df['year'] = df[date_col].dt.year
-        df['quarter_label'] = df['year'].astype(str) + '-Q' + df['quarter'].astype(str)
-        
-        # Group by quarter
-        quarterly = df.groupby('quarter_label').agg({
-            revenue_col: 'sum',
-            cost_col: 'sum'
-        }).reset_index()
-        
-        quarterly['profit'] = quarterly[revenue_col] - quarterly[cost_col]
-        
-        quarterly_data = []
-        for _, row in quarterly.iterrows():
-            quarterly_data.append({
-                'quarter': row['quarter_label'],
-                'revenue': float(row[revenue_col]),
-                'cost': float(row[cost_col]),
-                'profit': float(row['profit'])
-            })
-        
-        # Sort by quarter
-        quarterly_data.sort(key=lambda x: x['quarter'])
-        
-        return jsonify({
-            'success': True,
-            'quarterly_data': quarterly_data
-        })
-    
+        return period_pl(['quarter'], PERIOD_RESULT_KEYS['quarter'])
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/download/transformed', methods=['POST'])
-def download_transformed():
+def export_response(df, file_format, name='transformed_dataset'):
+    """Stream ``df`` as a file download in chunks (see export.py)."""
+    mimetype, export = exporter(file_format)
+    return Response(
+        stream_with_context(export(df)),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{name}.{file_format}"'}
+    )
+
+def submit_export_job(frame, file_format, name='transformed_dataset'):
+    """Write an export file in a background job, downloadable from /jobs/<job_id>/download."""
+    mimetype, _ = exporter(file_format)
+    export_dir = os.path.join(DATA_DIR, 'exports')
+    os.makedirs(export_dir, exist_ok=True)
+    output_path = os.path.join(export_dir, f'{uuid.uuid4().hex}.{file_format}')
+
+    def on_done(job, result):
+        job.download = (output_path, f'{name}.{file_format}', mimetype)
+        return {**result, 'download_url': f'/jobs/{job.job_id}/download'}
+
+    def cleanup():
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+    return jobs.submit('export', tasks.export_job, frame, file_format, output_path,
+                       on_done=on_done, cleanup=cleanup)
+
+@app.route('/datasets/<dataset_id>/export', methods=['GET'])
+def export_dataset(dataset_id):
     """
-    Download the transformed dataset as an Excel file.
-    Expects JSON body: { "data": [...] }
+    Stream a stored dataset as a file: ?format=xlsx|csv|parquet (default xlsx), ?view=original.
+    With ?async=1 the file is written by a background job instead.
     """
     try:
-        data = request.json.get('data', [])
-        if not data:
-            return jsonify({'error': 'No data provided'}), 400
+        file_format = request.args.get('format', 'xlsx')
+        original = request.args.get('view') == 'original'
+        if wants_async():
+            entry = store.get(dataset_id)
+            node = entry.versions[0] if original else entry.node
+            frame = (store.persistence.frame_path(dataset_id, node.file)
+                     if store.persistence is not None and node.file is not None
+                     else entry.frame(original))
+            return job_accepted(submit_export_job(frame, file_format))
 
-        df = pd.DataFrame(data)
+        df = store.get_frame(dataset_id, original=original)
+        return export_response(df, file_format)
 
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, index=False, sheet_name='TransformedData')
-        output.seek(0)
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-        return send_file(
-            output,
-            as_attachment=True,
-            download_name='transformed_dataset.xlsx',
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
+@app.route('/download/transformed', methods=['POST'])
+def download_transformed():
+    """
+    Download the transformed dataset, streamed as it is written.
+    Expects JSON body: { "dataset_id": "...", "format": "xlsx" | "csv" | "parquet" }
+    (or the legacy { "data": [...] }); "async": true writes it in a background job
+    """
+    try:
+        payload = request_payload()
+        file_format = payload.get('format', 'xlsx')
+        if wants_async(payload):
+            return job_accepted(submit_export_job(job_frame(payload), file_format))
+        return export_response(load_frame(payload), file_format)
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
     except Exception as e:
         import traceback
         return jsonify({'error': str(e), 'traceback': traceback.format_exc()}), 500
 
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify({'success': True, 'jobs': jobs.list()})
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Status, progress and partial result of a background job; its result once it has succeeded."""
+    try:
+        return jsonify({'success': True, **jobs.get(job_id).describe()})
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    try:
+        return jsonify({'success': True, **jobs.cancel(job_id).describe()})
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/jobs/<job_id>/download', methods=['GET'])
+def download_job_result(job_id):
+    """The file written by a finished export job."""
+    try:
+        job = jobs.get(job_id)
+        if job.download is None:
+            raise ApiError(f'Job {job_id} has no file to download', 404)
+        path, filename, mimetype = job.download
+        return send_file(path, mimetype=mimetype, as_attachment=True, download_name=filename)
+
+    except ApiError as e:
+        return jsonify({'error': e.message}), e.status_code
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Request latencies, phase timings, payload sizes, rows processed and store memory, for Prometheus."""
+    return Response(registry.render(), mimetype=PROMETHEUS_MIMETYPE)
+
 @app.route('/health', methods=['GET'])
 def health_check():
     return jsonify({'status': 'healthy'}), 200
 
 if __name__ == '__main__':
+    # Development server; in production run several workers with
+    # gunicorn -c gunicorn.conf.py app:app
     app.run(debug=True, port=5000)
 
@@ -0,0 +1,65 @@
+"""
+Daily appends to a stored ledger: the cost of each append (new version plus
+bringing the P&L aggregate up to date from the new rows), and a monthly
+P&L after it answered from the maintained aggregate against recomputing it
+over every row, with a check that both agree.
+
+    python benchmarks/bench_append.py --rows 1000000 --batch-rows 5000 --batches 5
+"""
+import argparse
+import time
+
+import numpy as np
+
+from ledger import make_ledger
+
+from column_store import concat_frames
+from dataset_store import DatasetStore
+from dtypes import conform_frame, optimize_frame
+from financials import APPEND_OPERATION, period_totals, pl_aggregate, refresh_pl_aggregates
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--batch-rows', type=int, default=5_000)
+    parser.add_argument('--batches', type=int, default=5)
+    args = parser.parse_args()
+
+    ledger = optimize_frame(make_ledger(args.rows + args.batch_rows * args.batches))
+    store = DatasetStore()
+    entry = store.create(ledger[:args.rows].reset_index(drop=True), name='ledger')
+    start = time.perf_counter()
+    pl_aggregate(entry, 'revenue', 'cost', date_col='date')
+    print(f'{args.rows:,} rows; aggregate built in {(time.perf_counter() - start) * 1000:.0f} ms')
+    print(f'{"batch":>5}{"rows":>12}{"append ms":>11}{"aggregate ms":>14}{"P&L ms":>9}{"full P&L ms":>13}  result')
+
+    for batch in range(args.batches):
+        offset = args.rows + batch * args.batch_rows
+        rows = ledger[offset:offset + args.batch_rows].reset_index(drop=True)
+
+        start = time.perf_counter()
+        store.transform(entry.dataset_id, lambda df: concat_frames([df, conform_frame(rows, df)]),
+                        operation=APPEND_OPERATION)
+        append_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        refresh_pl_aggregates(entry)
+        refresh_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        aggregate, cached = pl_aggregate(entry, 'revenue', 'cost', date_col='date')
+        maintained = aggregate.period_totals(['month'])['month']
+        pl_ms = (time.perf_counter() - start) * 1000
+
+        df = entry.current
+        start = time.perf_counter()
+        full = period_totals(df, 'date', 'revenue', 'cost', ['month'])['month']
+        full_ms = (time.perf_counter() - start) * 1000
+
+        equal = cached and np.allclose(maintained.to_numpy(), full.to_numpy(), rtol=1e-12)
+        print(f'{batch + 1:>5}{len(df):>12,}{append_ms:>11.1f}{refresh_ms:>14.2f}{pl_ms:>9.2f}{full_ms:>13.1f}'
+              f"  {'equal' if equal else 'DIFFERENT'}")
+
+
+if __name__ == '__main__':
+    main()
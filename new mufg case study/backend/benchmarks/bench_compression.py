@@ -0,0 +1,108 @@
+"""
+Bytes on the wire and compression CPU cost per route, for identity, gzip and
+(with the zstandard package installed) zstd responses, plus a gzip-compressed
+inline-data request body.
+
+    python benchmarks/bench_compression.py --rows 100000
+"""
+import argparse
+import gzip
+import io
+import json
+import os
+import tempfile
+import time
+
+from ledger import make_ledger
+
+# The app reads its settings on import: keep benchmark datasets out of backend/data
+os.environ.setdefault('DATA_DIR', tempfile.mkdtemp(prefix='bench-compression-'))
+
+from app import app  # noqa: E402
+from compression import available_encodings, compress, decompress  # noqa: E402
+
+
+def cpu_ms(func, repeat=3):
+    """Best-of-``repeat`` CPU time of ``func()`` in milliseconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.process_time()
+        func()
+        timings.append((time.process_time() - start) * 1000)
+    return min(timings)
+
+
+def fetch(client, method, path, encoding, **kwargs):
+    start = time.perf_counter()
+    response = client.open(path, method=method, headers={'Accept-Encoding': encoding}, **kwargs)
+    body = response.get_data()
+    elapsed = (time.perf_counter() - start) * 1000
+    if response.status_code >= 400:
+        raise RuntimeError(f'{method} {path}: HTTP {response.status_code} {body[:300]!r}')
+    return body, response.headers.get('Content-Encoding'), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--inline-rows', type=int, default=20_000,
+                        help='rows posted inline as "data" (the legacy request format)')
+    args = parser.parse_args()
+
+    df = make_ledger(args.rows)
+    csv = df.to_csv(index=False).encode()
+    client = app.test_client()
+    upload = client.post('/upload', data={'file': (io.BytesIO(csv), 'ledger.csv')},
+                         content_type='multipart/form-data', headers={'Accept-Encoding': 'identity'})
+    dataset_id = upload.get_json()['dataset_id']
+    ds = {'dataset_id': dataset_id}
+    inline = {'data': json.loads(make_ledger(args.inline_rows).to_json(orient='records', date_format='iso')),
+              'column1': 'revenue', 'column2': 'cost'}
+
+    routes = [
+        ('POST /upload', 'POST', '/upload',
+         lambda: {'data': {'file': (io.BytesIO(csv), 'ledger.csv')}, 'content_type': 'multipart/form-data'}),
+        ('GET /datasets/<id>/rows?limit=1000', 'GET', f'/datasets/{dataset_id}/rows',
+         lambda: {'query_string': {'limit': 1000}}),
+        ('POST /stats', 'POST', '/stats', lambda: {'json': ds}),
+        ('POST /advanced/pl/periods [day]', 'POST', '/advanced/pl/periods',
+         lambda: {'json': {**ds, 'date_column': 'date', 'revenue_column': 'revenue', 'cost_column': 'cost',
+                           'granularities': ['day']}}),
+        ('POST /math/add [inline data]', 'POST', '/math/add', lambda: {'json': inline}),
+        ('POST /download/transformed [csv]', 'POST', '/download/transformed',
+         lambda: {'json': {**ds, 'format': 'csv'}}),
+    ]
+
+    encodings = available_encodings()
+    print(f'{args.rows:,} rows stored, {args.inline_rows:,} rows posted inline; encodings: {", ".join(encodings)}')
+    header = f'{"route":<38}{"identity B":>13}{"ms":>9}'
+    for encoding in encodings:
+        header += f'{encoding + " B":>13}{"ratio":>7}{"cpu ms":>9}'
+    print(header)
+
+    for name, method, path, make_kwargs in routes:
+        raw, _, raw_ms = fetch(client, method, path, 'identity', **make_kwargs())
+        line = f'{name:<38}{len(raw):>13,}{raw_ms:>9.1f}'
+        for encoding in encodings:
+            body, applied, _ = fetch(client, method, path, encoding, **make_kwargs())
+            if applied != encoding:
+                # Below the size threshold or not a compressible type
+                line += f'{len(body):>13,}{"-":>7}{"-":>9}'
+                continue
+            cost = cpu_ms(lambda: compress(raw, encoding))
+            line += f'{len(body):>13,}{len(raw) / len(body):>6.1f}x{cost:>9.1f}'
+        print(line)
+
+    # Request side: the legacy inline-data body, gzip-compressed by the client
+    body = json.dumps(inline).encode()
+    compressed = gzip.compress(body)
+    inflate_ms = cpu_ms(lambda: decompress(compressed, 'gzip', len(body)))
+    print(f'\nrequest body ({args.inline_rows:,} inline rows): {len(body):,} B, gzip {len(compressed):,} B '
+          f'({len(body) / len(compressed):.1f}x), server decompression {inflate_ms:.1f} ms CPU')
+    response = client.post('/math/add', data=compressed, headers={
+        'Content-Type': 'application/json', 'Content-Encoding': 'gzip', 'Accept-Encoding': 'identity'})
+    assert response.status_code == 200, response.get_data()[:300]
+
+
+if __name__ == '__main__':
+    main()
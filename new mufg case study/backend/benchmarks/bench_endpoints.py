@@ -0,0 +1,240 @@
+"""
+Drive every endpoint through Flask's test client at several dataset sizes and
+record latency percentiles, response bytes and peak RSS per route; compare
+against a stored baseline and exit non-zero when a route regresses.
+
+    python benchmarks/bench_endpoints.py --rows 10000 100000 1000000
+    python benchmarks/bench_endpoints.py --rows 100000 --save-baseline
+    python benchmarks/bench_endpoints.py --rows 100000 --threshold 0.25
+
+Each route is called ``--repeat`` times against one uploaded ledger; the
+first call is reported separately (``first ms``) because later ones may hit
+the server's caches, as repeated client requests would. Transformations are
+undone (untimed) after every call so each one runs on the same data.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from ledger import BACKEND_DIR, RssSampler, make_ledger
+
+# The app reads its settings on import: keep benchmark datasets out of backend/data
+os.environ.setdefault('DATA_DIR', tempfile.mkdtemp(prefix='bench-endpoints-'))
+
+from app import app  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(BACKEND_DIR, 'benchmarks', 'baseline_endpoints.json')
+
+# Latency and RSS growth below these are noise, whatever the relative change
+MIN_LATENCY_DELTA_MS = 5.0
+MIN_RSS_DELTA_MB = 20.0
+
+
+def xlsx_bytes(df):
+    output = io.BytesIO()
+    df.to_excel(output, index=False)
+    return output.getvalue()
+
+
+def route_cases(dataset_id, csv, xlsx):
+    """
+    ``(route, path, make request kwargs, kind)`` for every benchmarked call;
+    ``kind`` is 'upload' (the created dataset is deleted after each call),
+    'transform' (undone after each call) or 'read'.
+    """
+    ds = {'dataset_id': dataset_id}
+    pl = {**ds, 'revenue_column': 'revenue', 'cost_column': 'cost', 'tax_column': 'tax', 'date_column': 'date'}
+    columns = {**ds, 'column1': 'revenue', 'column2': 'cost'}
+
+    def upload(data, filename):
+        return lambda: {'data': {'file': (io.BytesIO(data), filename)}, 'content_type': 'multipart/form-data'}
+
+    cases = [('POST /upload [csv]', '/upload', upload(csv, 'ledger.csv'), 'upload'),
+             ('POST /upload/stream [csv]', '/upload/stream', upload(csv, 'ledger.csv'), 'upload')]
+    if xlsx is not None:
+        cases.append(('POST /upload [xlsx]', '/upload', upload(xlsx, 'ledger.xlsx'), 'upload'))
+
+    cases += [
+        ('POST /clean/remove-null', '/clean/remove-null', lambda: {'json': ds}, 'transform'),
+        ('POST /clean/remove-duplicate', '/clean/remove-duplicate', lambda: {'json': ds}, 'transform'),
+        ('POST /clean/rename-columns', '/clean/rename-columns',
+         lambda: {'json': {**ds, 'rename_map': {'memo': 'description'}}}, 'transform'),
+        ('POST /clean/change-datatypes', '/clean/change-datatypes',
+         lambda: {'json': {**ds, 'dtype_map': {'account': 'string', 'cost': 'float', 'date': 'date'}}}, 'transform'),
+        ('POST /clean/trim-whitespaces', '/clean/trim-whitespaces', lambda: {'json': ds}, 'transform'),
+        ('GET /datasets/<id>/rows', f'/datasets/{dataset_id}/rows',
+         lambda: {'method': 'GET', 'query_string': {'sort': '-revenue', 'limit': 100}}, 'read'),
+        ('POST /stats', '/stats', lambda: {'json': ds}, 'read'),
+    ]
+    cases += [(f'POST /math/{op}', f'/math/{op}', lambda: {'json': {**ds, 'column': 'revenue'}}, 'read')
+              for op in ('sum', 'average', 'min', 'max', 'count')]
+    cases += [(f'POST /math/{op}', f'/math/{op}', lambda: {'json': columns}, 'transform')
+              for op in ('add', 'subtract', 'multiply', 'divide')]
+    cases += [(f'POST /advanced/pl/{op}', f'/advanced/pl/{op}', lambda: {'json': pl}, 'read')
+              for op in ('gross-profit', 'net-profit', 'monthly', 'quarterly')]
+    cases.append(('POST /advanced/pl/periods', '/advanced/pl/periods',
+                  lambda: {'json': {**pl, 'granularities': ['day', 'week', 'month', 'quarter', 'year']}}, 'read'))
+
+    formats = ('csv', 'parquet') if xlsx is None else ('csv', 'parquet', 'xlsx')
+    cases += [(f'POST /download/transformed [{fmt}]', '/download/transformed',
+               lambda fmt=fmt: {'json': {**ds, 'format': fmt}}, 'read')
+              for fmt in formats]
+    return cases
+
+
+def call(client, path, kwargs):
+    kwargs.setdefault('method', 'POST')
+    response = client.open(path, **kwargs)
+    # Streamed responses are produced as they are read
+    body = response.get_data()
+    if response.status_code >= 400:
+        raise RuntimeError(f'{kwargs["method"]} {path}: HTTP {response.status_code} {body[:300]!r}')
+    return response, body
+
+
+def created_dataset_id(response, body):
+    if response.mimetype == 'application/x-ndjson':
+        event = json.loads(body.splitlines()[-1])
+        if event['event'] != 'complete':
+            raise RuntimeError(f"/upload/stream: {event.get('error')}")
+        return event['dataset_id']
+    return json.loads(body)['dataset_id']
+
+
+def run_route(client, path, make_kwargs, kind, dataset_id, repeat):
+    latencies = []
+    size = 0
+    with RssSampler() as rss:
+        for _ in range(repeat):
+            kwargs = make_kwargs()
+            start = time.perf_counter()
+            response, body = call(client, path, kwargs)
+            latencies.append((time.perf_counter() - start) * 1000)
+            size = len(body)
+
+            if kind == 'upload':
+                client.delete(f'/datasets/{created_dataset_id(response, body)}')
+            elif kind == 'transform':
+                client.post(f'/datasets/{dataset_id}/undo')
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {
+        'first_ms': round(latencies[0], 2),
+        'p50_ms': round(float(p50), 2),
+        'p95_ms': round(float(p95), 2),
+        'p99_ms': round(float(p99), 2),
+        'bytes': size,
+        'peak_rss_mb': round(rss.peak / 1e6, 1),
+        'rss_growth_mb': round((rss.peak - rss.start) / 1e6, 1),
+    }
+
+
+def run_size(client, rows, repeat, xlsx_max_rows):
+    df = make_ledger(rows)
+    csv = df.to_csv(index=False).encode()
+    xlsx = xlsx_bytes(df) if rows <= xlsx_max_rows else None
+
+    _, body = call(client, '/upload', {
+        'data': {'file': (io.BytesIO(csv), 'ledger.csv')}, 'content_type': 'multipart/form-data'
+    })
+    dataset_id = json.loads(body)['dataset_id']
+
+    results = {}
+    try:
+        for route, path, make_kwargs, kind in route_cases(dataset_id, csv, xlsx):
+            results[route] = result = run_route(client, path, make_kwargs, kind, dataset_id, repeat)
+            print(f'{route:<38}{result["first_ms"]:>10.1f}{result["p50_ms"]:>10.1f}{result["p95_ms"]:>10.1f}'
+                  f'{result["p99_ms"]:>10.1f}{result["bytes"]:>13,}{result["peak_rss_mb"]:>10.1f}'
+                  f'{result["rss_growth_mb"]:>9.1f}', flush=True)
+    finally:
+        client.delete(f'/datasets/{dataset_id}')
+    if xlsx is None:
+        print(f'(xlsx routes skipped above --xlsx-max-rows {xlsx_max_rows:,})')
+    return results
+
+
+def regressions(results, baseline, threshold):
+    """Messages for routes slower, bigger or hungrier than the baseline by more than ``threshold``."""
+    found = []
+    for rows, routes in results.items():
+        for route, result in routes.items():
+            base = baseline.get(rows, {}).get(route)
+            if base is None:
+                continue
+            checks = [
+                ('p50 latency', result['p50_ms'], base['p50_ms'], MIN_LATENCY_DELTA_MS, 'ms'),
+                ('response size', result['bytes'], base['bytes'], 0, 'bytes'),
+                ('RSS growth', result['rss_growth_mb'], base['rss_growth_mb'], MIN_RSS_DELTA_MB, 'MB'),
+            ]
+            for label, value, reference, min_delta, unit in checks:
+                if value > reference * (1 + threshold) and value - reference > min_delta:
+                    found.append(f'{int(rows):,} rows {route}: {label} {value:,} {unit} vs baseline {reference:,} {unit}')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--xlsx-max-rows', type=int, default=100_000,
+                        help='skip XLSX upload/download above this many rows (openpyxl takes minutes at 1M)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='write the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed relative regression (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    client = app.test_client()
+    results = {}
+    try:
+        for rows in args.rows:
+            print(f'\n{rows:,} rows, {args.repeat} calls per route')
+            print(f'{"route":<38}{"first ms":>10}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}'
+                  f'{"bytes":>13}{"peak MB":>10}{"+RSS MB":>9}')
+            results[str(rows)] = run_size(client, rows, args.repeat, args.xlsx_max_rows)
+    finally:
+        shutil.rmtree(os.environ['DATA_DIR'], ignore_errors=True)
+
+    if args.save_baseline:
+        baseline = {'results': {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        # Sizes not run this time keep their previous baseline
+        baseline['results'].update(results)
+        baseline['environment'] = {
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+        }
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f'\nbaseline written to {args.baseline}')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f'\nno baseline at {args.baseline}; run with --save-baseline to record one')
+        return 0
+
+    with open(args.baseline) as f:
+        found = regressions(results, json.load(f)['results'], args.threshold)
+    if found:
+        print(f'\n{len(found)} regression(s) beyond {args.threshold:.0%}:')
+        for message in found:
+            print(f'  {message}')
+        return 1
+    print(f'\nno regressions beyond {args.threshold:.0%} of the baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
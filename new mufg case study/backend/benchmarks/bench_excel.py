@@ -0,0 +1,76 @@
+"""
+Batch Excel ingest: parsing every sheet of a multi-sheet ledger workbook
+with pd.read_excel's default engine (openpyxl) and with calamine, in this
+process and across a pool of worker processes, and a check that every
+engine gives the frames pd.read_excel does.
+
+    python benchmarks/bench_excel.py --rows 50000 --sheets 12 --workers 0 4
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import pandas as pd
+
+from ledger import make_ledger
+
+from workbooks import WorkbookReader, python_calamine
+
+
+def write_workbook(path, rows, sheets):
+    ledger = make_ledger(rows * sheets)
+    with pd.ExcelWriter(path) as writer:
+        for index in range(sheets):
+            ledger[index * rows:(index + 1) * rows].to_excel(writer, sheet_name=f'P{index + 1:02d}', index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=50_000, help='rows per sheet')
+    parser.add_argument('--sheets', type=int, default=12)
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 4])
+    args = parser.parse_args()
+
+    engines = ['pandas'] + (['calamine'] if python_calamine is not None else [])
+    if len(engines) == 1:
+        print('python-calamine is not installed; timing pd.read_excel only')
+
+    tmp = tempfile.mkdtemp(prefix='bench-excel-')
+    try:
+        path = os.path.join(tmp, 'ledger.xlsx')
+        write_workbook(path, args.rows, args.sheets)
+        print(f'{args.sheets} sheets of {args.rows:,} rows, {os.path.getsize(path) / 1024 ** 2:.1f} MB')
+        print(f'{"engine":<10}{"workers":>8}{"seconds":>9}{"rows/s":>12}  frames')
+
+        expected = None
+        for engine in engines:
+            for workers in args.workers:
+                reader = WorkbookReader(workers, engine)
+                sources = reader.sources([(path, 'ledger.xlsx')], 'all')
+                if workers:
+                    # Start the pool's processes outside the timing
+                    reader.read(sources[:workers])
+                start = time.perf_counter()
+                frames = [df for _, _, df, _ in reader.read(sources)]
+                elapsed = time.perf_counter() - start
+
+                status = 'equal'
+                if expected is None:
+                    expected = frames
+                else:
+                    for df, reference in zip(frames, expected):
+                        try:
+                            pd.testing.assert_frame_equal(df, reference)
+                        except AssertionError as e:
+                            status = f'DIFFERENT: {str(e).splitlines()[0]}'
+                            break
+                rows = sum(len(df) for df in frames)
+                print(f'{engine:<10}{workers:>8}{elapsed:>9.2f}{rows / elapsed:>12,.0f}  {status}', flush=True)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
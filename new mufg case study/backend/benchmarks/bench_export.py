@@ -0,0 +1,57 @@
+"""
+Compare streamed exports with the in-memory ExcelWriter download they replaced:
+time to first byte, total time and peak Python memory.
+
+    python benchmarks/bench_export.py --rows 100000
+"""
+import argparse
+import io
+import time
+import tracemalloc
+
+import pandas as pd
+
+from ledger import make_ledger  # puts the backend directory on sys.path
+from export import export_csv, export_parquet, export_xlsx
+
+
+def legacy_xlsx(df):
+    """The old /download/transformed: the whole workbook built in a BytesIO."""
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False, sheet_name='TransformedData')
+    yield output.getvalue()
+
+
+def measure(export, df):
+    tracemalloc.start()
+    start = time.perf_counter()
+    first_byte = None
+    size = 0
+    for block in export(df):
+        if first_byte is None and block:
+            first_byte = time.perf_counter() - start
+        size += len(block)
+    total = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return first_byte, total, peak, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100_000)
+    args = parser.parse_args()
+
+    df = make_ledger(args.rows)
+    print(f'{args.rows:,} rows x {len(df.columns)} columns')
+    print(f'{"export":<18}{"first byte ms":>15}{"total ms":>12}{"peak MB":>10}{"bytes":>14}')
+
+    for name, export in [('legacy xlsx', legacy_xlsx), ('streamed xlsx', export_xlsx),
+                         ('streamed csv', export_csv), ('streamed parquet', export_parquet)]:
+        first_byte, total, peak, size = measure(export, df)
+        print(f'{name:<18}{first_byte * 1000:>15.1f}{total * 1000:>12.1f}{peak / 1e6:>10.1f}{size:>14,}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Column expressions: margin = (revenue - cost) / revenue and a conditional
+column computed in one pass by /math/expression's engine, at several chunk
+sizes, against chaining the two-column arithmetic operations (one request
+each) and pandas' DataFrame.eval, with a check that all agree.
+
+    python benchmarks/bench_expression.py --rows 5000000 --chunk-rows 16384 65536 1048576
+"""
+import argparse
+import time
+
+import numpy as np
+
+from ledger import make_ledger
+
+from dtypes import optimize_frame
+from expressions import evaluate_expressions, parse_expressions
+from transforms import column_operation
+
+EXPRESSIONS = {
+    'margin': '(revenue - cost) / revenue',
+    'apac_net': "where(region == 'APAC', revenue - cost - tax, 0)",
+}
+
+
+def best_ms(func, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings), result
+
+
+def chained(df):
+    """The two-column operations, one after another, as three requests would run them."""
+    df = column_operation(df, 'subtract', 'revenue', 'cost', 'gross')
+    df = column_operation(df, 'divide', 'gross', 'revenue', 'margin')
+    return df['margin'].to_numpy(dtype='float64', na_value=np.nan)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=5_000_000)
+    parser.add_argument('--chunk-rows', type=int, nargs='+', default=[16_384, 65_536, 1_048_576])
+    args = parser.parse_args()
+
+    df = optimize_frame(make_ledger(args.rows))
+    df.loc[df.index[::1000], 'revenue'] = 0
+    expressions = parse_expressions(EXPRESSIONS)
+    print(f'{args.rows:,} rows; margin = {EXPRESSIONS["margin"]}, apac_net = {EXPRESSIONS["apac_net"]}')
+    print(f'{"method":<32}{"ms":>9}  result')
+
+    chained_ms, expected = best_ms(lambda: chained(df))
+    print(f'{"chained column operations":<32}{chained_ms:>9.1f}  margin only')
+
+    def pandas_eval():
+        margin = df.eval('(revenue - cost) / revenue').replace([np.inf, -np.inf], np.nan)
+        apac_net = (df['revenue'] - df['cost'] - df['tax']).where(df['region'] == 'APAC', 0)
+        return margin.to_numpy(), apac_net.to_numpy()
+
+    eval_ms, (margin, apac_net) = best_ms(pandas_eval)
+    print(f'{"DataFrame.eval + where":<32}{eval_ms:>9.1f}')
+
+    for chunk_rows in args.chunk_rows:
+        ms, results = best_ms(lambda: evaluate_expressions(df, expressions, chunk_rows))
+        equal = (np.allclose(results['margin'], expected, equal_nan=True)
+                 and np.allclose(results['margin'], margin, equal_nan=True)
+                 and np.allclose(results['apac_net'], apac_net, equal_nan=True))
+        print(f'{f"expression, {chunk_rows:,}-row chunks":<32}{ms:>9.1f}  {"equal" if equal else "DIFFERENT"}')
+
+
+if __name__ == '__main__':
+    main()
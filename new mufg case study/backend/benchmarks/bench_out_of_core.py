@@ -0,0 +1,113 @@
+"""
+Out-of-core vs in-memory execution of cleaning and arithmetic steps on a
+partitioned (streamed-upload) ledger: wall time and peak RSS growth per
+case, and a check that both produce the same frame.
+
+    python benchmarks/bench_out_of_core.py --rows 2000000 --workers 0 2
+"""
+import argparse
+import gc
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from ledger import RssSampler, make_ledger
+
+from ingest import CsvIngest
+from out_of_core import OutOfCoreExecutor
+from persistence import FeatherFrame, open_persisted_frame, write_feather
+from pipeline import execute, parse_steps, plan
+
+CASES = {
+    'remove-null': [{'op': 'remove-null'}],
+    'remove-duplicate': [{'op': 'remove-duplicate'}],
+    'trim-whitespaces': [{'op': 'trim-whitespaces'}],
+    'change-datatypes': [{'op': 'change-datatypes', 'dtype_map': {'posted': 'date', 'account': 'string'}}],
+    # 'units' fails to convert in one part only, so it must stay float64 in all of them
+    'change-datatypes-int': [{'op': 'change-datatypes', 'dtype_map': {'units': 'int', 'account': 'int'}}],
+    'add': [{'op': 'add', 'column1': 'revenue', 'column2': 'cost'}],
+    'pipeline': [{'op': 'remove-null'}, {'op': 'trim-whitespaces'}, {'op': 'remove-duplicate'},
+                 {'op': 'subtract', 'column1': 'revenue', 'column2': 'cost', 'result_column': 'margin'}],
+}
+
+
+def ingest(df, directory, chunk_rows):
+    job = CsvIngest(io.BytesIO(df.to_csv(index=False).encode()), directory, chunk_rows=chunk_rows)
+    for _ in job.run():
+        pass
+    return directory
+
+
+def measure(func):
+    gc.collect()
+    with RssSampler() as rss:
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+    return result, elapsed, (rss.peak - rss.start) / 1024 ** 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--chunk-rows', type=int, default=100_000, help='rows per part of the source dataset')
+    parser.add_argument('--bucket-rows', type=int, default=500_000, help='rows per remove-duplicate hash bucket')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2])
+    args = parser.parse_args()
+
+    df = make_ledger(args.rows)
+    # Some exact duplicates, and day-first date strings to parse
+    df = pd.concat([df, df.sample(args.rows // 10, random_state=1)], ignore_index=True)
+    df['posted'] = df['date'].dt.strftime('%d/%m/%Y')
+    # Whole numbers but one fractional value
+    df['units'] = (df['account'] % 7).astype('float64')
+    df.loc[len(df) // 2, 'units'] = 1.5
+
+    tmp = tempfile.mkdtemp(prefix='bench-out-of-core-')
+    try:
+        source = ingest(df, os.path.join(tmp, 'source.parts'), args.chunk_rows)
+        del df
+        print(f'{args.rows + args.rows // 10:,} rows in parts of {args.chunk_rows:,}')
+        print(f'{"case":<20}{"in-memory s":>12}{"RSS MB":>9}'
+              + ''.join(f'{f"ooc[{w}] s":>12}{"RSS MB":>9}' for w in args.workers) + '  result')
+
+        executors = {workers: OutOfCoreExecutor(workers, args.bucket_rows) for workers in args.workers}
+        different = []
+        for name, steps in CASES.items():
+            planned = plan(parse_steps(steps))
+            expected_path = os.path.join(tmp, f'{name}.feather')
+
+            def in_memory():
+                result, _ = execute(open_persisted_frame(source).read(), planned)
+                write_feather(result, expected_path)
+
+            _, mem_s, mem_mb = measure(in_memory)
+            line = f'{name:<20}{mem_s:>12.2f}{mem_mb:>9.0f}'
+
+            expected = FeatherFrame(expected_path).read()
+            status = 'equal'
+            for workers, executor in executors.items():
+                output = os.path.join(tmp, f'{name}-{workers}.parts')
+                (dataset, _), ooc_s, ooc_mb = measure(lambda: executor.run(source, planned, output))
+                line += f'{ooc_s:>12.2f}{ooc_mb:>9.0f}'
+                try:
+                    pd.testing.assert_frame_equal(dataset.read(), expected)
+                except AssertionError as e:
+                    status = f'DIFFERENT with {workers} workers: {str(e).splitlines()[0]}'
+                    different.append(name)
+                shutil.rmtree(output)
+            print(f'{line}  {status}', flush=True)
+            del expected
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    if different:
+        sys.exit(f'out-of-core results differ from in-memory ones: {", ".join(dict.fromkeys(different))}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Time reopening a persisted dataset (memory-mapped Feather) against re-parsing CSV and Parquet.
+
+    python benchmarks/bench_persistence.py --rows 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import pandas as pd
+
+from ledger import make_ledger
+from persistence import FeatherFrame, write_feather
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return (time.perf_counter() - start) * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    df = make_ledger(args.rows)
+    with tempfile.TemporaryDirectory() as tmp:
+        feather_path = os.path.join(tmp, 'dataset.feather')
+        parquet_path = os.path.join(tmp, 'dataset.parquet')
+        csv_path = os.path.join(tmp, 'dataset.csv')
+        write_ms, _ = timed(lambda: write_feather(df, feather_path))
+        df.to_parquet(parquet_path, index=False)
+        df.to_csv(csv_path, index=False)
+
+        print(f'{args.rows:,} rows; feather {os.path.getsize(feather_path) / 1e6:.1f} MB '
+              f'written in {write_ms:.1f} ms')
+
+        open_ms, frame = timed(lambda: FeatherFrame(feather_path))
+        head_ms, _ = timed(lambda: frame.head(100))
+        read_ms, _ = timed(frame.read)
+        parquet_ms, _ = timed(lambda: pd.read_parquet(parquet_path))
+        csv_ms, _ = timed(lambda: pd.read_csv(csv_path))
+
+        print(f'{"feather open (mmap)":<24}{open_ms:>10.1f} ms')
+        print(f'{"feather first 100 rows":<24}{head_ms:>10.1f} ms')
+        print(f'{"feather full read":<24}{read_ms:>10.1f} ms')
+        print(f'{"parquet full read":<24}{parquet_ms:>10.1f} ms')
+        print(f'{"csv full parse":<24}{csv_ms:>10.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
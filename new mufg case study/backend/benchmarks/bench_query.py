@@ -0,0 +1,68 @@
+"""
+Server-side queries: the first run of each filter (building the column
+indexes) and later runs (reusing them), against evaluating the same filter
+with pandas boolean masks over the whole frame.
+
+    python benchmarks/bench_query.py --rows 1000000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from ledger import make_ledger
+
+from query import FrameIndexes, parse_filter, parse_sort_keys, select_rows
+
+CASES = [
+    ("region == 'APAC'", lambda df: df['region'] == 'APAC'),
+    ('revenue > 10000', lambda df: df['revenue'] > 10000),
+    ("region == 'APAC' and revenue > 10000", lambda df: (df['region'] == 'APAC') & (df['revenue'] > 10000)),
+    ("product in ['FX', 'Cards'] and 100 <= cost < 500",
+     lambda df: df['product'].isin(['FX', 'Cards']) & (df['cost'] >= 100) & (df['cost'] < 500)),
+    ("contains(memo, 'fee')", lambda df: df['memo'].str.contains('fee', case=False, regex=False).fillna(False)),
+]
+
+
+def best_ms(func, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    df = make_ledger(args.rows)
+    df['region'] = df['region'].astype('category')
+    df['product'] = df['product'].astype('category')
+    cache = {}
+    print(f'{args.rows:,} rows')
+    print(f'{"filter":<52}{"matches":>9}{"first ms":>10}{"cached ms":>11}{"pandas ms":>11}')
+    for text, pandas_mask in CASES:
+        tree = parse_filter(text)
+        start = time.perf_counter()
+        positions = select_rows(FrameIndexes(df, cache), tree)
+        first = (time.perf_counter() - start) * 1000
+        cached = best_ms(lambda: select_rows(FrameIndexes(df, cache), tree))
+        expected = np.flatnonzero(pandas_mask(df).to_numpy(dtype=bool))
+        assert np.array_equal(positions, expected), text
+        baseline = best_ms(lambda: np.flatnonzero(pandas_mask(df).to_numpy(dtype=bool)))
+        print(f'{text:<52}{len(positions):>9,}{first:>10.1f}{cached:>11.1f}{baseline:>11.1f}')
+
+    keys = parse_sort_keys(['region', '-revenue'])
+    tree = parse_filter('revenue > 10000')
+    sort_ms = best_ms(lambda: select_rows(FrameIndexes(df, cache), tree, keys))
+    pandas_ms = best_ms(lambda: df[df['revenue'] > 10000].sort_values(
+        ['region', 'revenue'], ascending=[True, False], kind='stable'))
+    print(f'\nrevenue > 10000 sorted by region, -revenue: {sort_ms:.1f} ms with indexes, {pandas_ms:.1f} ms in pandas')
+
+
+if __name__ == '__main__':
+    main()
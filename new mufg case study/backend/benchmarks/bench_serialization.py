@@ -0,0 +1,59 @@
+"""
+Compare the vectorized serializer with the per-cell NaN/Timestamp loop it replaced.
+
+    python benchmarks/bench_serialization.py --rows 100000
+"""
+import argparse
+import time
+from datetime import datetime
+
+import pandas as pd
+
+from ledger import make_ledger
+from serialization import frame_to_columns, frame_to_records
+
+
+def legacy_records(df):
+    """The loop every handler used to run before jsonify."""
+    records = df.to_dict('records')
+    for record in records:
+        for key, value in record.items():
+            if pd.isna(value):
+                record[key] = None
+            elif isinstance(value, (pd.Timestamp, datetime)):
+                record[key] = value.strftime('%Y-%m-%d %H:%M:%S')
+    return records
+
+
+def best_of(func, df, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(df)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    df = make_ledger(args.rows)
+    cells = df.size
+    print(f'{args.rows:,} rows x {len(df.columns)} columns = {cells:,} cells')
+
+    legacy_time, legacy = best_of(legacy_records, df, args.repeat)
+    records_time, records = best_of(frame_to_records, df, args.repeat)
+    columns_time, _ = best_of(frame_to_columns, df, args.repeat)
+
+    assert records == legacy, 'vectorized records differ from the legacy loop'
+
+    print(f'{"legacy per-cell loop":<24}{legacy_time * 1000:>10.1f} ms')
+    print(f'{"frame_to_records":<24}{records_time * 1000:>10.1f} ms  ({legacy_time / records_time:.1f}x)')
+    print(f'{"frame_to_columns":<24}{columns_time * 1000:>10.1f} ms  ({legacy_time / columns_time:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Approximate statistics: building the column sketches of a ledger in memory
+and part by part from its persisted file across worker processes, against
+exact distinct counts and quantiles with pandas, with a check that every
+estimate falls within its reported bounds.
+
+    python benchmarks/bench_sketches.py --rows 5000000 --workers 0 4
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from ledger import make_ledger
+
+from column_store import PartitionedDataset
+from dtypes import optimize_frame
+from out_of_core import OutOfCoreExecutor
+from sketches import sketch_frame
+
+QUANTILES = (0.01, 0.25, 0.5, 0.75, 0.99)
+PART_ROWS = 250_000
+
+
+def check_bounds(df, sketch):
+    """Columns whose exact distinct count or quantile ranks fall outside the sketch's bounds."""
+    failures = []
+    for col, column in sketch.columns.items():
+        stats = column.describe(QUANTILES)
+        distinct = stats['distinct_count']
+        if not distinct['lower'] <= df[col].nunique() <= distinct['upper']:
+            failures.append(f'{col} distinct')
+        if column.kind != 'number':
+            continue
+        values = df[col].dropna()
+        for q, quantile in stats['quantiles'].items():
+            # The estimate's rank, not its value, is what the sketch bounds
+            below, at_most = (values < quantile['value']).mean(), (values <= quantile['value']).mean()
+            if not below - stats['rank_error'] <= float(q) <= at_most + stats['rank_error']:
+                failures.append(f'{col} q{q}')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=5_000_000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 4])
+    args = parser.parse_args()
+
+    df = optimize_frame(make_ledger(args.rows))
+    numbers = ['account', 'revenue', 'cost', 'tax']
+    print(f'{args.rows:,} rows, {df.shape[1]} columns')
+
+    start = time.perf_counter()
+    exact = {col: df[col].nunique() for col in df.columns}
+    quantiles = df[numbers].quantile(list(QUANTILES))
+    exact_ms = (time.perf_counter() - start) * 1000
+
+    tmp = tempfile.mkdtemp(prefix='bench-sketches-')
+    try:
+        path = os.path.join(tmp, 'parts')
+        dataset = PartitionedDataset.create(path)
+        for offset in range(0, len(df), PART_ROWS):
+            dataset.append(df[offset:offset + PART_ROWS])
+
+        print(f'{"method":<24}{"ms":>9}  bounds')
+        print(f'{"pandas (exact)":<24}{exact_ms:>9.0f}')
+        start = time.perf_counter()
+        sketch = sketch_frame(df)
+        elapsed = (time.perf_counter() - start) * 1000
+        failures = check_bounds(df, sketch)
+        print(f'{"sketch, in memory":<24}{elapsed:>9.0f}  {", ".join(failures) or "all within"}')
+
+        for workers in args.workers:
+            executor = OutOfCoreExecutor(workers)
+            if workers:
+                # Start the pool's processes outside the timing
+                executor.sketch(path, ['account'])
+            start = time.perf_counter()
+            parts_sketch = executor.sketch(path, list(df.columns), 10_000)
+            elapsed = (time.perf_counter() - start) * 1000
+            failures = check_bounds(df, parts_sketch)
+            print(f'{f"sketch, {workers} workers":<24}{elapsed:>9.0f}  {", ".join(failures) or "all within"}')
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f'\n{"column":<10}{"distinct":>12}{"estimate":>12}{"error %":>9}')
+    for col, column in sketch.columns.items():
+        estimate = column.describe(())['distinct_count']['estimate']
+        print(f'{col:<10}{exact[col]:>12,}{estimate:>12,}{(estimate / exact[col] - 1) * 100:>9.2f}')
+
+    print(f'\n{"column":<10}{"quantile":>9}{"exact":>12}{"estimate":>12}')
+    for col in numbers:
+        estimates = sketch.columns[col].quantiles.quantiles(QUANTILES)
+        for q, estimate in zip(QUANTILES, estimates):
+            print(f'{col:<10}{q:>9}{quantiles.loc[q, col]:>12.2f}{estimate:>12.2f}')
+
+
+if __name__ == '__main__':
+    main()
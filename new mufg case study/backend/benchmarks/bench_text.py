@@ -0,0 +1,69 @@
+"""
+Whitespace trimming and text cleanup: the Arrow string kernels of
+text_cleaning against the previous astype(str)/.str.strip() implementation,
+on object, string[pyarrow] and category text columns.
+
+    python benchmarks/bench_text.py --rows 1000000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from ledger import make_ledger
+
+from transforms import text_columns, trim_whitespaces
+
+
+def legacy_trim_whitespaces(df):
+    """The implementation trim_whitespaces replaced, for comparison."""
+    df = df.copy(deep=False)
+    for col in text_columns(df):
+        if isinstance(df[col].dtype, pd.StringDtype):
+            df[col] = df[col].str.strip()
+        else:
+            df[col] = df[col].astype(str).str.strip()
+            df[col] = df[col].replace(['nan', 'None'], None)
+    return df
+
+
+def best_ms(func, repeat=3):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    ledger = make_ledger(args.rows)
+    rng = np.random.default_rng(1)
+    # Padded, irregularly spaced text with about 1% nulls
+    memo = '  ' + ledger['memo'].astype(object) + np.where(rng.random(args.rows) < 0.5, '   ', ' ')
+    memo[ledger['memo'].isna()] = None
+
+    frames = {
+        'object': pd.DataFrame({'memo': memo.astype(object)}),
+        'string[pyarrow]': pd.DataFrame({'memo': memo.astype('string[pyarrow]')}),
+        'category': pd.DataFrame({'memo': memo.astype('category')}),
+    }
+    print(f'{args.rows:,} rows, one text column')
+    print(f'{"dtype":<18}{"legacy ms":>11}{"strip ms":>10}{"speedup":>9}{"all options ms":>16}  nulls kept')
+    for name, df in frames.items():
+        legacy = best_ms(lambda: legacy_trim_whitespaces(df))
+        strip = best_ms(lambda: trim_whitespaces(df))
+        everything = best_ms(lambda: trim_whitespaces(
+            df, case='lower', collapse_whitespace=True,
+            replace=[{'pattern': r'[^0-9a-z ]', 'replacement': ''}]))
+        nulls = trim_whitespaces(df)['memo'].isna().sum() == df['memo'].isna().sum()
+        print(f'{name:<18}{legacy:>11.1f}{strip:>10.1f}{legacy / strip:>8.1f}x{everything:>16.1f}  {nulls}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Compare JSON and Arrow IPC stream payloads: bytes on the wire and encode/decode time.
+
+    python benchmarks/bench_transport.py --rows 100000
+"""
+import argparse
+import json
+import time
+
+import pandas as pd
+
+from ledger import make_ledger
+from serialization import arrow_stream_to_frame, frame_to_arrow_stream, serialize_frame
+
+
+def json_encode(df, orient):
+    return json.dumps(serialize_frame(df, orient)).encode()
+
+
+def json_decode(payload, orient):
+    data = json.loads(payload)
+    if orient == 'columns':
+        return pd.DataFrame(data['data'], columns=data['columns'])
+    return pd.DataFrame(data)
+
+
+def best_of(func, arg, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(arg)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    df = make_ledger(args.rows)
+    print(f'{args.rows:,} rows x {len(df.columns)} columns')
+    print(f'{"format":<16}{"bytes":>14}{"encode ms":>12}{"decode ms":>12}')
+
+    formats = {
+        'json records': (lambda d: json_encode(d, 'records'), lambda p: json_decode(p, 'records')),
+        'json columns': (lambda d: json_encode(d, 'columns'), lambda p: json_decode(p, 'columns')),
+        'arrow stream': (frame_to_arrow_stream, lambda p: arrow_stream_to_frame(p)[0]),
+    }
+    for name, (encode, decode) in formats.items():
+        encode_time, payload = best_of(encode, df, args.repeat)
+        decode_time, decoded = best_of(decode, payload, args.repeat)
+        assert len(decoded) == len(df), f'{name} lost rows'
+        print(f'{name:<16}{len(payload):>14,}{encode_time * 1000:>12.1f}{decode_time * 1000:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
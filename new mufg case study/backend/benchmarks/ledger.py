@@ -0,0 +1,79 @@
+"""Synthetic ledger datasets and helpers shared by the benchmark scripts."""
+import os
+import resource
+import sys
+import threading
+
+import numpy as np
+import pandas as pd
+
+# Make the backend modules importable when a benchmark is run as a script
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+REGIONS = ['APAC', 'EMEA', 'AMER', 'LATAM']
+PRODUCTS = ['Loans', 'Deposits', 'Cards', 'FX', 'Custody', 'Payments']
+CURRENCIES = ['USD', 'JPY', 'EUR', 'GBP']
+
+
+def make_ledger(rows, seed=0, null_fraction=0.01):
+    """A ledger-like DataFrame: dates, low-cardinality strings and money columns."""
+    rng = np.random.default_rng(seed)
+    revenue = rng.gamma(2.0, 5000.0, rows).round(2)
+    cost = (revenue * rng.uniform(0.3, 0.9, rows)).round(2)
+    df = pd.DataFrame({
+        'date': pd.Timestamp('2022-01-01') + pd.to_timedelta(rng.integers(0, 3 * 365, rows), unit='D'),
+        'region': rng.choice(REGIONS, rows),
+        'product': rng.choice(PRODUCTS, rows),
+        'currency': rng.choice(CURRENCIES, rows),
+        'account': rng.integers(1000, 1200, rows),
+        'revenue': revenue,
+        'cost': cost,
+        'tax': ((revenue - cost).clip(min=0) * 0.3).round(2),
+        'memo': rng.choice(['  wire transfer', 'card settlement  ', ' fee ', 'interest'], rows),
+    })
+    if null_fraction:
+        for col in ('region', 'cost', 'memo'):
+            df.loc[rng.random(rows) < null_fraction, col] = None
+    return df
+
+
+class RssSampler:
+    """Samples the process's resident set size in a background thread."""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+        self._peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def current(self):
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * self._page_size
+        except OSError:
+            # No /proc: the process-wide high-water mark (KB on Linux, bytes on macOS)
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak if sys.platform == 'darwin' else peak * 1024
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._peak = max(self._peak, self.current())
+
+    def __enter__(self):
+        self._peak = self.start = self.current()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._peak = max(self._peak, self.current())
+
+    @property
+    def peak(self):
+        return self._peak
@@ -0,0 +1,167 @@
+"""
+On-disk columnar storage for datasets too big to hold while parsing.
+
+A ``PartitionedDataset`` is a directory of numbered Parquet part files plus
+a ``meta.json`` describing them. Parts are appended one at a time during
+ingest and can be read back individually or as one DataFrame.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_bool_dtype, is_integer_dtype, union_categoricals
+
+META_FILE = 'meta.json'
+
+
+def part_file(index):
+    return f'part-{index:05d}.parquet'
+
+
+def frame_schema(df):
+    return [{'name': str(col), 'dtype': str(dtype)} for col, dtype in df.dtypes.items()]
+
+
+def concat_frames(frames):
+    """
+    Concatenate part frames, keeping columns that are ``category`` in every
+    part categorical (plain ``pd.concat`` falls back to object when the
+    parts' categories differ). Parts without rows are left out, and columns
+    that are all null in a part take the dtype the parts with values have,
+    so neither changes the result's dtypes (an empty ``category`` column
+    reads back from Parquet as object; appended rows may lack a column).
+    """
+    frames = list(frames)
+    if not frames:
+        return pd.DataFrame()
+    frames = [f for f in frames if len(f)] or frames[:1]
+    if len(frames) == 1:
+        return frames[0]
+
+    for col in frames[0].columns:
+        frames = _cast_all_null(frames, col)
+    for col in frames[0].columns:
+        if all(col in f.columns and isinstance(f[col].dtype, pd.CategoricalDtype) for f in frames):
+            categories = union_categoricals([f[col] for f in frames], ignore_order=True).categories
+            frames = [f.assign(**{col: f[col].cat.set_categories(categories)}) for f in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
+def _cast_all_null(frames, col):
+    """``frames`` with ``col``, where it is all null, cast to its dtype in the first frame with values."""
+    dtypes = [f[col].dtype for f in frames if col in f.columns]
+    if all(dtype == dtypes[0] for dtype in dtypes):
+        return frames
+    null = [col not in f.columns or f[col].isna().all() for f in frames]
+    target = next((f[col].dtype for f, all_null in zip(frames, null) if not all_null), None)
+    if target is None:
+        return frames
+    if is_integer_dtype(target) and not isinstance(target, pd.api.extensions.ExtensionDtype):
+        # Nulls make a numpy integer column float
+        target = np.dtype('float64')
+    elif is_bool_dtype(target) and not isinstance(target, pd.api.extensions.ExtensionDtype):
+        target = np.dtype(object)
+    return [f.assign(**{col: f[col].astype(target)}) if all_null and col in f.columns and f[col].dtype != target
+            else f for f, all_null in zip(frames, null)]
+
+
+class PartitionedDataset:
+    """A dataset stored as ``part-NNNNN.parquet`` files in one directory."""
+
+    def __init__(self, path):
+        self.path = path
+        meta_path = os.path.join(path, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {'rows': 0, 'columns': None, 'schema': None, 'parts': []}
+
+    @classmethod
+    def create(cls, path):
+        os.makedirs(path, exist_ok=True)
+        return cls(path)
+
+    @property
+    def rows(self):
+        return self.meta['rows']
+
+    @property
+    def columns(self):
+        return self.meta['columns'] or []
+
+    @property
+    def schema(self):
+        return self.meta['schema'] or []
+
+    @property
+    def num_parts(self):
+        return len(self.meta['parts'])
+
+    def append(self, df):
+        """Write ``df`` as the next part file."""
+        self.add_part(self.write_part(self.num_parts, df), frame_schema(df))
+
+    def write_part(self, index, df):
+        """
+        Write ``df`` as part file ``index`` without recording it; several
+        processes can write parts at once, then one records them in order
+        with ``add_part``.
+        """
+        file_name = part_file(index)
+        df.to_parquet(os.path.join(self.path, file_name), index=False)
+        return {'file': file_name, 'rows': len(df)}
+
+    def add_part(self, part, schema):
+        """
+        Record a part written by ``write_part``; the first one fixes the
+        columns, and the first one with rows their dtypes.
+        """
+        if self.meta['columns'] is None:
+            self.meta['columns'] = [column['name'] for column in schema]
+        if self.meta['schema'] is None or (not self.meta['rows'] and part['rows']):
+            self.meta['schema'] = schema
+        self.meta['parts'].append(part)
+        self.meta['rows'] += part['rows']
+        self._save_meta()
+
+    def set_schema(self, schema):
+        """Record ``schema`` for parts rewritten to it (``write_part``), as a wider dtype found later."""
+        self.meta['schema'] = schema
+        self._save_meta()
+
+    def _save_meta(self):
+        tmp_path = os.path.join(self.path, META_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, os.path.join(self.path, META_FILE))
+
+    def read_part(self, index, columns=None):
+        part = self.meta['parts'][index]
+        df = pd.read_parquet(os.path.join(self.path, part['file']), columns=columns)
+        # Parquet has no object type: a part's booleans without nulls read back as bool
+        objects = {column['name'] for column in self.schema if column['dtype'] == 'object'}
+        cast = {col: object for col in df.columns if col in objects and df[col].dtype != object}
+        return df.astype(cast) if cast else df
+
+    def iter_parts(self, columns=None):
+        for index in range(self.num_parts):
+            yield self.read_part(index, columns)
+
+    def read(self, columns=None):
+        """The whole dataset as one DataFrame."""
+        if not self.num_parts:
+            return pd.DataFrame(columns=self.columns)
+        return concat_frames(self.iter_parts(columns))
+
+    def head(self, n):
+        frames, remaining = [], n
+        for part in self.iter_parts():
+            frames.append(part.head(remaining))
+            remaining -= len(frames[-1])
+            if remaining <= 0:
+                break
+        if not frames:
+            return pd.DataFrame(columns=self.columns)
+        return concat_frames(frames)
@@ -0,0 +1,156 @@
+"""
+Compressed request and response bodies.
+
+Responses are compressed when the client accepts it (``Accept-Encoding``):
+zstd when the ``zstandard`` package is installed and the client lists it,
+otherwise gzip. Only text-like bodies (JSON, CSV, NDJSON, Arrow IPC
+streams) of at least ``min_bytes`` are compressed; XLSX and Parquet are
+compressed already. Streamed responses are compressed as they are
+produced, flushing after every block so progress events still arrive
+one by one.
+
+Request bodies sent with ``Content-Encoding: gzip`` (or zstd) are
+decompressed by a WSGI middleware before Flask reads them, up to
+``max_request_bytes`` once decompressed.
+"""
+import gzip
+import io
+import json
+import zlib
+
+from flask import request
+
+from metrics import phase
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_MIMETYPES = {
+    'application/json',
+    'application/x-ndjson',
+    'application/vnd.apache.arrow.stream',
+    'text/csv',
+    'text/plain',
+    'text/html',
+}
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+class RequestBodyTooLarge(ValueError):
+    pass
+
+
+def available_encodings():
+    return ('zstd', 'gzip') if zstandard is not None else ('gzip',)
+
+
+def negotiate(accept_encoding):
+    """The encoding to use for a response, from the request's ``Accept-Encoding``, or None."""
+    for encoding in available_encodings():
+        quality = accept_encoding[encoding]
+        if quality:
+            return encoding
+    return None
+
+
+def compress(data, encoding):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def compress_stream(blocks, encoding):
+    """Compress an iterable of byte blocks, flushing after each one."""
+    if encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+        flush_block, finish = zstandard.COMPRESSOBJ_FLUSH_BLOCK, zstandard.COMPRESSOBJ_FLUSH_FINISH
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        flush_block, finish = zlib.Z_SYNC_FLUSH, zlib.Z_FINISH
+    try:
+        for block in blocks:
+            if isinstance(block, str):
+                block = block.encode()
+            data = compressor.compress(block) + compressor.flush(flush_block)
+            if data:
+                yield data
+        yield compressor.flush(finish)
+    finally:
+        if hasattr(blocks, 'close'):
+            blocks.close()
+
+
+def decompress(data, encoding, max_bytes):
+    """Decompress a request body; raises ValueError if it is invalid or larger than ``max_bytes``."""
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd request bodies are not supported')
+        reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data))
+        result = reader.read(max_bytes + 1)
+    else:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        result = decompressor.decompress(data, max_bytes + 1)
+        if not decompressor.eof and len(result) <= max_bytes:
+            raise ValueError('truncated gzip request body')
+    if len(result) > max_bytes:
+        raise RequestBodyTooLarge(f'decompressed request body is larger than {max_bytes} bytes')
+    return result
+
+
+class DecompressRequests:
+    """WSGI middleware decompressing request bodies sent with a supported ``Content-Encoding``."""
+
+    def __init__(self, wsgi_app, max_request_bytes):
+        self.wsgi_app = wsgi_app
+        self.max_request_bytes = max_request_bytes
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding in ('gzip', 'x-gzip', 'zstd'):
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            body = environ['wsgi.input'].read(length) if length else environ['wsgi.input'].read()
+            try:
+                body = decompress(body, 'zstd' if encoding == 'zstd' else 'gzip', self.max_request_bytes)
+            except (ValueError, OSError, zlib.error) as e:
+                status = '413 Payload Too Large' if isinstance(e, RequestBodyTooLarge) else '400 Bad Request'
+                message = json.dumps({'error': f'Could not decompress request body: {e}'}).encode()
+                start_response(status, [('Content-Type', 'application/json'),
+                                        ('Content-Length', str(len(message)))])
+                return [message]
+            environ['wsgi.input'] = io.BytesIO(body)
+            environ['CONTENT_LENGTH'] = str(len(body))
+            del environ['HTTP_CONTENT_ENCODING']
+        return self.wsgi_app(environ, start_response)
+
+
+def enable_compression(app, min_bytes=1024, max_request_bytes=1024 ** 3):
+    """Compress ``app``'s responses and accept compressed request bodies."""
+    app.wsgi_app = DecompressRequests(app.wsgi_app, max_request_bytes)
+
+    @app.after_request
+    def compress_response(response):
+        if (response.mimetype not in COMPRESSIBLE_MIMETYPES
+                or 'Content-Encoding' in response.headers
+                or response.direct_passthrough
+                or response.status_code < 200 or response.status_code in (204, 206, 304)):
+            return response
+        encoding = negotiate(request.accept_encodings)
+        response.vary.add('Accept-Encoding')
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            if len(data) < min_bytes:
+                return response
+            with phase('compress'):
+                response.set_data(compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+        return response
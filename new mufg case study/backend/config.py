@@ -0,0 +1,80 @@
+"""
+Backend settings, overridable through environment variables.
+"""
+import os
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Where ingested datasets are written
+DATA_DIR = os.environ.get('DATA_DIR', os.path.join(BACKEND_DIR, 'data'))
+
+# Disk space for persisted datasets; the least recently used ones are deleted beyond it
+DATASET_DISK_BUDGET_BYTES = int(float(os.environ.get('DATASET_DISK_BUDGET_MB', 5120)) * 1024 * 1024)
+# Dataset directories left without a record (an ingest that died) are deleted once nothing has been
+# written to them for this long
+UNCOMMITTED_GRACE_SECONDS = float(os.environ.get('UNCOMMITTED_GRACE_MINUTES', 60)) * 60
+
+# Memory for the versions of one dataset kept in memory (shared column buffers count once);
+# older versions beyond it are released and reopened from disk when needed
+VERSION_MEMORY_BUDGET_BYTES = int(float(os.environ.get('VERSION_MEMORY_BUDGET_MB', 1024)) * 1024 * 1024)
+
+# Rows converted at a time by streamed exports
+EXPORT_CHUNK_ROWS = int(os.environ.get('EXPORT_CHUNK_ROWS', 50_000))
+
+# Background jobs: worker processes, jobs queued or running at once, rows per progress step
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_MAX_PENDING = int(os.environ.get('JOB_MAX_PENDING', 32))
+JOB_CHUNK_ROWS = int(os.environ.get('JOB_CHUNK_ROWS', 100_000))
+
+# Transformations of stored datasets of at least OUT_OF_CORE_MIN_ROWS rows that aren't in memory run
+# part by part on their files, across OUT_OF_CORE_WORKERS processes (0 runs them in the server process);
+# remove-duplicate hashes rows into buckets of about OUT_OF_CORE_BUCKET_ROWS rows
+OUT_OF_CORE_MIN_ROWS = int(os.environ.get('OUT_OF_CORE_MIN_ROWS', 5_000_000))
+OUT_OF_CORE_WORKERS = int(os.environ.get('OUT_OF_CORE_WORKERS', 2))
+OUT_OF_CORE_BUCKET_ROWS = int(os.environ.get('OUT_OF_CORE_BUCKET_ROWS', 500_000))
+
+# Responses of at least COMPRESS_MIN_BYTES are gzip/zstd-compressed for clients that accept it;
+# compressed request bodies may expand to at most MAX_REQUEST_MB
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+MAX_REQUEST_BYTES = int(float(os.environ.get('MAX_REQUEST_MB', 1024)) * 1024 * 1024)
+
+# Requests slower than PROFILE_SLOW_REQUEST_MS get their sampled stacks written to
+# DATA_DIR/profiles as flamegraph input (0 disables the profiler)
+PROFILE_SLOW_REQUEST_MS = float(os.environ.get('PROFILE_SLOW_REQUEST_MS', 0))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 5))
+
+# Streaming CSV ingest: rows per chunk, and rows sampled up front to infer column types
+INGEST_CHUNK_ROWS = int(os.environ.get('INGEST_CHUNK_ROWS', 100_000))
+INGEST_SAMPLE_ROWS = int(os.environ.get('INGEST_SAMPLE_ROWS', 10_000))
+
+# Excel parsing: 'auto' reads with calamine when python-calamine is installed and with pd.read_excel's
+# default engine otherwise ('calamine' or 'pandas' picks one); batch uploads parse their sheets across
+# EXCEL_WORKERS processes (0 parses them in the server process)
+EXCEL_ENGINE = os.environ.get('EXCEL_ENGINE', 'auto')
+EXCEL_WORKERS = int(os.environ.get('EXCEL_WORKERS', 2))
+
+# Column expressions (/math/expression) are evaluated EXPRESSION_CHUNK_ROWS rows at a time,
+# bounding the temporary arrays of each operation
+EXPRESSION_CHUNK_ROWS = int(os.environ.get('EXPRESSION_CHUNK_ROWS', 65_536))
+
+# Approximate statistics: HyperLogLog registers (2 ** SKETCH_HLL_PRECISION), KLL quantile sketch size,
+# and rows kept in the uniform sample for previews and histograms; INGEST_SKETCHES=0 stops streaming
+# ingest sketching each chunk as it goes (sketches are then built on first use)
+SKETCH_HLL_PRECISION = int(os.environ.get('SKETCH_HLL_PRECISION', 14))
+SKETCH_KLL_K = int(os.environ.get('SKETCH_KLL_K', 200))
+SKETCH_SAMPLE_ROWS = int(os.environ.get('SKETCH_SAMPLE_ROWS', 10_000))
+INGEST_SKETCHES = os.environ.get('INGEST_SKETCHES', '1') != '0'
+
+# Compact dtypes for ingested data (set COMPACT_DTYPES=0 to keep pandas' defaults)
+COMPACT_DTYPES = os.environ.get('COMPACT_DTYPES', '1') != '0'
+
+# A text column with at most this share of distinct values is stored as 'category'
+CATEGORY_MAX_RATIO = float(os.environ.get('CATEGORY_MAX_RATIO', 0.5))
+
+# dtype for the other all-text columns ('object' keeps Python strings)
+TEXT_DTYPE = os.environ.get('TEXT_DTYPE', 'string[pyarrow]')
+
+# Downcast float64 columns to float32 where no value changes by more than FLOAT32_TOLERANCE.
+# Off by default: monetary values keep full precision.
+DOWNCAST_FLOATS = os.environ.get('DOWNCAST_FLOATS', '0') == '1'
+FLOAT32_TOLERANCE = float(os.environ.get('FLOAT32_TOLERANCE', 0))
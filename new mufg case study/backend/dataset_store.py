@@ -0,0 +1,628 @@
+"""
+Server-side dataset store.
+
+Uploaded datasets live here, keyed by a ``dataset_id`` handed back from
+``/upload``, so the cleaning, math and P&L endpoints can work on the stored
+DataFrame instead of having the whole dataset posted back on every request.
+With a ``DatasetPersistence`` every version is also written to disk, so
+datasets survive restarts and dropping out of the in-memory LRU.
+
+Each dataset keeps a graph of versions: every transformation adds a child
+of the current version, and undo/redo/checkout move between them. pandas
+copy-on-write is enabled so a version shares the buffers of every column it
+didn't change with its parent; adding a column costs that column's memory
+only. Versions beyond the memory budget are released from memory, to be
+reopened from disk if they are needed again.
+
+Server processes sharing a persistence root share their datasets: a
+process picks up the versions another one wrote when it next uses the
+dataset, opening them memory-mapped rather than copying them, and changes
+are serialized across processes by the dataset's file lock.
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from config import VERSION_MEMORY_BUDGET_BYTES
+from errors import ApiError
+from persistence import ORIGINAL_FILE, PARTS_DIR, version_file, version_parts
+
+# Frames derived with assign/rename/dropna/... share unchanged columns with
+# their input instead of copying them
+pd.set_option('mode.copy_on_write', True)
+
+
+class DatasetNotFoundError(ApiError):
+    """Raised when a dataset_id is not (or no longer) in the store."""
+
+    status_code = 404
+
+    def __init__(self, dataset_id):
+        super().__init__(f'Dataset {dataset_id} not found')
+        self.dataset_id = dataset_id
+
+
+def _buffer_key(series):
+    """Identifies the memory holding a column's values."""
+    values = series.values
+    if isinstance(values, np.ndarray):
+        return (values.__array_interface__['data'][0], values.strides, values.shape, values.dtype.str)
+    return id(values)
+
+
+def _same_values(old, new):
+    if old.dtype != new.dtype:
+        return False
+    # Unchanged columns usually still share their buffer with the previous frame
+    if _buffer_key(old) == _buffer_key(new):
+        return True
+    return old.equals(new)
+
+
+def changed_columns(old, new):
+    """Columns of ``new`` whose values differ from the same-named column of ``old``."""
+    if len(old) != len(new) or not old.index.equals(new.index):
+        return list(new.columns)
+    if not (old.columns.is_unique and new.columns.is_unique):
+        return list(new.columns)
+    return [col for col in new.columns
+            if col not in old.columns or not _same_values(old[col], new[col])]
+
+
+def column_buffers(df, known=None):
+    """
+    ``{buffer key: bytes}`` for the columns of ``df``; sizes of buffers in
+    ``known`` (a parent version's buffers) are reused rather than measured.
+    """
+    known = known or {}
+    buffers = {}
+    for position in range(df.shape[1]):
+        series = df.iloc[:, position]
+        key = _buffer_key(series)
+        if key not in buffers:
+            buffers[key] = known[key] if key in known else int(series.memory_usage(index=False, deep=True))
+    return buffers
+
+
+class VersionUnavailableError(ApiError):
+    """Raised when a version was released from memory and has no copy on disk."""
+
+    status_code = 410
+
+    def __init__(self, version):
+        super().__init__(f'Version {version} is no longer available')
+
+
+class Version:
+    """
+    One node of a dataset's version graph.
+
+    The frame is held in memory or, once released, reopened from ``source``
+    (a file on disk, opened on first use through ``opener``).
+    """
+
+    def __init__(self, version, parent=None, df=None, operation=None, column_versions=None,
+                 source=None, opener=None, file=None, created_at=None):
+        self.version = version
+        self.parent = parent
+        self.operation = operation
+        # Version at which each column last changed on the way to this one;
+        # columns not listed are unchanged since upload
+        self.column_versions = column_versions or {}
+        self.file = file
+        self.opener = opener
+        self._source = source
+        self._df = df
+        self.buffers = None
+        # The child redo moves to: the one last created or undone from
+        self.redo_child = None
+        self.created_at = created_at or datetime.utcnow()
+        self.last_used = time.monotonic()
+        # Data derived from the frame (sort permutations, memory report, ...)
+        self.cache = {}
+
+    @property
+    def loaded(self):
+        return self._df is not None
+
+    def holds(self, df):
+        return self._df is df
+
+    @property
+    def source(self):
+        if self._source is None and self.opener is not None:
+            self._source = self.opener()
+        return self._source
+
+    def frame(self):
+        self.last_used = time.monotonic()
+        if self._df is None:
+            if self.source is None:
+                raise VersionUnavailableError(self.version)
+            self._df = self.source.read()
+        return self._df
+
+    def release(self):
+        self._df = None
+        self.buffers = None
+        self.cache = {}
+
+    def head(self, n):
+        if not self.loaded and self.source is not None:
+            return self.source.head(n)
+        return self.frame().head(n)
+
+    def shape_info(self):
+        """``(rows, columns, schema)``, without loading a frame that's on disk."""
+        if not self.loaded and self.source is not None:
+            return self.source.rows, self.source.columns, self.source.schema
+        df = self.frame()
+        schema = [{'name': col, 'dtype': str(dtype)} for col, dtype in df.dtypes.items()]
+        return len(df), list(df.columns), schema
+
+    def describe(self):
+        return {
+            'version': self.version,
+            'parent': self.parent,
+            'operation': self.operation,
+            'created_at': self.created_at.isoformat(),
+            'in_memory': self.loaded,
+        }
+
+
+class DatasetEntry:
+    """
+    A stored dataset: the frame as uploaded (version 0) plus the graph of
+    versions derived from it, with ``version`` the current one.
+
+    An entry may instead be backed by a ``source`` on disk (a
+    ``PartitionedDataset`` from streaming ingest, or a persisted file); its
+    frames are then only read into memory the first time an operation needs
+    them.
+    """
+
+    def __init__(self, dataset_id, name, df=None, source=None):
+        self.dataset_id = dataset_id
+        self.name = name
+        self.versions = {0: Version(0, df=df, operation='upload', source=source)}
+        self.version = 0
+        self.created_at = datetime.utcnow()
+        self.updated_at = self.created_at
+        # Serializes transformations of this dataset without blocking others
+        self.lock = threading.RLock()
+        # Memoized per-column statistics and parsed date columns, keyed by (column, column version, ...)
+        self.stats_cache = {}
+        # The persisted record this entry reflects, and how deeply this thread holds its file lock
+        self.record_stamp = None
+        self.lock_depth = 0
+
+    @property
+    def node(self):
+        return self.versions[self.version]
+
+    @property
+    def column_versions(self):
+        return self.node.column_versions
+
+    def column_version(self, column, original=False):
+        return 0 if original else self.column_versions.get(column, 0)
+
+    @property
+    def loaded(self):
+        return self.versions[0].loaded
+
+    @property
+    def original(self):
+        with self.lock:
+            return self.versions[0].frame()
+
+    @property
+    def current(self):
+        with self.lock:
+            return self.node.frame()
+
+    def head(self, n):
+        """First ``n`` rows of the current frame, without loading a disk-backed dataset."""
+        with self.lock:
+            return self.node.head(n)
+
+    def frame(self, original=False):
+        return self.original if original else self.current
+
+    def cache(self, original=False):
+        return self.versions[0].cache if original else self.node.cache
+
+    def can_undo(self):
+        return self.node.parent is not None
+
+    def can_redo(self):
+        return self.node.redo_child is not None
+
+    def retained_bytes(self):
+        """Memory held by the versions in memory, counting shared column buffers once."""
+        buffers = {}
+        for node in self.versions.values():
+            if node.loaded:
+                if node.buffers is None:
+                    node.buffers = column_buffers(node.frame())
+                buffers.update(node.buffers)
+        return sum(buffers.values())
+
+    def history(self):
+        return [node.describe() for node in sorted(self.versions.values(), key=lambda node: node.version)]
+
+    def metadata(self):
+        with self.lock:
+            rows, columns, schema = self.node.shape_info()
+            original = self.versions[0]
+            original_rows = len(original.frame()) if original.loaded else original.source.rows
+
+        return {
+            'dataset_id': self.dataset_id,
+            'name': self.name,
+            'version': self.version,
+            'parent_version': self.node.parent,
+            'can_undo': self.can_undo(),
+            'can_redo': self.can_redo(),
+            'rows': rows,
+            'columns': columns,
+            'schema': schema,
+            'original_rows': original_rows,
+            'created_at': self.created_at.isoformat(),
+            'updated_at': self.updated_at.isoformat(),
+        }
+
+
+class DatasetStore:
+    """
+    Thread-safe, multi-dataset store.
+
+    Frames handed out by the store must be treated as read-only; a
+    transformation builds a new frame and commits it through ``update`` or
+    ``transform``. When more than ``max_datasets`` are held, the least
+    recently used dataset is dropped from memory.
+
+    With a ``persistence`` (``DatasetPersistence``) the original frame and
+    every transformed version are written to disk as they are stored, and a
+    dataset that is not in memory is reopened from its files on first use.
+    A disk-backed ``source`` passed to ``create`` must then live in the
+    dataset's directory (``persistence.dataset_dir(dataset_id)``).
+
+    Versions of one dataset held in memory are bounded by
+    ``version_memory_budget`` bytes; the least recently used ones beyond it
+    are released (the current version and an original with no copy on disk
+    never are).
+    """
+
+    def __init__(self, max_datasets=20, persistence=None, version_memory_budget=VERSION_MEMORY_BUDGET_BYTES):
+        self.max_datasets = max_datasets
+        self.persistence = persistence
+        self.version_memory_budget = version_memory_budget
+        self._datasets = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def new_id():
+        return uuid.uuid4().hex
+
+    def _insert(self, entry):
+        with self._lock:
+            entry = self._datasets.setdefault(entry.dataset_id, entry)
+            self._datasets.move_to_end(entry.dataset_id)
+            while len(self._datasets) > self.max_datasets:
+                self._datasets.popitem(last=False)
+        return entry
+
+    def _opener(self, dataset_id, file):
+        return lambda: self.persistence.open_frame(dataset_id, file)
+
+    def _persist(self, entry):
+        """Write the entry's record and keep the disk budget; call inside ``_exclusive(entry)``."""
+        self.persistence.save_record({
+            'dataset_id': entry.dataset_id,
+            'name': entry.name,
+            'current': entry.version,
+            'versions': [{
+                'version': node.version,
+                'parent': node.parent,
+                'operation': node.operation,
+                'file': node.file,
+                'column_versions': node.column_versions,
+                'redo_child': node.redo_child,
+                'created_at': node.created_at.isoformat(),
+            } for node in entry.versions.values()],
+            'created_at': entry.created_at.isoformat(),
+            'updated_at': entry.updated_at.isoformat(),
+        })
+        entry.record_stamp = self.persistence.record_stamp(entry.dataset_id)
+        evicted = self.persistence.enforce_budget(keep={entry.dataset_id})
+        with self._lock:
+            for dataset_id in evicted:
+                self._datasets.pop(dataset_id, None)
+
+    def _load_record(self, entry, record, stamp):
+        """
+        Make ``entry`` reflect a persisted record. Versions it already holds
+        are kept, with their frames and caches, since version files never change.
+        """
+        versions = {}
+        for saved in record['versions']:
+            node = entry.versions.get(saved['version'])
+            if node is None or node.file != saved['file']:
+                node = Version(saved['version'], saved['parent'], operation=saved['operation'],
+                               file=saved['file'], opener=self._opener(entry.dataset_id, saved['file']),
+                               created_at=datetime.fromisoformat(saved['created_at']))
+            node.column_versions = saved['column_versions']
+            node.redo_child = saved['redo_child']
+            versions[node.version] = node
+        entry.name = record['name']
+        entry.versions = versions
+        entry.version = record['current']
+        entry.created_at = datetime.fromisoformat(record['created_at'])
+        entry.updated_at = datetime.fromisoformat(record['updated_at'])
+        entry.record_stamp = stamp
+
+    def _open(self, dataset_id):
+        """A lazy entry for a persisted dataset, or None."""
+        if self.persistence is None:
+            return None
+        stamp = self.persistence.record_stamp(dataset_id)
+        record = self.persistence.load_record(dataset_id)
+        if record is None:
+            return None
+
+        entry = DatasetEntry(dataset_id, record['name'])
+        entry.versions = {}
+        self._load_record(entry, record, stamp)
+        return entry
+
+    def _sync(self, entry):
+        """
+        Pick up changes another process made to a persisted dataset; call with
+        ``entry.lock`` held. Returns False if the dataset has been deleted.
+        """
+        if self.persistence is None or entry.record_stamp is None:
+            return True
+        stamp = self.persistence.record_stamp(entry.dataset_id)
+        if stamp == entry.record_stamp:
+            return True
+        record = self.persistence.load_record(entry.dataset_id)
+        if record is None:
+            return False
+        self._load_record(entry, record, stamp)
+        return True
+
+    @contextmanager
+    def _exclusive(self, entry):
+        """
+        Hold the entry's lock and, with persistence, its file lock, so no other
+        thread or process changes the dataset meanwhile; the entry is synced
+        with the disk first. Reentrant within a thread.
+        """
+        with entry.lock:
+            if self.persistence is None or entry.lock_depth:
+                entry.lock_depth += 1
+                try:
+                    yield
+                finally:
+                    entry.lock_depth -= 1
+                return
+
+            with self.persistence.lock(entry.dataset_id):
+                if not self._sync(entry):
+                    raise DatasetNotFoundError(entry.dataset_id)
+                entry.lock_depth += 1
+                try:
+                    yield
+                finally:
+                    entry.lock_depth -= 1
+
+    def _release_versions(self, entry):
+        """Release least recently used versions until the entry fits its memory budget."""
+        candidates = sorted(
+            (node for node in entry.versions.values()
+             if node.loaded and node.version != entry.version and (node.version != 0 or node.source is not None)),
+            key=lambda node: node.last_used
+        )
+        for node in candidates:
+            if entry.retained_bytes() <= self.version_memory_budget:
+                break
+            node.release()
+
+    def create(self, df=None, name=None, dataset_id=None, source=None, source_file=PARTS_DIR):
+        """
+        Register a frame, or a disk-backed ``source``, as a new dataset. With
+        persistence, ``source_file`` names the source within the dataset's directory.
+        """
+        dataset_id = dataset_id or self.new_id()
+        entry = DatasetEntry(dataset_id, name, df=df, source=source)
+        if self.persistence is not None:
+            with self._exclusive(entry):
+                original = entry.versions[0]
+                if source is None:
+                    original.file = self.persistence.write_frame(dataset_id, ORIGINAL_FILE, df)
+                    original.opener = self._opener(dataset_id, original.file)
+                else:
+                    original.file = source_file
+                self._persist(entry)
+        return self._insert(entry)
+
+    def get(self, dataset_id):
+        with self._lock:
+            entry = self._datasets.get(dataset_id)
+            if entry is not None:
+                self._datasets.move_to_end(dataset_id)
+
+        if entry is None:
+            entry = self._open(dataset_id)
+            if entry is None:
+                raise DatasetNotFoundError(dataset_id)
+            entry = self._insert(entry)
+        else:
+            with entry.lock:
+                current = self._sync(entry)
+            if not current:
+                # Deleted (or evicted) by another process
+                with self._lock:
+                    self._datasets.pop(dataset_id, None)
+                raise DatasetNotFoundError(dataset_id)
+
+        if self.persistence is not None:
+            self.persistence.touch(dataset_id)
+        return entry
+
+    def get_frame(self, dataset_id, original=False):
+        return self.get(dataset_id).frame(original)
+
+    def _add_version(self, entry, node, columns, changed):
+        """
+        Make ``node`` the current version, a child of the current one;
+        ``changed`` are the ``columns`` whose values differ from the parent's.
+        Call inside ``_exclusive(entry)``.
+        """
+        parent = entry.node
+        node.column_versions = {
+            col: node.version if col in changed else parent.column_versions.get(col, 0)
+            for col in columns
+        }
+        parent.redo_child = node.version
+        entry.versions[node.version] = node
+        entry.version = node.version
+
+        # Keep memoized stats of columns some version still has (version 0 also serves the original frame)
+        live = {(col, version) for other in entry.versions.values() for col, version in other.column_versions.items()}
+        entry.stats_cache = {
+            key: stats for key, stats in entry.stats_cache.items()
+            if key[1] == 0 or (key[0], key[1]) in live
+        }
+        entry.updated_at = datetime.utcnow()
+        if self.persistence is not None:
+            self._persist(entry)
+        self._release_versions(entry)
+
+    def update(self, dataset_id, df, operation=None):
+        """Store ``df`` as a new version, a child of the current one, and make it current."""
+        entry = self.get(dataset_id)
+        with self._exclusive(entry):
+            parent = entry.node
+            node = Version(max(entry.versions) + 1, parent.version, df=df, operation=operation)
+            node.buffers = column_buffers(df, parent.buffers)
+            if self.persistence is not None:
+                original = entry.versions[0]
+                if original.holds(df):
+                    node.file = original.file
+                else:
+                    node.file = self.persistence.write_frame(dataset_id, version_file(node.version), df)
+                node.opener = self._opener(dataset_id, node.file)
+            self._add_version(entry, node, df.columns, changed_columns(parent.frame(), df))
+        return entry
+
+    def transform(self, dataset_id, func, operation=None):
+        """
+        Apply ``func(df) -> new_df`` to the current frame and store the result.
+
+        The dataset's lock (and file lock) is held for the whole call so
+        concurrent transformations of the same dataset, in this process or
+        another, are applied one after another instead of overwriting each other.
+        """
+        entry = self.get(dataset_id)
+        with self._exclusive(entry):
+            return self.update(dataset_id, func(entry.current), operation)
+
+    def transform_out_of_core(self, dataset_id, func, operation=None):
+        """
+        ``transform`` for frames too big to load: ``func(source_path,
+        output_path)`` writes the new version as a ``PartitionedDataset`` at
+        ``output_path`` from the current version's file at ``source_path``,
+        and returns the columns whose values it changed (None for all of them).
+        The current frame is never loaded.
+        """
+        if self.persistence is None:
+            raise ApiError('Out-of-core transformations need persisted datasets')
+        entry = self.get(dataset_id)
+        with self._exclusive(entry):
+            parent = entry.node
+            if parent.file is None:
+                raise ApiError(f'Version {parent.version} has no file to transform')
+            version = max(entry.versions) + 1
+            file = version_parts(version)
+            changed = func(self.persistence.frame_path(dataset_id, parent.file),
+                           self.persistence.frame_path(dataset_id, file))
+            node = Version(version, parent.version, operation=operation, file=file,
+                           opener=self._opener(dataset_id, file))
+            columns = node.source.columns
+            self._add_version(entry, node, columns, columns if changed is None else changed)
+        return entry
+
+    def reset(self, dataset_id):
+        entry = self.get(dataset_id)
+        with self._exclusive(entry):
+            return self.update(dataset_id, entry.original, 'reset')
+
+    def checkout(self, dataset_id, version):
+        """Make an existing version current again."""
+        entry = self.get(dataset_id)
+        with self._exclusive(entry):
+            if version not in entry.versions:
+                raise ApiError(f'Version {version} not found', 404)
+            # Load it first, so an unavailable version leaves the current one in place
+            entry.versions[version].frame()
+            entry.version = version
+            entry.updated_at = datetime.utcnow()
+            if self.persistence is not None:
+                self._persist(entry)
+            self._release_versions(entry)
+        return entry
+
+    def undo(self, dataset_id):
+        entry = self.get(dataset_id)
+        with self._exclusive(entry):
+            node = entry.node
+            if node.parent is None:
+                raise ApiError('Nothing to undo')
+            entry.versions[node.parent].redo_child = node.version
+            return self.checkout(dataset_id, node.parent)
+
+    def redo(self, dataset_id):
+        entry = self.get(dataset_id)
+        with self._exclusive(entry):
+            if entry.node.redo_child is None:
+                raise ApiError('Nothing to redo')
+            return self.checkout(dataset_id, entry.node.redo_child)
+
+    def delete(self, dataset_id):
+        with self._lock:
+            entry = self._datasets.pop(dataset_id, None)
+        if self.persistence is not None:
+            if entry is None and self.persistence.load_record(dataset_id) is None:
+                raise DatasetNotFoundError(dataset_id)
+            self.persistence.delete(dataset_id)
+        elif entry is None:
+            raise DatasetNotFoundError(dataset_id)
+
+    def memory_usage(self):
+        """Datasets and versions held in memory, and the bytes they retain."""
+        with self._lock:
+            entries = list(self._datasets.values())
+        versions = retained = 0
+        for entry in entries:
+            with entry.lock:
+                versions += sum(1 for node in entry.versions.values() if node.loaded)
+                retained += entry.retained_bytes()
+        return {'datasets': len(entries), 'versions': versions, 'bytes': retained}
+
+    def list(self):
+        with self._lock:
+            entries = list(self._datasets.values())
+        if self.persistence is not None:
+            # Persisted datasets that aren't in memory are listed without loading them
+            held = {entry.dataset_id for entry in entries}
+            entries += [self._open(dataset_id) for dataset_id in self.persistence.dataset_ids()
+                        if dataset_id not in held]
+        return [entry.metadata() for entry in entries if entry is not None]
@@ -0,0 +1,85 @@
+"""
+Delta responses: what a transformation changed, instead of the rows it produced.
+
+A client holding the first ``window`` rows of a frame (all of it, for
+inline ``data`` requests; the preview, for stored datasets) can bring them
+up to date from:
+
+- ``columns``: the values, for those rows, of the columns the
+  transformation added or replaced (``/math/add`` and friends);
+- ``dropped_rows``: the positions, among those rows, of the rows it
+  removed (``/clean/remove-null``, ``/clean/remove-duplicate``), as
+  ``[start, length]`` runs or a bitmap, whichever is smaller;
+  ``appended_rows`` are the rows that move up into the window to take
+  their place.
+
+Transformations that change the frame in any other way (renaming, row
+order, ...) have no delta; their response is the usual one.
+"""
+import base64
+
+import numpy as np
+
+from dataset_store import changed_columns
+from serialization import column_values, serialize_frame
+
+
+def encode_positions(positions, length):
+    """
+    Ascending row ``positions`` out of ``length`` rows as
+    ``{'encoding': 'runs', 'runs': [[start, length], ...]}`` or, when that
+    would be larger, ``{'encoding': 'bitmap', 'length': ..., 'bitmap': ...}``
+    (base64, bit ``i % 8`` of byte ``i // 8`` set for row ``i``).
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    if len(positions) == 0:
+        return {'encoding': 'runs', 'runs': []}
+
+    breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+    starts = positions[np.r_[0, breaks]]
+    ends = positions[np.r_[breaks - 1, len(positions) - 1]]
+
+    # A run is two numbers of at most len(str(length)) digits plus '[,],' in JSON
+    runs_chars = len(starts) * (2 * len(str(length)) + 4)
+    bitmap_chars = -(-length // 8) * 4 // 3
+    if runs_chars <= bitmap_chars:
+        return {'encoding': 'runs', 'runs': np.column_stack([starts, ends - starts + 1]).tolist()}
+
+    bits = np.zeros(length, dtype=bool)
+    bits[positions] = True
+    return {
+        'encoding': 'bitmap',
+        'length': length,
+        'bitmap': base64.b64encode(np.packbits(bits, bitorder='little')).decode('ascii'),
+    }
+
+
+def frame_delta(before, after, window=None, orient='records'):
+    """
+    The delta taking the first ``window`` rows of ``before`` (all of them
+    by default) to the first ``window`` rows of ``after``, or None if
+    ``after`` is not ``before`` with columns added/replaced or rows dropped.
+    """
+    window = len(before) if window is None else min(window, len(before))
+
+    if len(after) == len(before) and after.index.equals(before.index):
+        if not set(before.columns) <= set(after.columns) or not after.columns.is_unique:
+            return None
+        changed = changed_columns(before, after)
+        head = after.iloc[:window]
+        return {'window_rows': window, 'columns': {col: column_values(head[col]) for col in changed}}
+
+    if list(after.columns) != list(before.columns) or not before.index.is_unique:
+        return None
+    kept = before.index.isin(after.index)
+    # Dropping rows keeps the order of the rest
+    if kept.sum() != len(after) or not before.index[kept].equals(after.index):
+        return None
+
+    dropped = np.flatnonzero(~kept[:window])
+    kept_in_window = window - len(dropped)
+    return {
+        'window_rows': window,
+        'dropped_rows': encode_positions(dropped, window),
+        'appended_rows': serialize_frame(after.iloc[kept_in_window:window], orient),
+    }
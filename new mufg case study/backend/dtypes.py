@@ -0,0 +1,199 @@
+"""
+Column type helpers: choosing compact dtypes for ingested data, measuring
+what they save, converting columns to numbers safely for arithmetic, and
+conforming new rows to a stored frame's columns.
+"""
+import numpy as np
+import pandas as pd
+from pandas.api.types import (
+    infer_dtype, is_bool_dtype, is_datetime64_any_dtype, is_float_dtype, is_integer_dtype, is_numeric_dtype,
+    is_object_dtype
+)
+
+from config import (
+    CATEGORY_MAX_RATIO, COMPACT_DTYPES, DOWNCAST_FLOATS, FLOAT32_TOLERANCE, TEXT_DTYPE
+)
+
+# Frames read back from Parquet/Feather restore 'string' columns with this storage
+pd.set_option('mode.string_storage', 'pyarrow')
+
+
+def infer_column_types(sample, category_max_ratio=CATEGORY_MAX_RATIO):
+    """
+    Decide how to read a CSV from a sample of its rows.
+
+    Returns ``(read_dtypes, category_columns)``: columns that hold text in the
+    sample are read as ``object`` in every chunk (so a chunk of digits-only
+    values can't turn a text column numeric), and the low-cardinality ones
+    among them are stored as ``category``.
+    """
+    read_dtypes = {}
+    category_columns = []
+    for col in sample.columns:
+        values = sample[col]
+        if not is_object_dtype(values):
+            continue
+
+        read_dtypes[col] = 'object'
+        non_null = values.dropna()
+        if len(non_null) and non_null.nunique() / len(non_null) <= category_max_ratio:
+            category_columns.append(col)
+    return read_dtypes, category_columns
+
+
+def _downcast_float(values, tolerance):
+    narrowed = values.astype('float32')
+    # NaN compares unequal to itself, so compare the non-null values only
+    valid = values.notna().to_numpy()
+    difference = np.abs(narrowed.to_numpy(dtype='float64')[valid] - values.to_numpy()[valid])
+    return narrowed if not len(difference) or difference.max() <= tolerance else values
+
+
+def compact_frame(df, category_columns=(), text_dtype=None, downcast_floats=DOWNCAST_FLOATS):
+    """
+    Return ``df`` with compact dtypes: integers downcast to the smallest type
+    that holds their values, the given text columns as ``category`` and the
+    remaining all-text columns as ``text_dtype`` (if given). Floats are left at
+    64 bits so monetary values keep their precision, unless
+    ``downcast_floats`` and float32 holds them within ``FLOAT32_TOLERANCE``.
+    """
+    converted = {}
+    for col in df.columns:
+        values = df[col]
+        if col in category_columns:
+            converted[col] = values.astype('category')
+        elif is_integer_dtype(values):
+            converted[col] = pd.to_numeric(values, downcast='integer')
+        elif downcast_floats and is_float_dtype(values) and values.dtype.itemsize > 4:
+            converted[col] = _downcast_float(values, FLOAT32_TOLERANCE)
+        elif (text_dtype and is_object_dtype(values) and
+              infer_dtype(values, skipna=True) in ('string', 'empty')):
+            converted[col] = values.astype(text_dtype)
+    return df.assign(**converted) if converted else df
+
+
+def optimize_frame(df):
+    """
+    Compact dtypes for a frame built in memory (an upload, inline request
+    rows), with the configured thresholds; returns ``df`` unchanged when
+    ``COMPACT_DTYPES`` is off.
+    """
+    if not COMPACT_DTYPES:
+        return df
+    _, category_columns = infer_column_types(df)
+    return compact_frame(df, category_columns, TEXT_DTYPE)
+
+
+def widen_numeric(dtype, other):
+    """
+    The dtype holding the values of both numpy integer or float dtypes
+    (int8 and int16: int16; int16 and float64: float64), or None when
+    either is not one.
+    """
+    if isinstance(dtype, np.dtype) and isinstance(other, np.dtype) and dtype.kind in 'iuf' and other.kind in 'iuf':
+        return np.promote_types(dtype, other)
+    return None
+
+
+def unify_dtypes(dtype, other):
+    """
+    The dtype for a column that has ``dtype`` in some parts and ``other``
+    in others: the same, the wider number dtype (``widen_numeric``), or
+    object (bool parts and parts with nulls, read as objects).
+    """
+    if dtype == other or (isinstance(dtype, pd.CategoricalDtype) and isinstance(other, pd.CategoricalDtype)):
+        return dtype
+    widened = widen_numeric(dtype, other)
+    return np.dtype(object) if widened is None else widened
+
+
+def _default_dtype(series):
+    """``series`` with the dtype pandas gives it without compaction."""
+    dtype = series.dtype
+    if isinstance(dtype, (pd.CategoricalDtype, pd.StringDtype)):
+        return series.astype(object)
+    if is_integer_dtype(dtype) and dtype.itemsize < 8:
+        return series.astype('Int64' if isinstance(dtype, pd.api.extensions.ExtensionDtype) else 'int64')
+    if is_float_dtype(dtype) and dtype.itemsize < 8:
+        return series.astype('float64')
+    return series
+
+
+def memory_report(df):
+    """Per-column bytes of ``df`` as stored and with pandas' default dtypes."""
+    columns = []
+    for col in df.columns:
+        values = df[col]
+        default = _default_dtype(values)
+        columns.append({
+            'name': str(col),
+            'dtype': str(values.dtype),
+            'bytes': int(values.memory_usage(index=False, deep=True)),
+            'default_dtype': str(default.dtype),
+            'default_bytes': int(default.memory_usage(index=False, deep=True)),
+        })
+
+    total = sum(column['bytes'] for column in columns)
+    default_total = sum(column['default_bytes'] for column in columns)
+    return {
+        'rows': len(df),
+        'columns': columns,
+        'total_bytes': total,
+        'default_total_bytes': default_total,
+        'saved_fraction': round(1 - total / default_total, 4) if default_total else 0.0,
+    }
+
+
+def to_numeric(values):
+    """
+    ``pd.to_numeric(values, errors='coerce')`` with small integer types widened
+    to 64 bits, so arithmetic on compacted columns cannot overflow.
+    """
+    numeric = pd.to_numeric(values, errors='coerce')
+    if is_integer_dtype(numeric) and numeric.dtype.itemsize < 8:
+        numeric = numeric.astype('Int64' if isinstance(numeric.dtype, pd.api.extensions.ExtensionDtype) else 'int64')
+    return numeric
+
+
+def _conform_column(values, dtype):
+    """``values`` as the kind of column ``dtype`` is, or unchanged where converting would lose values."""
+    kind = infer_dtype(values, skipna=True)
+    try:
+        if isinstance(dtype, pd.CategoricalDtype):
+            if kind == 'empty' or kind == infer_dtype(dtype.categories):
+                # Categories of the same dtype, which union_categoricals requires
+                return values.astype(dtype.categories.dtype).astype('category')
+        elif isinstance(dtype, pd.StringDtype):
+            if kind in ('string', 'empty'):
+                return values.astype(dtype)
+        elif is_datetime64_any_dtype(dtype):
+            if not is_datetime64_any_dtype(values):
+                return pd.to_datetime(values)
+        elif is_numeric_dtype(dtype) and not is_bool_dtype(dtype):
+            if not is_numeric_dtype(values):
+                return pd.to_numeric(values.astype(object))
+    except (TypeError, ValueError):
+        pass
+    return values
+
+
+def conform_frame(df, like):
+    """
+    ``df`` with the columns of ``like``, in its order, to be appended to it:
+    columns ``df`` lacks are all null, and the others are converted (where
+    no value is lost) to the kind of column ``like`` has, so concatenating
+    them keeps category, text, date and number columns as they are rather
+    than turning them into ``object``.
+    """
+    columns = {}
+    for col in like.columns:
+        dtype = like[col].dtype
+        if col in df.columns:
+            columns[col] = _conform_column(df[col], dtype)
+        elif is_bool_dtype(dtype):
+            columns[col] = pd.Series(None, index=df.index, dtype=object)
+        elif is_integer_dtype(dtype):
+            columns[col] = pd.Series(np.nan, index=df.index)
+        else:
+            columns[col] = pd.Series(index=df.index, dtype=dtype)
+    return pd.DataFrame(columns, index=df.index)
@@ -0,0 +1,10 @@
+class ApiError(Exception):
+    """An error that is reported to the client as ``{'error': message}`` with ``status_code``."""
+
+    status_code = 400
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.message = message
+        if status_code is not None:
+            self.status_code = status_code
@@ -0,0 +1,129 @@
+"""
+Streamed dataset export.
+
+Each exporter is a generator of byte chunks that reads the frame
+``chunk_rows`` rows at a time, so a Flask response can send the file while
+it is being produced and only one chunk's worth of output is held in memory:
+
+- CSV: the header, then one ``to_csv`` block per chunk.
+- Parquet: one row group per chunk, flushed to the client as it is written.
+- XLSX: openpyxl's write-only mode, which spools rows to a temporary file
+  instead of building cell objects. The zip container can only be
+  assembled once every row is written, so the first byte of an XLSX export
+  arrives at the end; memory still stays flat.
+"""
+import io
+import tempfile
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from config import EXPORT_CHUNK_ROWS
+from errors import ApiError
+from serialization import frame_to_arrow_table
+
+# Size of the pieces a finished file is streamed in
+STREAM_BLOCK_BYTES = 1024 * 1024
+
+
+def iter_chunks(df, chunk_rows=EXPORT_CHUNK_ROWS, progress=None):
+    """Row slices of ``df``; ``progress(rows_done, total_rows)`` is called after each."""
+    for start in range(0, len(df), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows]
+        yield chunk
+        if progress is not None:
+            progress(start + len(chunk), len(df))
+
+
+class _ChunkSink(io.RawIOBase):
+    """A write-only file whose written bytes are collected until ``drain``."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def export_csv(df, chunk_rows=EXPORT_CHUNK_ROWS, progress=None):
+    yield df.head(0).to_csv(index=False).encode()
+    for chunk in iter_chunks(df, chunk_rows, progress):
+        yield chunk.to_csv(index=False, header=False).encode()
+
+
+def _arrow_schema(df):
+    # Inferred from the whole frame, so a chunk of nulls can't fix a column's type
+    try:
+        return pa.Schema.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return frame_to_arrow_table(df).schema
+
+
+def export_parquet(df, chunk_rows=EXPORT_CHUNK_ROWS, progress=None):
+    sink = _ChunkSink()
+    schema = _arrow_schema(df)
+    with pq.ParquetWriter(sink, schema) as writer:
+        for chunk in iter_chunks(df, chunk_rows, progress):
+            writer.write_table(frame_to_arrow_table(chunk).cast(schema))
+            yield sink.drain()
+    # The footer is written on close
+    yield sink.drain()
+
+
+def _excel_rows(chunk):
+    # openpyxl writes None as an empty cell; NaN/NaT/pd.NA would fail or show as text
+    values = chunk.astype(object).where(chunk.notna(), None)
+    return values.itertuples(index=False, name=None)
+
+
+def export_xlsx(df, chunk_rows=EXPORT_CHUNK_ROWS, progress=None, sheet_name='TransformedData'):
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(sheet_name)
+    sheet.append([str(col) for col in df.columns])
+    try:
+        for chunk in iter_chunks(df, chunk_rows, progress):
+            for row in _excel_rows(chunk):
+                sheet.append(row)
+    except BaseException:
+        # Finish the sheet's spool file before it is discarded
+        sheet.close()
+        raise
+
+    with tempfile.TemporaryFile() as output:
+        workbook.save(output)
+        output.seek(0)
+        while True:
+            block = output.read(STREAM_BLOCK_BYTES)
+            if not block:
+                break
+            yield block
+
+
+EXPORT_FORMATS = {
+    'xlsx': ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', export_xlsx),
+    'csv': ('text/csv', export_csv),
+    'parquet': ('application/vnd.apache.parquet', export_parquet),
+}
+
+
+def exporter(file_format):
+    """``(mimetype, export function)`` for a format name."""
+    if file_format not in EXPORT_FORMATS:
+        raise ApiError(f"Unsupported format '{file_format}', expected one of {', '.join(EXPORT_FORMATS)}")
+    return EXPORT_FORMATS[file_format]
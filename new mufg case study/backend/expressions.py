@@ -0,0 +1,512 @@
+"""
+Derived columns from arithmetic and conditional expressions.
+
+An expression is written over a frame's column names, as in
+
+    (revenue - cost) / revenue
+    where(region == 'APAC', revenue * 0.9, revenue)
+    cost if cost > 0 else null
+
+and several of them, each naming its result column, are computed in one
+pass; an expression may use another's result by its name. Only this
+grammar is accepted (the text is parsed with ``ast``, never evaluated as
+Python): numbers, ``True``/``False``/``null``, column names (backquoted
+when they aren't identifiers: ```net amount` * 2``), ``+ - * / // % **``,
+comparisons, ``and``/``or``/``not``, ``a if condition else b`` and the
+functions in ``FUNCTIONS``.
+
+An expression compiles once into a tree of numpy operations, which runs
+``chunk_rows`` rows at a time, so temporaries are bounded by the chunk
+rather than the frame and stay in cache between operations. Columns are
+converted with ``dtypes.to_numeric``, as by the two-column arithmetic
+operations; text columns can only be compared with text (``region ==
+'APAC'``, ``product in ['FX', 'Cards']``).
+
+Nulls propagate through arithmetic and comparisons, and division (``/``,
+``//``, ``%``) by zero gives null, as ``/math/divide`` does; ``and`` and
+``or`` treat null as unknown (``null and False`` is False), and a null
+condition takes the else branch. Numeric results with nulls are float64
+with NaN; comparisons give booleans (nullable 'boolean' when they have nulls).
+"""
+import ast
+import functools
+import operator
+import re
+
+import numpy as np
+import pandas as pd
+
+from config import EXPRESSION_CHUNK_ROWS
+from dtypes import to_numeric
+from errors import ApiError
+
+# Nesting depth beyond which an expression is refused rather than recursed into
+MAX_EXPRESSION_DEPTH = 64
+
+NULL_NAMES = ('null', 'None')
+
+_NULL = (np.float64(np.nan), np.True_)
+
+_COMPARISONS = {
+    ast.Eq: operator.eq, ast.NotEq: operator.ne, ast.Lt: operator.lt,
+    ast.LtE: operator.le, ast.Gt: operator.gt, ast.GtE: operator.ge,
+}
+
+# Comparisons text columns support, against text constants
+_TEXT_COMPARISONS = (ast.Eq, ast.NotEq, ast.In, ast.NotIn)
+
+
+def _union(*masks):
+    """The positions null in any of ``masks`` (None: no nulls)."""
+    masks = [mask for mask in masks if mask is not None]
+    if not masks:
+        return None
+    return functools.reduce(operator.or_, masks)
+
+
+def _nulls(value):
+    """The null positions of a value: its mask, and its NaN if it is float."""
+    values, mask = value
+    if values.dtype.kind != 'f':
+        return mask
+    nan = np.isnan(values)
+    return nan if mask is None else nan | mask
+
+
+def _truth(value):
+    """``(true, false)`` positions of a condition, both False where it is null."""
+    values, mask = value[0], _nulls(value)
+    true = values if values.dtype == bool else values != 0
+    if mask is None:
+        return true, ~true
+    known = ~mask
+    return true & known, ~true & known
+
+
+# Operations on (values, mask) pairs: ``values`` a numpy array or scalar, ``mask`` the null
+# positions or None. Values under the mask are unspecified; NaN in float values are null too,
+# and left to propagate through arithmetic on their own.
+
+def _arithmetic(func):
+    def apply(a, b):
+        with np.errstate(all='ignore'):
+            return func(a[0], b[0]), _union(a[1], b[1])
+    return apply
+
+
+def _by_nonzero(func):
+    """``func(a, b)`` with null where ``b`` is zero."""
+    def apply(a, b):
+        zero = b[0] == 0
+        divisor = np.where(zero, 1, b[0]) if np.any(zero) else b[0]
+        with np.errstate(all='ignore'):
+            return func(a[0], divisor), _union(a[1], b[1], zero if np.any(zero) else None)
+    return apply
+
+
+def _power(a, b):
+    # Integer powers with negative exponents are fractions; 0 to a negative power divides by zero
+    zero = (a[0] == 0) & (b[0] < 0)
+    with np.errstate(all='ignore'):
+        return np.float_power(a[0], b[0]), _union(a[1], b[1], zero if np.any(zero) else None)
+
+
+_BINARY = {
+    ast.Add: _arithmetic(np.add),
+    ast.Sub: _arithmetic(np.subtract),
+    ast.Mult: _arithmetic(np.multiply),
+    ast.Pow: _power,
+    ast.Div: _by_nonzero(np.true_divide),
+    ast.FloorDiv: _by_nonzero(np.floor_divide),
+    ast.Mod: _by_nonzero(np.mod),
+}
+
+
+def _compare(func):
+    def apply(a, b):
+        with np.errstate(all='ignore'):
+            return func(a[0], b[0]), _union(_nulls(a), _nulls(b))
+    return apply
+
+
+def _and(a, b):
+    a_true, a_false = _truth(a)
+    b_true, b_false = _truth(b)
+    values = a_true & b_true
+    if _nulls(a) is None and _nulls(b) is None:
+        return values, None
+    return values, ~(values | a_false | b_false)
+
+
+def _or(a, b):
+    a_true, a_false = _truth(a)
+    b_true, b_false = _truth(b)
+    values = a_true | b_true
+    if _nulls(a) is None and _nulls(b) is None:
+        return values, None
+    return values, ~(values | (a_false & b_false))
+
+
+def _not(a):
+    true, _ = _truth(a)
+    return ~true, _nulls(a)
+
+
+def _where(condition, a, b):
+    true, _ = _truth(condition)
+    mask = None
+    if a[1] is not None or b[1] is not None:
+        mask = np.where(true, a[1] if a[1] is not None else False, b[1] if b[1] is not None else False)
+    return np.where(true, a[0], b[0]), mask
+
+
+def _unary(func):
+    def apply(a):
+        with np.errstate(all='ignore'):
+            return func(a[0]), a[1]
+    return apply
+
+
+def _round(a, digits=(0, None)):
+    if digits[1] is not None or np.ndim(digits[0]):
+        raise ApiError('round() takes a constant number of digits')
+    return np.round(a[0], int(digits[0])), a[1]
+
+
+def _extreme(func):
+    def apply(*args):
+        return functools.reduce(_arithmetic(func), args)
+    return apply
+
+
+def _coalesce(*args):
+    values, mask = args[-1][0], _nulls(args[-1])
+    for value in reversed(args[:-1]):
+        nulls = _nulls(value)
+        if nulls is None:
+            values, mask = value[0], None
+        else:
+            values = np.where(nulls, values, value[0])
+            mask = nulls & mask if mask is not None else None
+    return values, mask
+
+
+def _is_null(a):
+    nulls = _nulls(a)
+    return (np.zeros(np.shape(a[0]), dtype=bool) if nulls is None else np.array(nulls)), None
+
+
+def _not_null(a):
+    values, _ = _is_null(a)
+    return ~values, None
+
+
+# name: (function, minimum arguments, maximum arguments or None for any number)
+FUNCTIONS = {
+    'abs': (_unary(np.abs), 1, 1),
+    'sqrt': (_unary(np.sqrt), 1, 1),
+    'log': (_unary(np.log), 1, 1),
+    'exp': (_unary(np.exp), 1, 1),
+    'floor': (_unary(np.floor), 1, 1),
+    'ceil': (_unary(np.ceil), 1, 1),
+    'round': (_round, 1, 2),
+    'min': (_extreme(np.minimum), 1, None),
+    'max': (_extreme(np.maximum), 1, None),
+    'where': (_where, 3, 3),
+    'coalesce': (_coalesce, 1, None),
+    'is_null': (_is_null, 1, 1),
+    'not_null': (_not_null, 1, 1),
+}
+
+
+class _Chunk:
+    """The rows ``start:stop`` of a frame's columns, and of the expression results computed so far."""
+
+    def __init__(self, columns, start, stop):
+        self.columns = columns
+        self.start = start
+        self.stop = stop
+        self.results = {}
+
+    def numeric(self, name):
+        if name in self.results:
+            return self.results[name]
+        values, mask = self.columns.numeric(name)
+        return values[self.start:self.stop], None if mask is None else mask[self.start:self.stop]
+
+    def text_matches(self, name, values):
+        if name in self.results:
+            raise ApiError(f'{name} is a computed number and cannot be compared with text')
+        matches, mask = self.columns.text_matches(name, values)
+        return matches[self.start:self.stop], None if mask is None else mask[self.start:self.stop]
+
+
+class _Columns:
+    """A frame's columns as numpy values and null masks, converted on first use."""
+
+    def __init__(self, df):
+        self.frame = df
+        self._numeric = {}
+        self._text = {}
+
+    def numeric(self, name):
+        if name not in self._numeric:
+            numbers = to_numeric(self.frame[name])
+            if isinstance(numbers.dtype, pd.api.extensions.ExtensionDtype):
+                mask = numbers.isna().to_numpy()
+                values = numbers.to_numpy(dtype=numbers.dtype.numpy_dtype, na_value=0)
+            else:
+                # NaN are the nulls of a float column
+                values, mask = numbers.to_numpy(), None
+            self._numeric[name] = values, (mask if mask is not None and mask.any() else None)
+        return self._numeric[name]
+
+    def text_matches(self, name, values):
+        """Where a column equals any of the texts ``values``, and its nulls."""
+        key = name, tuple(values)
+        if key not in self._text:
+            series = self.frame[name]
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                # Match the categories once and look the rows up by code (-1, null, picks the False appended)
+                codes = series.cat.codes.to_numpy()
+                matches = np.append(series.cat.categories.isin(values), False)[codes]
+                mask = codes < 0
+            else:
+                matches = series.isin(values).to_numpy(dtype=bool)
+                mask = series.isna().to_numpy()
+            self._text[key] = matches, (mask if mask.any() else None)
+        return self._text[key]
+
+
+class Expression:
+    """One parsed expression; ``columns`` are the names it refers to."""
+
+    def __init__(self, text):
+        self.text = text
+        self.columns = set()
+        self._names = {}
+        # Backquoted names may hold spaces and punctuation: swap them for identifiers first
+        source = re.sub(r'`([^`]+)`', self._placeholder, text.strip())
+        try:
+            tree = ast.parse(source, mode='eval')
+        except SyntaxError as e:
+            raise ApiError(f'Invalid expression {text!r}: {e.msg}')
+        except (RecursionError, MemoryError):
+            raise ApiError('Expression is nested too deeply')
+        self._source = source
+        self._evaluate = self._compile(tree.body, 0)
+
+    def _placeholder(self, match):
+        name = f'_column_{len(self._names)}'
+        self._names[name] = match.group(1)
+        return name
+
+    def _unsupported(self, node):
+        segment = ast.get_source_segment(self._source, node) or self.text
+        for placeholder, name in self._names.items():
+            segment = segment.replace(placeholder, f'`{name}`')
+        return ApiError(f'Unsupported expression: {segment}')
+
+    def _column(self, node):
+        name = self._names.get(node.id, node.id)
+        self.columns.add(name)
+        return name
+
+    @staticmethod
+    def _text_constant(node):
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            return [node.value]
+        if isinstance(node, (ast.List, ast.Tuple)) and node.elts and all(
+                isinstance(element, ast.Constant) and isinstance(element.value, str) for element in node.elts):
+            return [element.value for element in node.elts]
+        return None
+
+    def _compile_text_comparison(self, node):
+        """``column == 'text'``, ``'text' != column``, ``column in ['a', 'b']``."""
+        (op,), left, right = node.ops, node.left, node.comparators[0]
+        if type(op) not in _TEXT_COMPARISONS:
+            raise self._unsupported(node)
+        values = self._text_constant(right)
+        if isinstance(left, ast.Name) and left.id not in NULL_NAMES and values is not None:
+            column = self._column(left)
+        elif isinstance(right, ast.Name) and isinstance(op, (ast.Eq, ast.NotEq)) and self._text_constant(left):
+            column, values = self._column(right), self._text_constant(left)
+        else:
+            raise self._unsupported(node)
+        negate = isinstance(op, (ast.NotEq, ast.NotIn))
+
+        def evaluate(chunk):
+            matches, mask = chunk.text_matches(column, values)
+            return (~matches if negate else matches), mask
+        return evaluate
+
+    def _compile(self, node, depth):
+        if depth > MAX_EXPRESSION_DEPTH:
+            raise ApiError('Expression is nested too deeply')
+        compile_child = functools.partial(self._compile, depth=depth + 1)
+
+        if isinstance(node, ast.Constant):
+            if isinstance(node.value, bool):
+                value = (np.bool_(node.value), None)
+            elif isinstance(node.value, (int, float)):
+                value = (np.array(node.value)[()], None)
+            elif node.value is None:
+                value = _NULL
+            else:
+                raise self._unsupported(node)
+            return lambda chunk: value
+
+        if isinstance(node, ast.Name):
+            if node.id in NULL_NAMES:
+                return lambda chunk: _NULL
+            column = self._column(node)
+            return lambda chunk: chunk.numeric(column)
+
+        if isinstance(node, ast.UnaryOp):
+            operand = compile_child(node.operand)
+            if isinstance(node.op, ast.USub):
+                return lambda chunk: _unary(np.negative)(operand(chunk))
+            if isinstance(node.op, ast.UAdd):
+                return operand
+            if isinstance(node.op, ast.Not):
+                return lambda chunk: _not(operand(chunk))
+            raise self._unsupported(node)
+
+        if isinstance(node, ast.BinOp):
+            func = _BINARY.get(type(node.op))
+            if func is None:
+                raise self._unsupported(node)
+            left, right = compile_child(node.left), compile_child(node.right)
+            return lambda chunk: func(left(chunk), right(chunk))
+
+        if isinstance(node, ast.BoolOp):
+            func = _and if isinstance(node.op, ast.And) else _or
+            operands = [compile_child(value) for value in node.values]
+            return lambda chunk: functools.reduce(func, (operand(chunk) for operand in operands))
+
+        if isinstance(node, ast.Compare):
+            if len(node.ops) == 1 and any(self._text_constant(side) is not None
+                                          for side in (node.left, node.comparators[0])):
+                return self._compile_text_comparison(node)
+            # Chained comparisons (0 < margin <= 1) are an "and" of each pair
+            operands = [compile_child(operand) for operand in [node.left, *node.comparators]]
+            funcs = []
+            for op in node.ops:
+                if type(op) not in _COMPARISONS:
+                    raise self._unsupported(node)
+                funcs.append(_compare(_COMPARISONS[type(op)]))
+
+            def evaluate(chunk):
+                values = [operand(chunk) for operand in operands]
+                return functools.reduce(_and, (func(values[i], values[i + 1]) for i, func in enumerate(funcs)))
+            return evaluate
+
+        if isinstance(node, ast.IfExp):
+            condition, body, orelse = compile_child(node.test), compile_child(node.body), compile_child(node.orelse)
+            return lambda chunk: _where(condition(chunk), body(chunk), orelse(chunk))
+
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+            name = node.func.id
+            if name not in FUNCTIONS:
+                raise ApiError(f"Unknown function {name}(); available: {', '.join(sorted(FUNCTIONS))}")
+            func, least, most = FUNCTIONS[name]
+            if len(node.args) < least or (most is not None and len(node.args) > most):
+                raise ApiError(f'Wrong number of arguments to {name}()')
+            args = [compile_child(arg) for arg in node.args]
+            return lambda chunk: func(*(arg(chunk) for arg in args))
+
+        raise self._unsupported(node)
+
+    def evaluate(self, chunk):
+        return self._evaluate(chunk)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_expression(text):
+    if not isinstance(text, str) or not text.strip():
+        raise ApiError('An expression must be a non-empty string')
+    return Expression(text)
+
+
+def parse_expressions(spec):
+    """
+    ``{result_column: expression, ...}`` as a list of ``(result_column,
+    Expression)`` in order; raises ApiError for anything malformed.
+    """
+    if not isinstance(spec, dict) or not spec:
+        raise ApiError('expressions must be an object of {"result_column": "expression"}')
+    return [(name, compile_expression(text)) for name, text in spec.items()]
+
+
+def _result(values, mask):
+    if mask is None or not mask.any():
+        return values
+    if values.dtype == bool:
+        return pd.arrays.BooleanArray(values, mask)
+    values = values.astype('float64', copy=False)
+    values[mask] = np.nan
+    return values
+
+
+def _evaluation_order(df, expressions):
+    """
+    ``expressions`` ordered so each comes after the results it uses: a name
+    given to a result means that result in the other expressions, and the
+    frame's column in its own.
+    """
+    by_name = dict(expressions)
+    for name, expression in expressions:
+        missing = sorted(expression.columns - set(df.columns) - set(by_name), key=str)
+        if missing:
+            raise ApiError(f"Columns not found: {', '.join(map(str, missing))}")
+
+    ordered, visiting, done = [], set(), set()
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ApiError(f'Expressions refer to each other in a cycle: {name}')
+        visiting.add(name)
+        for dependency in sorted(by_name[name].columns & set(by_name) - {name}, key=str):
+            visit(dependency)
+        visiting.discard(name)
+        done.add(name)
+        ordered.append((name, by_name[name]))
+
+    for name, _ in expressions:
+        visit(name)
+    return ordered
+
+
+def evaluate_expressions(df, expressions, chunk_rows=EXPRESSION_CHUNK_ROWS):
+    """
+    The columns ``expressions`` (from ``parse_expressions``) compute over
+    ``df``, as a dict of result column name to values, in the order given.
+    """
+    names = [name for name, _ in expressions]
+    expressions = _evaluation_order(df, expressions)
+
+    columns = _Columns(df)
+    rows = len(df)
+    parts = {name: [] for name, _ in expressions}
+    for start in range(0, rows, chunk_rows) if rows else [0]:
+        chunk = _Chunk(columns, start, min(start + chunk_rows, rows))
+        for name, expression in expressions:
+            values, mask = expression.evaluate(chunk)
+            size = chunk.stop - chunk.start
+            values = np.broadcast_to(values, (size,)) if np.ndim(values) == 0 else values
+            mask = None if mask is None else np.broadcast_to(mask, (size,))
+            chunk.results[name] = values, mask
+            parts[name].append((values, mask))
+
+    results = {}
+    for name in names:
+        chunks = parts[name]
+        values = np.concatenate([values for values, _ in chunks])
+        mask = None
+        if any(mask is not None for _, mask in chunks):
+            mask = np.concatenate([np.zeros(len(values), dtype=bool) if mask is None else mask
+                                   for values, mask in chunks])
+        results[name] = _result(values, mask)
+    return results
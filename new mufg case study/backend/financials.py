@@ -0,0 +1,207 @@
+"""
+Period P&L aggregation shared by the /advanced/pl endpoints and their
+background jobs, on top of the time bucketing in time_buckets.py.
+
+Totals are sums per period code, so a large frame can be aggregated chunk
+by chunk and the partial totals merged (``merge_period_totals``) with the
+same result as aggregating it at once.
+
+Stored datasets also keep materialized aggregates (``PlAggregate``): for
+one choice of revenue, cost and optional tax and date columns, the totals
+the gross and net profit endpoints report and revenue and cost summed per
+day, from which any period report is rolled up in O(days). They are
+memoized in the dataset's ``stats_cache`` under the versions of their
+columns, like column statistics. A version made by appending rows holds its
+parent's rows followed by the new ones, so its aggregates are the parent's
+merged with those of the new rows alone (``pl_aggregate``), their dates
+parsed with the format inferred for the whole column.
+"""
+import pandas as pd
+
+from dtypes import to_numeric
+from errors import ApiError
+from time_buckets import NS_PER_DAY, bucket_labels, bucket_sums, date_index, infer_date_format, parse_epoch
+
+# Operation name of versions that add rows after their parent's
+APPEND_OPERATION = 'append'
+
+# Response keys of the single-period endpoints
+PERIOD_RESULT_KEYS = {'month': 'monthly_data', 'quarter': 'quarterly_data'}
+
+
+def check_columns(available, *columns):
+    if any(col not in available for col in columns):
+        raise ApiError('Required columns not found')
+
+
+def period_totals(df, date_col, revenue_col, cost_col, periods, fiscal_year_start=1, epoch=None, rows=None):
+    """
+    ``{period: totals}`` with revenue and cost summed per period code for
+    each granularity in ``periods``; rows with invalid dates are dropped.
+    ``epoch`` is the already parsed date column, if there is one; ``rows``
+    the positions of the rows to aggregate, if not all of them.
+    """
+    def column(name):
+        return df[name] if rows is None else df[name].iloc[rows]
+
+    if epoch is None:
+        epoch = parse_epoch(column(date_col))
+    elif rows is not None:
+        epoch = epoch[rows]
+    values = {
+        'revenue': to_numeric(column(revenue_col)).to_numpy(dtype='float64', na_value=0.0),
+        'cost': to_numeric(column(cost_col)).to_numpy(dtype='float64', na_value=0.0),
+    }
+    return {period: bucket_sums(epoch, values, period, fiscal_year_start) for period in periods}
+
+
+def merge_period_totals(totals):
+    """Combine the ``period_totals`` of one period across several chunks."""
+    totals = [t for t in totals if len(t)]
+    if not totals:
+        return pd.DataFrame(columns=['revenue', 'cost'])
+    return pd.concat(totals).groupby(level=0).sum()
+
+
+def period_rows(totals, period, fiscal_year_start=1):
+    """``[{period: label, 'revenue', 'cost', 'profit'}]`` in period order."""
+    totals = totals.sort_index()
+    labels = bucket_labels(totals.index.to_numpy(), period, fiscal_year_start)
+    revenue = totals['revenue'].to_numpy(dtype='float64')
+    cost = totals['cost'].to_numpy(dtype='float64')
+    profit = revenue - cost
+    return [
+        {period: label, 'revenue': r, 'cost': c, 'profit': p}
+        for label, r, c, p in zip(labels, revenue.tolist(), cost.tolist(), profit.tolist())
+    ]
+
+
+def pl_report(totals, fiscal_year_start=1, result_key=None):
+    """
+    The report for ``{period: totals}``: rows of the single period
+    under ``result_key`` (e.g. 'monthly_data'), or rows of every period
+    under 'periods'.
+    """
+    reports = {period: period_rows(t, period, fiscal_year_start) for period, t in totals.items()}
+    if result_key is not None:
+        return {result_key: next(iter(reports.values()))}
+    return {'fiscal_year_start': fiscal_year_start, 'periods': reports}
+
+
+class PlAggregate:
+    """
+    Totals of a frame's revenue, cost (and tax) columns, and revenue and
+    cost summed per day of its date column when it has one (``days``,
+    indexed by day code, and ``date_format`` the format its dates were
+    parsed with). ``rows`` is the number of rows aggregated.
+    """
+
+    def __init__(self, rows, totals, days=None, date_format=None):
+        self.rows = rows
+        self.totals = totals
+        self.days = days
+        self.date_format = date_format
+
+    @classmethod
+    def compute(cls, df, revenue_col, cost_col, tax_col=None, date_col=None, epoch=None, date_format=None):
+        """
+        Aggregate ``df``; ``epoch`` is its already parsed date column, if
+        there is one, and ``date_format`` the format to parse the dates
+        with (by default the one inferred from them).
+        """
+        revenue = to_numeric(df[revenue_col])
+        cost = to_numeric(df[cost_col])
+        gross_profit = revenue - cost
+        totals = {
+            'total_revenue': float(revenue.sum()),
+            'total_cost': float(cost.sum()),
+            'total_gross_profit': float(gross_profit.sum()),
+        }
+        if tax_col is not None:
+            tax = to_numeric(df[tax_col])
+            totals['total_tax'] = float(tax.sum())
+            totals['total_net_profit'] = float((gross_profit - tax).sum())
+
+        days = None
+        if date_col is not None:
+            if date_format is None:
+                date_format = infer_date_format(df[date_col])
+            if epoch is None:
+                epoch = parse_epoch(df[date_col], date_format)
+            values = {
+                'revenue': revenue.to_numpy(dtype='float64', na_value=0.0),
+                'cost': cost.to_numpy(dtype='float64', na_value=0.0),
+            }
+            days = bucket_sums(epoch, values, 'day')
+        return cls(len(df), totals, days, date_format)
+
+    def merge(self, other):
+        """The aggregate of this aggregate's rows followed by ``other``'s."""
+        totals = {key: value + other.totals[key] for key, value in self.totals.items()}
+        days = None if self.days is None else merge_period_totals([self.days, other.days])
+        return PlAggregate(self.rows + other.rows, totals, days, self.date_format)
+
+    def period_totals(self, periods, fiscal_year_start=1):
+        """``period_totals`` of the aggregated rows, from the daily sums."""
+        epoch = self.days.index.to_numpy(dtype='int64') * NS_PER_DAY
+        values = {name: self.days[name].to_numpy(dtype='float64') for name in ('revenue', 'cost')}
+        return {period: bucket_sums(epoch, values, period, fiscal_year_start) for period in periods}
+
+
+def _aggregate_key(node, columns):
+    """stats_cache key of the aggregate of ``columns`` (revenue, cost, tax, date) at version ``node``."""
+    revenue_col, cost_col, tax_col, date_col = columns
+    versions = [None if col is None else node.column_versions.get(col, 0) for col in columns]
+    return (revenue_col, versions[0], 'pl', cost_col, versions[1], tax_col, versions[2], date_col, versions[3])
+
+
+def pl_aggregate(entry, revenue_col, cost_col, tax_col=None, date_col=None):
+    """
+    The memoized ``PlAggregate`` of a stored dataset's current version.
+    Returns ``(aggregate, cached)``.
+
+    If it isn't memoized but the version was made by appends to one whose
+    aggregate is, only the rows appended since are aggregated, their dates
+    parsed with the format of that aggregate's (as pandas would infer it
+    for the whole column, not for the new rows alone).
+    """
+    columns = (revenue_col, cost_col, tax_col, date_col)
+    with entry.lock:
+        node = entry.node
+        key = _aggregate_key(node, columns)
+        aggregate = entry.stats_cache.get(key)
+        if aggregate is not None:
+            return aggregate, True
+
+        base, ancestor = None, node
+        while base is None and ancestor.operation == APPEND_OPERATION and ancestor.parent in entry.versions:
+            ancestor = entry.versions[ancestor.parent]
+            base = entry.stats_cache.get(_aggregate_key(ancestor, columns))
+        df = node.frame()
+    check_columns(df.columns, revenue_col, cost_col, *(col for col in (tax_col, date_col) if col is not None))
+
+    if base is not None and base.rows <= len(df):
+        aggregate = base.merge(PlAggregate.compute(df.iloc[base.rows:], *columns, date_format=base.date_format))
+    else:
+        epoch = date_index(entry, date_col)[0] if date_col is not None else None
+        aggregate = PlAggregate.compute(df, *columns, epoch=epoch)
+    entry.stats_cache[key] = aggregate
+    return aggregate, False
+
+
+def refresh_pl_aggregates(entry):
+    """
+    After rows were appended, bring the aggregates memoized for the previous
+    version up to date from the new rows; returns how many there were.
+    """
+    with entry.lock:
+        node = entry.node
+        parent = entry.versions.get(node.parent)
+        if parent is None:
+            return 0
+        specs = {(key[0], key[3], key[5], key[7]) for key in entry.stats_cache
+                 if len(key) == 9 and key[2] == 'pl'}
+        specs = [columns for columns in specs if _aggregate_key(parent, columns) in entry.stats_cache]
+    for columns in specs:
+        pl_aggregate(entry, *columns)
+    return len(specs)
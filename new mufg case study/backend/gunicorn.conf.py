@@ -0,0 +1,29 @@
+"""
+Production serving with gunicorn: pre-forked worker processes, each with a
+few threads.
+
+    cd backend
+    gunicorn -c gunicorn.conf.py app:app
+
+Workers share datasets, recipes and background job state through DATA_DIR:
+dataset versions are memory-mapped Feather files, so every worker serves
+every dataset from the same page-cache pages instead of its own copy.
+DATA_DIR must therefore be the same local directory for all workers.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count()))
+# Threads overlap I/O (uploads, streamed downloads) within a worker; pandas work scales with workers
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 4))
+# Large uploads and exports can take minutes
+timeout = int(os.environ.get('WEB_TIMEOUT', 300))
+graceful_timeout = 30
+# Recycle workers now and then so memory from released versions is returned to the OS
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 2000))
+max_requests_jitter = max_requests // 10
+# Each worker creates its own job pool and caches after forking
+preload_app = False
+accesslog = '-'
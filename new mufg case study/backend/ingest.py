@@ -0,0 +1,162 @@
+"""
+Streaming CSV ingest.
+
+Instead of ``pd.read_csv`` on the whole upload, the file is read
+``chunk_rows`` rows at a time with column types fixed from a sample of the
+first rows. Each chunk is converted to compact dtypes and appended to a
+``PartitionedDataset`` on disk, so peak memory is bounded by the chunk
+size rather than the file size. With ``sketch`` each chunk is also
+sketched (``sketches.FrameSketch``) and the sketches merged, so the
+dataset's approximate statistics are ready when the upload completes.
+
+Every column gets one dtype for the whole file, the kind reading it whole
+would give. Chunks are written with the dtype their columns have needed so
+far (``dtypes.unify_dtypes``: int16 once a chunk held values int8 can't,
+float64 once one held a fraction or a null, object for booleans once one
+held a null), and the few parts written before a column changed are
+rewritten with its final dtype, which the dataset's schema records. A
+column read as numbers (or all null) in the sample that turns out to hold
+text is text throughout: the file is read again from the start with that
+column read as text.
+"""
+import os
+import shutil
+
+import pandas as pd
+from pandas.api.types import infer_dtype, is_object_dtype
+
+from column_store import PartitionedDataset
+from config import COMPACT_DTYPES, INGEST_CHUNK_ROWS, INGEST_SAMPLE_ROWS, INGEST_SKETCHES, TEXT_DTYPE
+from dtypes import compact_frame, infer_column_types, unify_dtypes
+from sketches import FrameSketch
+
+
+class CsvIngest:
+    """
+    Ingest one CSV file object into ``dataset_dir``.
+
+    ``run()`` is a generator yielding a progress dict after every chunk;
+    once it is exhausted ``dataset`` holds the ingested ``PartitionedDataset``
+    and, with ``sketch``, ``sketch`` its ``FrameSketch``.
+    """
+
+    def __init__(self, file_obj, dataset_dir, chunk_rows=INGEST_CHUNK_ROWS, sample_rows=INGEST_SAMPLE_ROWS,
+                 sketch=INGEST_SKETCHES):
+        self.file_obj = file_obj
+        self.dataset_dir = dataset_dir
+        self.chunk_rows = chunk_rows
+        self.sample_rows = sample_rows
+        self.sketch_chunks = sketch
+        self.dataset = None
+        self.sketch = None
+
+    def _total_bytes(self):
+        try:
+            self.file_obj.seek(0, os.SEEK_END)
+            total = self.file_obj.tell()
+            self.file_obj.seek(0)
+            return total
+        except (AttributeError, OSError):
+            return None
+
+    def _bytes_read(self):
+        try:
+            return self.file_obj.tell()
+        except (AttributeError, OSError):
+            return None
+
+    def run(self):
+        total_bytes = self._total_bytes()
+
+        # Infer column types from the first rows, then rewind for the real pass
+        sample = pd.read_csv(self.file_obj, nrows=self.sample_rows)
+        read_dtypes, category_columns = infer_column_types(sample)
+
+        while True:
+            self.file_obj.seek(0)
+            turned_text = yield from self._read_chunks(read_dtypes, category_columns, total_bytes)
+            if not turned_text:
+                break
+            # Start over reading those columns as text, as reading the whole file at once would
+            read_dtypes.update(dict.fromkeys(turned_text, 'object'))
+            shutil.rmtree(self.dataset_dir, ignore_errors=True)
+            self.sketch = None
+
+        dataset = PartitionedDataset(self.dataset_dir)
+        if not dataset.num_parts:
+            # Header-only file: keep the columns
+            dataset = PartitionedDataset.create(self.dataset_dir)
+            dataset.append(sample.head(0))
+            if self.sketch_chunks:
+                self.sketch = FrameSketch.build(sample.head(0))
+
+        self.dataset = dataset
+
+    def _read_chunks(self, read_dtypes, category_columns, total_bytes):
+        """
+        Generator writing the file's chunks as parts, yielding progress.
+        Returns the columns that held text in a chunk but weren't read as
+        text, before writing that chunk; an empty list once all are written.
+        """
+        dataset = PartitionedDataset.create(self.dataset_dir)
+        # Columns' dtypes so far, and each part's as written
+        column_dtypes = {}
+        part_dtypes = []
+        reader = pd.read_csv(self.file_obj, chunksize=self.chunk_rows, dtype=read_dtypes)
+        with reader:
+            for chunk in reader:
+                turned_text = [col for col in chunk.columns
+                               if is_object_dtype(chunk[col]) and read_dtypes.get(col) != 'object'
+                               and infer_dtype(chunk[col], skipna=True) != 'boolean']
+                if turned_text:
+                    return turned_text
+                if COMPACT_DTYPES:
+                    chunk = compact_frame(chunk, category_columns, TEXT_DTYPE)
+                chunk = self._unify(chunk, column_dtypes)
+                part_dtypes.append(chunk.dtypes.to_dict())
+                dataset.append(chunk)
+                if self.sketch_chunks:
+                    sketch = FrameSketch.build(chunk, seed=(0, dataset.num_parts))
+                    self.sketch = sketch if self.sketch is None else self.sketch.merge(sketch)
+
+                bytes_read = self._bytes_read()
+                progress = {
+                    'rows': dataset.rows,
+                    'chunks': dataset.num_parts,
+                    'bytes_read': bytes_read,
+                    'total_bytes': total_bytes,
+                }
+                if bytes_read is not None and total_bytes:
+                    progress['fraction'] = round(min(bytes_read / total_bytes, 1.0), 4)
+                yield progress
+
+        if dataset.num_parts:
+            self._rewrite_differing_parts(dataset, column_dtypes, part_dtypes)
+        return []
+
+    @staticmethod
+    def _unify(chunk, column_dtypes):
+        """``chunk`` with its columns at the dtype all chunks so far need, updating ``column_dtypes``."""
+        for col in chunk.columns:
+            dtype = chunk[col].dtype
+            column_dtypes[col] = unify_dtypes(column_dtypes.get(col, dtype), dtype)
+        return chunk.astype(_differing(chunk.dtypes.to_dict(), column_dtypes))
+
+    @staticmethod
+    def _rewrite_differing_parts(dataset, column_dtypes, part_dtypes):
+        """Rewrite the parts written before a column's dtype changed with its final one, and record the schema."""
+        for index, dtypes in enumerate(part_dtypes):
+            cast = _differing(dtypes, column_dtypes)
+            if cast:
+                dataset.write_part(index, dataset.read_part(index).astype(cast))
+        schema = [{'name': column['name'], 'dtype': str(column_dtypes.get(column['name'], column['dtype']))}
+                  for column in dataset.schema]
+        if schema != dataset.schema:
+            dataset.set_schema(schema)
+
+
+def _differing(dtypes, column_dtypes):
+    """The columns of ``dtypes`` (column: dtype) not at their ``column_dtypes`` dtype, with that dtype."""
+    return {col: column_dtypes[col] for col, dtype in dtypes.items()
+            if col in column_dtypes and dtype != column_dtypes[col]
+            and not (isinstance(dtype, pd.CategoricalDtype) and isinstance(column_dtypes[col], pd.CategoricalDtype))}
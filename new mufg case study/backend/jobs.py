@@ -0,0 +1,307 @@
+"""
+Background jobs for long-running operations.
+
+Work runs in a bounded pool of worker processes fed by the executor's local
+queue; there is no external broker. A job function runs in a worker as
+``func(context, *args)`` and reports through ``context.progress(...)``,
+which also raises ``JobCancelled`` once the job has been cancelled, so
+cancellation takes effect at the next progress report. Updates travel back
+to this process over a manager queue and are applied by a listener thread.
+
+An optional ``on_done(job, result)`` runs in this process when the worker
+succeeds (e.g. to register an ingested dataset) and its return value
+becomes the job's result.
+
+With a ``state_dir``, every job's state is also written there, so when
+several server processes share the directory any of them can report a job
+or ask for it to be cancelled; the process that runs the job picks up
+cancellation requests left for it.
+"""
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from datetime import datetime
+
+from errors import ApiError
+
+QUEUED, RUNNING, SUCCEEDED, FAILED, CANCELLED = 'queued', 'running', 'succeeded', 'failed', 'cancelled'
+FINISHED = {SUCCEEDED, FAILED, CANCELLED}
+
+# How often the process running jobs looks for cancellation requests from other processes
+CANCEL_POLL_SECONDS = 0.5
+
+
+class JobCancelled(Exception):
+    """Raised inside a job function when its job has been cancelled."""
+
+
+class JobContext:
+    """Handed to job functions in the worker process."""
+
+    def __init__(self, job_id, updates, cancelled):
+        self.job_id = job_id
+        self._updates = updates
+        self._cancelled = cancelled
+
+    def check_cancelled(self):
+        if self.job_id in self._cancelled:
+            raise JobCancelled()
+
+    def progress(self, fraction=None, message=None, partial=None):
+        """Report progress (0..1), a status message and/or a partial result."""
+        self.check_cancelled()
+        update = {'progress': None if fraction is None else round(min(max(fraction, 0.0), 1.0), 4)}
+        if message is not None:
+            update['message'] = message
+        if partial is not None:
+            update['partial'] = partial
+        self._updates.put((self.job_id, update))
+
+
+def _run_job(func, job_id, updates, cancelled, args):
+    # Runs in the worker process
+    context = JobContext(job_id, updates, cancelled)
+    context.check_cancelled()
+    updates.put((job_id, {'status': RUNNING}))
+    return func(context, *args)
+
+
+class Job:
+    def __init__(self, kind, on_done=None, cleanup=None):
+        self.job_id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = QUEUED
+        self.progress = 0.0
+        self.message = None
+        self.partial = None
+        self.result = None
+        self.error = None
+        self.on_done = on_done
+        # ``(path, filename, mimetype)`` of a file the job produced for download
+        self.download = None
+        # Called when the job is forgotten (e.g. to delete its output file)
+        self.cleanup = cleanup
+        self.future = None
+        self.created_at = datetime.utcnow()
+        self.started_at = None
+        self.finished_at = None
+
+    def describe(self):
+        description = {
+            'job_id': self.job_id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'message': self.message,
+            'created_at': self.created_at.isoformat(),
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+        }
+        if self.partial is not None and self.status not in FINISHED:
+            description['partial'] = self.partial
+        if self.status == SUCCEEDED:
+            description['result'] = self.result
+        if self.error is not None:
+            description['error'] = self.error
+        return description
+
+    def to_record(self):
+        return {**self.describe(), 'partial': self.partial, 'download': self.download}
+
+    @classmethod
+    def from_record(cls, record):
+        """A read-only snapshot of a job run by another process."""
+        job = cls(record['kind'])
+        job.job_id = record['job_id']
+        job.status = record['status']
+        job.progress = record['progress']
+        job.message = record['message']
+        job.partial = record.get('partial')
+        job.result = record.get('result')
+        job.error = record.get('error')
+        job.download = tuple(record['download']) if record.get('download') else None
+        job.created_at = datetime.fromisoformat(record['created_at'])
+        job.started_at = datetime.fromisoformat(record['started_at']) if record['started_at'] else None
+        job.finished_at = datetime.fromisoformat(record['finished_at']) if record['finished_at'] else None
+        return job
+
+
+class JobManager:
+    """
+    Submits jobs to at most ``max_workers`` processes, with at most
+    ``max_pending`` jobs queued or running; the ``max_finished`` most recent
+    finished jobs are kept for polling. Both limits apply per server process.
+    """
+
+    def __init__(self, max_workers=2, max_pending=32, max_finished=100, state_dir=None):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.max_finished = max_finished
+        self.state_dir = state_dir
+        if state_dir is not None:
+            os.makedirs(state_dir, exist_ok=True)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._manager = None
+
+    def _start(self):
+        # Processes are only started on the first submit; spawn avoids forking
+        # a multi-threaded server
+        if self._executor is None:
+            context = multiprocessing.get_context('spawn')
+            self._manager = context.Manager()
+            self._updates = self._manager.Queue()
+            self._cancelled = self._manager.dict()
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+            threading.Thread(target=self._listen, daemon=True).start()
+
+    def _state_path(self, job_id, suffix='.json'):
+        return os.path.join(self.state_dir, job_id + suffix)
+
+    def _save(self, job):
+        """Write a job's state for other processes; call with ``_lock`` held."""
+        if self.state_dir is None:
+            return
+        path = self._state_path(job.job_id)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(job.to_record(), f, default=str)
+        os.replace(tmp_path, path)
+
+    def _load(self, job_id):
+        if self.state_dir is None or not job_id.isalnum():
+            return None
+        try:
+            with open(self._state_path(job_id)) as f:
+                return Job.from_record(json.load(f))
+        except (OSError, ValueError):
+            return None
+
+    def _cancel_requested(self):
+        """Cancel the jobs of this process that other processes asked to cancel."""
+        if self.state_dir is None:
+            return
+        with self._lock:
+            job_ids = [job_id for job_id in self._jobs if os.path.exists(self._state_path(job_id, '.cancel'))]
+        for job_id in job_ids:
+            os.remove(self._state_path(job_id, '.cancel'))
+            try:
+                self.cancel(job_id)
+            except ApiError:
+                # Finished in the meantime
+                pass
+
+    def _listen(self):
+        while True:
+            try:
+                job_id, update = self._updates.get(timeout=CANCEL_POLL_SECONDS)
+            except queue.Empty:
+                self._cancel_requested()
+                continue
+            except (EOFError, OSError):
+                return
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is None or job.status in FINISHED:
+                    continue
+                if update.get('status') == RUNNING:
+                    job.status, job.started_at = RUNNING, datetime.utcnow()
+                if update.get('progress') is not None:
+                    job.progress = update['progress']
+                if 'message' in update:
+                    job.message = update['message']
+                if 'partial' in update:
+                    job.partial = update['partial']
+                self._save(job)
+
+    def submit(self, kind, func, *args, on_done=None, cleanup=None):
+        """Queue ``func(context, *args)``; ``func`` must be importable by the worker processes."""
+        with self._lock:
+            pending = sum(1 for job in self._jobs.values() if job.status not in FINISHED)
+            if pending >= self.max_pending:
+                raise ApiError('Too many jobs queued, try again later', 429)
+            self._start()
+            job = Job(kind, on_done, cleanup)
+            self._jobs[job.job_id] = job
+            self._save(job)
+            job.future = self._executor.submit(_run_job, func, job.job_id, self._updates, self._cancelled, args)
+        job.future.add_done_callback(lambda future: self._finish(job, future))
+        return job
+
+    def _finish(self, job, future):
+        status, result, error = SUCCEEDED, None, None
+        try:
+            result = future.result()
+            if job.on_done is not None:
+                result = job.on_done(job, result)
+        except (CancelledError, JobCancelled):
+            status = CANCELLED
+        except ApiError as e:
+            status, error = FAILED, e.message
+        except Exception as e:
+            status, error = FAILED, str(e) or type(e).__name__
+
+        with self._lock:
+            job.status, job.result, job.error = status, result, error
+            job.finished_at = datetime.utcnow()
+            if status == SUCCEEDED:
+                job.progress = 1.0
+            self._cancelled.pop(job.job_id, None)
+            self._save(job)
+            self._forget_finished()
+
+    def _forget_finished(self):
+        finished = [job for job in self._jobs.values() if job.status in FINISHED]
+        for job in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job.job_id]
+            if self.state_dir is not None:
+                for suffix in ('.json', '.cancel'):
+                    if os.path.exists(self._state_path(job.job_id, suffix)):
+                        os.remove(self._state_path(job.job_id, suffix))
+            if job.cleanup is not None:
+                job.cleanup()
+
+    def get(self, job_id):
+        """A job of this process or, with a ``state_dir``, a snapshot of one run by another process."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            job = self._load(job_id)
+        if job is None:
+            raise ApiError(f'Job {job_id} not found', 404)
+        return job
+
+    def cancel(self, job_id):
+        """Cancel a queued job at once, or ask a running one to stop at its next progress report."""
+        job = self.get(job_id)
+        with self._lock:
+            if job.status in FINISHED:
+                raise ApiError(f'Job {job_id} has already finished', 409)
+            job.message = 'cancelling'
+            if job.future is None:
+                # Another process runs it: leave a request for that process to pick up
+                open(self._state_path(job_id, '.cancel'), 'w').close()
+                return job
+            self._cancelled[job_id] = True
+            self._save(job)
+        job.future.cancel()
+        return job
+
+    def list(self):
+        with self._lock:
+            jobs = {job_id: job.describe() for job_id, job in self._jobs.items()}
+        if self.state_dir is not None:
+            # Jobs of other processes
+            for name in os.listdir(self.state_dir):
+                job_id, ext = os.path.splitext(name)
+                if ext == '.json' and job_id not in jobs:
+                    job = self._load(job_id)
+                    if job is not None:
+                        jobs[job_id] = job.describe()
+        return sorted(jobs.values(), key=lambda job: job['created_at'])
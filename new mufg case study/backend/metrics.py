@@ -0,0 +1,222 @@
+"""
+Request instrumentation.
+
+Each request records how long it spent in named phases (``with
+phase('load'):``): parsing the body, building or loading the frame, the
+pandas operation, serializing rows and encoding the JSON response. Phases
+may nest; a phase's time excludes the phases inside it, and whatever the
+request spent outside any phase is reported as ``other``. The timings go
+out in a ``Server-Timing`` header and, with payload sizes and rows
+processed, into the registry rendered by ``/metrics`` in the Prometheus
+text format.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (1e2, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9)
+ROWS_BUCKETS = (1e1, 1e2, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+
+PROMETHEUS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_labels(self.labels, key)} {_number(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        # {label values: [bucket counts..., count, sum]}
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            series = self._series.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f'{self.name}_bucket{_labels(self.labels, key, [("le", _number(bound))])} {count}')
+                lines.append(f'{self.name}_bucket{_labels(self.labels, key, [("le", "+Inf")])} {series[-2]}')
+                lines.append(f'{self.name}_count{_labels(self.labels, key)} {series[-2]}')
+                lines.append(f'{self.name}_sum{_labels(self.labels, key)} {_number(series[-1])}')
+        return lines
+
+
+class Registry:
+    """
+    The server's metrics. Gauges are read when rendered, from
+    ``gauge(name, help, read)`` callbacks returning a number or
+    ``{label value: number}`` (labelled with ``label``).
+    """
+
+    def __init__(self):
+        self.requests = Counter('http_requests_total', 'Requests served.', ('route', 'method', 'status'))
+        self.latency = Histogram('http_request_duration_seconds', 'Time to produce the response.',
+                                 LATENCY_BUCKETS, ('route', 'method'))
+        self.phases = Histogram('http_request_phase_seconds', 'Time spent in each phase of a request.',
+                                LATENCY_BUCKETS, ('route', 'phase'))
+        self.request_bytes = Histogram('http_request_size_bytes', 'Request body sizes.', BYTES_BUCKETS, ('route',))
+        self.response_bytes = Histogram('http_response_size_bytes', 'Response body sizes (streamed bodies excluded).',
+                                        BYTES_BUCKETS, ('route',))
+        self.rows = Histogram('http_request_rows', 'Dataset rows processed per request.', ROWS_BUCKETS, ('route',))
+        self._gauges = []
+
+    def gauge(self, name, help, read, label=None):
+        self._gauges.append((name, help, read, label))
+
+    def render(self):
+        lines = []
+        for metric in (self.requests, self.latency, self.phases, self.request_bytes, self.response_bytes, self.rows):
+            lines += metric.render()
+        for name, help, read, label in self._gauges:
+            lines += [f'# HELP {name} {help}', f'# TYPE {name} gauge']
+            value = read()
+            if isinstance(value, dict):
+                lines += [f'{name}{_labels((label,), (key,))} {_number(v)}' for key, v in sorted(value.items())]
+            else:
+                lines.append(f'{name} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+@contextmanager
+def phase(name):
+    """Time a block as phase ``name`` of the current request (a no-op outside requests)."""
+    if not has_request_context() or 'phases' not in g:
+        yield
+        return
+    stack = g.phase_stack
+    stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        nested = stack.pop()
+        g.phases[name] = g.phases.get(name, 0.0) + elapsed - nested
+        if stack:
+            stack[-1] += elapsed
+
+
+def count_rows(rows):
+    """Record that the current request processed a frame of ``rows`` rows (the largest one counts)."""
+    if has_request_context() and 'phases' in g:
+        g.rows = max(g.get('rows', 0), rows)
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """Times JSON encoding of every ``jsonify`` response as the ``encode`` phase."""
+
+    def response(self, *args, **kwargs):
+        with phase('encode'):
+            return super().response(*args, **kwargs)
+
+
+def server_timing(phases, total):
+    entries = [f'{name};dur={seconds * 1000:.2f}' for name, seconds in phases.items()]
+    other = total - sum(phases.values())
+    if phases and other > 0:
+        entries.append(f'other;dur={other * 1000:.2f}')
+    entries.append(f'total;dur={total * 1000:.2f}')
+    return ', '.join(entries)
+
+
+def instrument(app, profiler=None):
+    """
+    Time every request of ``app``; with a ``profiler`` (``SlowRequestProfiler``)
+    the stacks of slow requests are also sampled and dumped.
+    """
+    app.json = TimedJSONProvider(app)
+
+    @app.before_request
+    def start_timing():
+        g.phases = {}
+        g.phase_stack = []
+        g.request_start = time.perf_counter()
+        if profiler is not None:
+            profiler.start_request()
+
+    @app.after_request
+    def record_timing(response):
+        if 'request_start' not in g:
+            return response
+        total = time.perf_counter() - g.request_start
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+        response.headers['Server-Timing'] = server_timing(g.phases, total)
+        registry.requests.inc(route=route, method=request.method, status=str(response.status_code))
+        registry.latency.observe(total, route=route, method=request.method)
+        for name, seconds in g.phases.items():
+            registry.phases.observe(seconds, route=route, phase=name)
+        if g.phases:
+            registry.phases.observe(max(total - sum(g.phases.values()), 0.0), route=route, phase='other')
+        registry.request_bytes.observe(request.content_length or 0, route=route)
+        if not response.is_streamed and response.content_length is not None:
+            registry.response_bytes.observe(response.content_length, route=route)
+        if g.get('rows'):
+            registry.rows.observe(g.rows, route=route)
+
+        if profiler is not None:
+            path = profiler.finish_request(f'{request.method} {request.path}', total)
+            if path is not None:
+                app.logger.warning('Slow request %s %s took %.0f ms; profile written to %s',
+                                   request.method, request.path, total * 1000, path)
+        return response
+
+    @app.teardown_request
+    def stop_profiling(exc):
+        # Requests that failed before after_request ran
+        if profiler is not None:
+            profiler.discard_request()
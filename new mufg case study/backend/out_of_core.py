@@ -0,0 +1,414 @@
+"""
+Out-of-core execution of transformation steps.
+
+A stored dataset too big to load is transformed part by part: every part
+(record batch or Parquet part) of its persisted file is read, run through
+the pipeline steps and written as one part of a new ``PartitionedDataset``,
+so memory is bounded by the part size however big the dataset is. Parts
+are independent, so with ``workers`` they are processed in parallel by a
+pool of processes, each reading its part from disk.
+
+Every step except ``remove-duplicate`` works row by row and runs this way
+unchanged. ``remove-duplicate`` is hash-partitioned: rows are spilled to
+buckets by a hash of their values, so equal rows land in the same bucket;
+each bucket (about ``bucket_rows`` rows) is deduplicated on its own, and
+the parts are then rewritten without the duplicates found, first
+occurrences kept as ``drop_duplicates`` keeps them.
+
+Results match running the steps on the whole frame: 'date' conversions
+parse with the format pandas would infer from the whole column, a
+conversion that fails on any part is skipped for the column in every part
+(as the whole column is kept when it fails in memory), and the parts read
+back as one frame (``PartitionedDataset.read``) equal the in-memory result
+once it is persisted.
+"""
+import multiprocessing
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import (
+    infer_dtype, is_bool_dtype, is_datetime64_dtype, is_numeric_dtype
+)
+
+from column_store import PartitionedDataset, concat_frames, frame_schema, part_file
+from persistence import PARTS_SUFFIX, open_persisted_frame
+from pipeline import Step
+from sketches import FrameSketch
+import transforms
+
+try:
+    from pandas.tseries.api import guess_datetime_format
+except ImportError:
+    # pandas < 2.2
+    from pandas._libs.tslibs.parsing import guess_datetime_format
+
+# Position of each spilled row in its source part
+PART_COLUMN = '__out_of_core_part__'
+ROW_COLUMN = '__out_of_core_row__'
+
+# Hash of a null, whatever the column's dtype
+NULL_HASH = np.uint64(0)
+HASH_MULTIPLIER = np.uint64(1_000_003)
+
+NUMERIC_KINDS = {'integer', 'floating', 'mixed-integer-float', 'decimal', 'boolean'}
+
+# 'change-datatypes' conversions that can fail on some values, checked on every part before any runs
+FALLIBLE_CONVERSIONS = {'int', 'float'}
+
+
+def _read_part(source, index):
+    return source.head(0) if index is None else source.read_part(index)
+
+
+def _part_indexes(source):
+    # An empty dataset still has its columns, as a part of no rows
+    return list(range(source.num_parts)) or [None]
+
+
+def _column_hashes(values):
+    """
+    uint64 hashes of one column, equal for values ``drop_duplicates`` treats
+    as equal even when parts hold the column with different dtypes (int64
+    in one part, float64 in another), or None if the values can't be hashed
+    that way (mixed objects).
+    """
+    if is_datetime64_dtype(values):
+        keys = values.to_numpy(dtype='datetime64[ns]').view('int64')
+    elif is_bool_dtype(values) or is_numeric_dtype(values):
+        keys = values.to_numpy(dtype='float64', na_value=np.nan)
+    else:
+        objects = values.astype(object)
+        kind = infer_dtype(objects, skipna=True)
+        if kind in ('string', 'empty'):
+            keys = objects.where(objects.notna(), '').to_numpy()
+        elif kind in NUMERIC_KINDS:
+            keys = pd.to_numeric(objects, errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+        else:
+            return None
+    if keys.dtype == np.float64:
+        # -0.0 == 0.0
+        keys = keys + 0.0
+    hashes = pd.util.hash_array(keys)
+    hashes[values.isna().to_numpy()] = NULL_HASH
+    return hashes
+
+
+def row_hashes(df):
+    """
+    A uint64 hash per row, equal for rows ``drop_duplicates`` treats as
+    equal. Columns that can't be hashed consistently are left out, which
+    only makes unequal rows share a hash more often.
+    """
+    hashes = np.zeros(len(df), dtype=np.uint64)
+    for position in range(df.shape[1]):
+        column = _column_hashes(df.iloc[:, position])
+        if column is not None:
+            hashes = hashes * HASH_MULTIPLIER ^ column
+    return hashes
+
+
+def steps_changed_columns(steps, rows_in, rows_out):
+    """
+    The columns whose values ``steps`` changed, for the version graph: the
+    results of column arithmetic and expressions when that's all they did,
+    otherwise None (every column, as when rows were dropped).
+    """
+    if rows_in != rows_out or not all(step.op in transforms.COLUMN_OPERATIONS or step.op == 'expression'
+                                      for step in steps):
+        return None
+    changed = []
+    for step in steps:
+        if step.op == 'expression':
+            changed.extend(step.params['expressions'])
+            continue
+        result_column = step.params.get('result_column')
+        if result_column is None:
+            default_name, _ = transforms.COLUMN_OPERATIONS[step.op]
+            result_column = default_name.format(column1=step.params.get('column1'),
+                                                column2=step.params.get('column2'))
+        changed.append(result_column)
+    return changed
+
+
+def _run_steps(df, steps):
+    timings = []
+    for step in steps:
+        rows_in = len(df)
+        start = time.perf_counter()
+        df = step.run(df)
+        timings.append((rows_in, len(df), time.perf_counter() - start))
+    return df, timings
+
+
+# The functions below run in the worker processes
+
+def transform_part(source_path, index, steps, output_path):
+    """Run ``steps`` on one part; returns its part record, schema and per-step timings."""
+    source = open_persisted_frame(source_path)
+    df, timings = _run_steps(_read_part(source, index), steps)
+    part = PartitionedDataset(output_path).write_part(index or 0, df)
+    return part, frame_schema(df), timings
+
+
+def failed_conversions(source_path, index, steps, step):
+    """Columns whose conversion by ``step`` (a 'change-datatypes' step) fails on one part after ``steps``."""
+    df, _ = _run_steps(_read_part(open_persisted_frame(source_path), index), steps)
+    date_formats = step.params.get('date_formats') or {}
+    failed = []
+    for col, dtype in step.params.get('dtype_map', {}).items():
+        if col in df.columns and dtype in FALLIBLE_CONVERSIONS:
+            try:
+                transforms.convert_column(df[col], dtype, date_formats.get(col))
+            except Exception:
+                failed.append(col)
+    return failed
+
+
+def _bucket_dir(spill_path, bucket):
+    return os.path.join(spill_path, f'bucket-{bucket:05d}')
+
+
+def spill_part(source_path, index, buckets, spill_path):
+    """Append one part's rows, tagged with their position, to the buckets their hashes pick."""
+    df = _read_part(open_persisted_frame(source_path), index)
+    bucket_of = row_hashes(df) % np.uint64(buckets)
+    # A stable sort keeps the rows of each bucket in their original order
+    order = np.argsort(bucket_of, kind='stable')
+    bounds = np.searchsorted(bucket_of[order], np.arange(buckets + 1, dtype=np.uint64))
+    df = df.assign(**{PART_COLUMN: index or 0, ROW_COLUMN: np.arange(len(df))})
+    for bucket in range(buckets):
+        start, end = bounds[bucket], bounds[bucket + 1]
+        if start < end:
+            os.makedirs(_bucket_dir(spill_path, bucket), exist_ok=True)
+            df.take(order[start:end]).to_parquet(
+                os.path.join(_bucket_dir(spill_path, bucket), part_file(index or 0)), index=False)
+
+
+def bucket_duplicates(spill_path, bucket):
+    """``(parts, rows)``: positions of the rows of a bucket that repeat an earlier row."""
+    directory = _bucket_dir(spill_path, bucket)
+    if not os.path.isdir(directory):
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    # Part files sort by part index, so the rows are in dataset order
+    df = concat_frames(pd.read_parquet(os.path.join(directory, name)) for name in sorted(os.listdir(directory)))
+    duplicated = df.drop(columns=[PART_COLUMN, ROW_COLUMN]).duplicated().to_numpy()
+    return df[PART_COLUMN].to_numpy()[duplicated], df[ROW_COLUMN].to_numpy()[duplicated]
+
+
+def drop_part_rows(source_path, index, rows, output_path):
+    """Rewrite one part without the rows at positions ``rows``."""
+    df = _read_part(open_persisted_frame(source_path), index)
+    keep = np.ones(len(df), dtype=bool)
+    keep[rows] = False
+    df = df[keep]
+    part = PartitionedDataset(output_path).write_part(index or 0, df)
+    return part, frame_schema(df)
+
+
+def sketch_parts(source_path, indexes, columns, sample_rows, seed):
+    """The merged ``FrameSketch`` of ``columns`` of some parts, sampling whole rows if ``sample_rows``."""
+    source = open_persisted_frame(source_path)
+    sketch = None
+    for index in indexes:
+        if index is None:
+            df = source.head(0)
+        else:
+            # The row sample keeps every column
+            df = source.read_part(index, None if sample_rows else columns)
+        part = FrameSketch.build(df, columns, sample_rows, (seed, index or 0))
+        sketch = part if sketch is None else sketch.merge(part)
+    return sketch
+
+
+class OutOfCoreExecutor:
+    """
+    Runs pipeline steps over persisted frames part by part, in this process
+    or, with ``workers`` > 0, in a pool of that many processes.
+    """
+
+    def __init__(self, workers=0, bucket_rows=500_000):
+        self.workers = workers
+        self.bucket_rows = bucket_rows
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _map(self, func, calls):
+        """``[func(*args) for args in calls]``, spread over the pool when there is one."""
+        if self.workers <= 0 or len(calls) < 2:
+            return [func(*args) for args in calls]
+
+        with self._lock:
+            if self._pool is None:
+                # Processes are only started on first use; spawn avoids forking the server
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        futures = [self._pool.submit(func, *args) for args in calls]
+        try:
+            return [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    def sketch(self, source_path, columns, sample_rows=0, seed=0):
+        """
+        ``FrameSketch`` of ``columns`` of the frame persisted at
+        ``source_path``: groups of parts are sketched in parallel and the
+        sketches merged.
+        """
+        indexes = _part_indexes(open_persisted_frame(source_path))
+        groups = min(len(indexes), max(self.workers, 1) * 4)
+        calls = [(source_path, indexes[group::groups], columns, sample_rows, seed) for group in range(groups)]
+        sketches = self._map(sketch_parts, calls)
+        sketch = sketches[0]
+        for other in sketches[1:]:
+            sketch = sketch.merge(other)
+        return sketch
+
+    def run(self, source_path, steps, output_path):
+        """
+        Run ``steps`` (pipeline ``Step``s) over the frame persisted at
+        ``source_path``, writing the result as a ``PartitionedDataset`` at
+        ``output_path``. Returns the dataset and per-step timings in the
+        form of ``pipeline.execute``'s.
+        """
+        stages = []
+        for step in steps:
+            if step.op == 'remove-duplicate':
+                stages.append(step)
+            elif stages and isinstance(stages[-1], list):
+                stages[-1].append(step)
+            else:
+                stages.append([step])
+
+        work_paths = []
+        timings = []
+        current = source_path
+        try:
+            for position, stage in enumerate(stages):
+                if position == len(stages) - 1:
+                    target = output_path
+                else:
+                    target = f'{output_path}.stage{position}{PARTS_SUFFIX}'
+                    work_paths.append(target)
+                if isinstance(stage, list):
+                    timings += self._transform(current, stage, target)
+                else:
+                    timings.append(self._remove_duplicates(current, stage, target, f'{output_path}.spill{position}'))
+                current = target
+        except BaseException:
+            shutil.rmtree(output_path, ignore_errors=True)
+            raise
+        finally:
+            for path in work_paths:
+                shutil.rmtree(path, ignore_errors=True)
+        return PartitionedDataset(output_path), timings
+
+    def _transform(self, source_path, steps, output_path):
+        source = open_persisted_frame(source_path)
+        steps = self._resolve_conversions(source_path, source, steps)
+        output = PartitionedDataset.create(output_path)
+        start = time.perf_counter()
+        results = self._map(transform_part, [(source_path, index, steps, output_path)
+                                             for index in _part_indexes(source)])
+        for part, schema, _ in results:
+            output.add_part(part, schema)
+
+        timings = []
+        for position, step in enumerate(steps):
+            per_part = [part_timings[position] for _, _, part_timings in results]
+            timing = step.describe()
+            timing.update({
+                'rows_in': sum(rows_in for rows_in, _, _ in per_part),
+                'rows_out': sum(rows_out for _, rows_out, _ in per_part),
+                # Summed over the parts, which may have run in parallel
+                'ms': round(sum(seconds for _, _, seconds in per_part) * 1000, 3),
+                'parts': len(per_part),
+            })
+            timings.append(timing)
+        if timings:
+            timings[-1]['wall_ms'] = round((time.perf_counter() - start) * 1000, 3)
+        return timings
+
+    def _resolve_conversions(self, source_path, source, steps):
+        """
+        ``steps`` with every 'change-datatypes' step decided for the whole
+        dataset rather than part by part: the format of each 'date'
+        conversion fixed to the one pandas infers for the whole column (from
+        its first non-null value), and conversions that fail on any part
+        dropped, so every part converts the same columns the same way.
+        """
+        resolved = []
+        for step in steps:
+            if step.op != 'change-datatypes':
+                resolved.append(step)
+                continue
+            dtype_map = dict(step.params.get('dtype_map', {}))
+            formats = dict(step.params.get('date_formats') or {})
+            for column, dtype in dtype_map.items():
+                if dtype != 'date' or column in formats:
+                    continue
+                first = self._first_value(source, resolved, column)
+                if isinstance(first, str):
+                    formats[column] = guess_datetime_format(first)
+            params = {**step.params, 'date_formats': formats} if formats else step.params
+            step = Step(step.op, params, step.sources, step.note)
+
+            if any(dtype in FALLIBLE_CONVERSIONS for dtype in dtype_map.values()):
+                failed = set()
+                for columns in self._map(failed_conversions, [(source_path, index, resolved, step)
+                                                              for index in _part_indexes(source)]):
+                    failed.update(columns)
+                if failed:
+                    params = {**params, 'dtype_map': {col: dtype for col, dtype in dtype_map.items()
+                                                      if col not in failed}}
+                    step = Step(step.op, params, step.sources, step.note)
+            resolved.append(step)
+        return resolved
+
+    @staticmethod
+    def _first_value(source, steps, column):
+        """First non-null value of ``column`` after ``steps``, reading parts until one has it."""
+        for index in _part_indexes(source):
+            df, _ = _run_steps(_read_part(source, index), steps)
+            if column not in df.columns:
+                return None
+            values = df[column].dropna()
+            if len(values):
+                return values.iloc[0]
+        return None
+
+    def _remove_duplicates(self, source_path, step, output_path, spill_path):
+        source = open_persisted_frame(source_path)
+        indexes = _part_indexes(source)
+        buckets = max(1, -(-source.rows // self.bucket_rows))
+        start = time.perf_counter()
+        try:
+            self._map(spill_part, [(source_path, index, buckets, spill_path) for index in indexes])
+            found = self._map(bucket_duplicates, [(spill_path, bucket) for bucket in range(buckets)])
+        finally:
+            shutil.rmtree(spill_path, ignore_errors=True)
+
+        parts = np.concatenate([parts for parts, _ in found])
+        rows = np.concatenate([rows for _, rows in found])
+        dropped = {index: rows[parts == (index or 0)] for index in indexes}
+
+        output = PartitionedDataset.create(output_path)
+        results = self._map(drop_part_rows, [(source_path, index, dropped[index], output_path) for index in indexes])
+        for part, schema in results:
+            output.add_part(part, schema)
+
+        timing = step.describe()
+        timing.update({
+            'rows_in': source.rows,
+            'rows_out': output.rows,
+            'ms': round((time.perf_counter() - start) * 1000, 3),
+            'parts': len(indexes),
+            'buckets': buckets,
+        })
+        return timing
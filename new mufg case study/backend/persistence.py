@@ -0,0 +1,255 @@
+"""
+On-disk copies of stored datasets.
+
+Every dataset gets a directory under the persistence root holding a
+``dataset.json`` record, its frame as uploaded and one file per transformed
+version. Frames are written as uncompressed Feather (Arrow IPC) files so
+they can be reopened memory-mapped: opening one only reads its schema, and
+the pages are shared through the OS page cache by every process reading
+the same file. Datasets from streaming ingest keep their Parquet parts
+(``parts/``) as the original, and versions made by out-of-core
+transformations are Parquet parts too (``vNNNNN.parts/``).
+
+When the files take more than ``disk_budget_bytes``, the least recently
+used datasets are deleted. Directories without a record belong to ingests
+still writing and are left alone, unless nothing has been written to them
+for ``uncommitted_grace_seconds`` (the ingest died).
+
+Several server processes can share one persistence root: changes to a
+dataset are made under an exclusive file lock (``lock``), and a process
+notices another's changes from the record's ``record_stamp``.
+"""
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: only the single-process development server runs there
+    fcntl = None
+
+import pyarrow as pa
+from pyarrow import feather
+
+from column_store import PartitionedDataset
+from config import UNCOMMITTED_GRACE_SECONDS
+from serialization import frame_to_arrow_table
+
+RECORD_FILE = 'dataset.json'
+LOCK_FILE = '.lock'
+ORIGINAL_FILE = 'original.feather'
+PARTS_DIR = 'parts'
+# Versions written part by part (out-of-core transformations) are parts directories too
+PARTS_SUFFIX = '.parts'
+
+
+class FeatherFrame:
+    """
+    A frame in a Feather file, opened memory-mapped.
+
+    Has the same ``rows``/``columns``/``schema``/``head``/``read``/``iter_parts``
+    interface as ``PartitionedDataset`` (its record batches being the parts),
+    so a ``DatasetEntry`` can use either as its source.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._reader = pa.ipc.open_file(pa.memory_map(path))
+        self._dtypes = self._reader.schema.empty_table().to_pandas().dtypes
+        self.rows = sum(self._reader.get_batch(i).num_rows for i in range(self._reader.num_record_batches))
+
+    @property
+    def columns(self):
+        return [str(col) for col in self._dtypes.index]
+
+    @property
+    def schema(self):
+        return [{'name': str(col), 'dtype': str(dtype)} for col, dtype in self._dtypes.items()]
+
+    @property
+    def num_parts(self):
+        return self._reader.num_record_batches
+
+    def read_part(self, index, columns=None):
+        batch = self._reader.get_batch(index)
+        if columns is not None:
+            batch = batch.select(columns)
+        return batch.to_pandas()
+
+    def iter_parts(self, columns=None):
+        for index in range(self.num_parts):
+            yield self.read_part(index, columns)
+
+    def read(self):
+        # Numeric columns without nulls stay backed by the mapped pages
+        return self._reader.read_all().to_pandas(split_blocks=True)
+
+    def head(self, n):
+        return self._reader.read_all().slice(0, n).to_pandas()
+
+
+def write_feather(df, path):
+    """Write ``df`` to ``path`` atomically, uncompressed so it can be memory-mapped."""
+    tmp_path = path + '.tmp'
+    feather.write_feather(frame_to_arrow_table(df), tmp_path, compression='uncompressed')
+    os.replace(tmp_path, path)
+
+
+def version_file(version):
+    return f'v{version:05d}.feather'
+
+
+def version_parts(version):
+    return f'v{version:05d}{PARTS_SUFFIX}'
+
+
+@contextmanager
+def file_lock(path):
+    """An exclusive lock on ``path`` held across processes (a no-op without fcntl)."""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def open_persisted_frame(path):
+    """The ``FeatherFrame`` or ``PartitionedDataset`` (a parts directory) at ``path``."""
+    if os.path.basename(path) == PARTS_DIR or path.endswith(PARTS_SUFFIX):
+        return PartitionedDataset(path)
+    return FeatherFrame(path)
+
+
+class DatasetPersistence:
+    """Dataset records and frame files under ``root``, bounded by ``disk_budget_bytes``."""
+
+    def __init__(self, root, disk_budget_bytes, uncommitted_grace_seconds=UNCOMMITTED_GRACE_SECONDS):
+        self.root = root
+        self.disk_budget_bytes = disk_budget_bytes
+        self.uncommitted_grace_seconds = uncommitted_grace_seconds
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def dataset_dir(self, dataset_id):
+        return os.path.join(self.root, dataset_id)
+
+    def parts_dir(self, dataset_id):
+        """Where streaming ingest writes a dataset's Parquet parts."""
+        return os.path.join(self.dataset_dir(dataset_id), PARTS_DIR)
+
+    def _path(self, dataset_id, name):
+        return os.path.join(self.dataset_dir(dataset_id), name)
+
+    def write_frame(self, dataset_id, name, df):
+        os.makedirs(self.dataset_dir(dataset_id), exist_ok=True)
+        write_feather(df, self._path(dataset_id, name))
+        return name
+
+    def frame_path(self, dataset_id, name):
+        return self._path(dataset_id, name)
+
+    def open_frame(self, dataset_id, name):
+        return open_persisted_frame(self._path(dataset_id, name))
+
+    def save_record(self, record):
+        path = self._path(record['dataset_id'], RECORD_FILE)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, path)
+
+    def load_record(self, dataset_id):
+        if not dataset_id.isalnum():
+            return None
+        try:
+            with open(self._path(dataset_id, RECORD_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def record_stamp(self, dataset_id):
+        """Changes whenever the dataset's record is rewritten (by any process); None once it's deleted."""
+        try:
+            stat = os.stat(self._path(dataset_id, RECORD_FILE))
+        except OSError:
+            return None
+        # save_record replaces the file, so the inode changes too
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def lock(self, dataset_id):
+        """Exclusive, cross-process lock for changing a dataset."""
+        return file_lock(self._path(dataset_id, LOCK_FILE))
+
+    def touch(self, dataset_id):
+        """Mark a dataset as used now, for LRU eviction."""
+        try:
+            os.utime(self.dataset_dir(dataset_id))
+        except OSError:
+            pass
+
+    def dataset_ids(self):
+        return [name for name in os.listdir(self.root)
+                if os.path.exists(self._path(name, RECORD_FILE))]
+
+    def delete(self, dataset_id):
+        shutil.rmtree(self.dataset_dir(dataset_id), ignore_errors=True)
+
+    def _usage(self, dataset_id):
+        """``(bytes, last write time)`` of a dataset's files."""
+        total = 0
+        last_write = 0.0
+        for directory, _, files in os.walk(self.dataset_dir(dataset_id)):
+            for name in [None, *files]:
+                try:
+                    stat = os.stat(directory if name is None else os.path.join(directory, name))
+                except OSError:
+                    continue
+                if name is not None:
+                    total += stat.st_size
+                last_write = max(last_write, stat.st_mtime)
+        return total, last_write
+
+    def enforce_budget(self, keep=()):
+        """
+        Delete least recently used datasets (never those in ``keep``) until the
+        total size fits the disk budget; returns the evicted ids. Directories
+        without a record yet (a streaming ingest still writing its parts)
+        count towards the total but are never evicted, and are deleted once
+        nothing has been written to them for the grace period.
+        """
+        with self._lock:
+            usage = []
+            evicted = []
+            now = time.time()
+            for dataset_id in os.listdir(self.root):
+                try:
+                    last_used = os.path.getmtime(self.dataset_dir(dataset_id))
+                except OSError:
+                    continue
+                size, last_write = self._usage(dataset_id)
+                committed = os.path.exists(self._path(dataset_id, RECORD_FILE))
+                if not committed and dataset_id not in keep and now - last_write > self.uncommitted_grace_seconds:
+                    self.delete(dataset_id)
+                    evicted.append(dataset_id)
+                    continue
+                usage.append((last_used, dataset_id, size, committed))
+
+            total = sum(size for _, _, size, _ in usage)
+            for _, dataset_id, size, committed in sorted(usage):
+                if total <= self.disk_budget_bytes:
+                    break
+                if dataset_id in keep or not committed:
+                    continue
+                self.delete(dataset_id)
+                total -= size
+                evicted.append(dataset_id)
+            return evicted
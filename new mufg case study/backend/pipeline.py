@@ -0,0 +1,263 @@
+"""
+Batched transformation pipelines.
+
+A pipeline ("recipe") is an ordered list of steps such as
+
+    [{"op": "remove-null"},
+     {"op": "trim-whitespaces"},
+     {"op": "change-datatypes", "dtype_map": {"amount": "float"}},
+     {"op": "remove-duplicate"}]
+
+It runs on one DataFrame in a single request. Before running, a planner
+rewrites the steps where the result is guaranteed to be identical:
+null-row filters are moved ahead of whitespace trimming (so fewer rows are
+trimmed), and adjacent steps that can be merged are fused. Recipes can be
+saved and replayed on other datasets.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from errors import ApiError
+from expressions import parse_expressions
+from persistence import file_lock
+import text_cleaning
+import transforms
+
+
+OPERATIONS = {
+    'remove-null': lambda df, params: transforms.remove_nulls(df),
+    'remove-duplicate': lambda df, params: transforms.remove_duplicates(df),
+    'rename-columns': lambda df, params: transforms.rename_columns(df, params.get('rename_map', {})),
+    'change-datatypes': lambda df, params: transforms.change_datatypes(
+        df, params.get('dtype_map', {}), params.get('date_formats')),
+    'trim-whitespaces': lambda df, params: transforms.trim_whitespaces(df, **params),
+    'expression': lambda df, params: transforms.derive_columns(df, params.get('expressions')),
+    **{
+        name: (lambda operation: lambda df, params: transforms.column_operation(
+            df, operation, params.get('column1'), params.get('column2'), params.get('result_column')
+        ))(name)
+        for name in transforms.COLUMN_OPERATIONS
+    },
+}
+
+# Running these twice in a row gives the same result as running them once
+# (trimming unless it has regex replacements)
+IDEMPOTENT_OPERATIONS = {'remove-null', 'remove-duplicate', 'trim-whitespaces'}
+
+# A null filter can move ahead of these without changing which rows are dropped
+NULL_FILTER_COMMUTES_WITH = {'trim-whitespaces', 'rename-columns'}
+
+
+class Step:
+    """One step of a pipeline; ``sources`` are the indexes of the recipe steps it stands for."""
+
+    def __init__(self, op, params=None, sources=(), note=None):
+        self.op = op
+        self.params = params or {}
+        self.sources = list(sources)
+        self.note = note
+
+    def run(self, df):
+        return OPERATIONS[self.op](df, self.params)
+
+    def describe(self):
+        description = {'op': self.op, 'steps': self.sources}
+        if self.params:
+            description['params'] = self.params
+        if self.note:
+            description['note'] = self.note
+        return description
+
+
+def parse_steps(steps):
+    """Validate a recipe's step list and return it as ``Step`` objects."""
+    if not isinstance(steps, list) or not steps:
+        raise ApiError('steps must be a non-empty list')
+
+    parsed = []
+    for index, step in enumerate(steps):
+        if not isinstance(step, dict) or step.get('op') not in OPERATIONS:
+            raise ApiError(f"Step {index}: op must be one of {', '.join(sorted(OPERATIONS))}")
+
+        op = step['op']
+        params = {key: value for key, value in step.items() if key != 'op'}
+        if op == 'rename-columns' and not isinstance(params.get('rename_map', {}), dict):
+            raise ApiError(f'Step {index}: rename_map must be an object')
+        if op == 'change-datatypes' and not isinstance(params.get('dtype_map', {}), dict):
+            raise ApiError(f'Step {index}: dtype_map must be an object')
+        if op == 'change-datatypes' and not isinstance(params.get('date_formats', {}), dict):
+            raise ApiError(f'Step {index}: date_formats must be an object')
+        if op in transforms.COLUMN_OPERATIONS and not (params.get('column1') and params.get('column2')):
+            raise ApiError(f'Step {index}: column1 and column2 are required')
+        if op == 'expression':
+            try:
+                parse_expressions(params.get('expressions'))
+            except ApiError as e:
+                raise ApiError(f'Step {index}: {e.message}')
+        if op == 'trim-whitespaces':
+            try:
+                params = text_cleaning.parse_options(params)
+            except ApiError as e:
+                raise ApiError(f'Step {index}: {e.message}')
+
+        parsed.append(Step(op, params, [index]))
+    return parsed
+
+
+def _hoist_null_filters(steps):
+    planned = []
+    for step in steps:
+        if step.op != 'remove-null':
+            planned.append(step)
+            continue
+
+        position = len(planned)
+        while position > 0 and planned[position - 1].op in NULL_FILTER_COMMUTES_WITH:
+            position -= 1
+
+        if position == len(planned):
+            planned.append(step)
+            continue
+
+        planned.insert(position, Step('remove-null', sources=step.sources,
+                                      note='moved ahead of ' + ', '.join(s.op for s in planned[position:])))
+    return planned
+
+
+def _compose_renames(first, second):
+    composed = {old: second.get(new, new) for old, new in first.items()}
+    composed.update({old: new for old, new in second.items() if old not in composed})
+    return composed
+
+
+def _fuse(previous, step):
+    """Return one step equivalent to ``previous`` followed by ``step``, or None."""
+    sources = previous.sources + step.sources
+
+    if (previous.op == step.op and step.op in IDEMPOTENT_OPERATIONS and previous.params == step.params
+            and text_cleaning.is_idempotent(step.params)):
+        return Step(step.op, step.params, sources, note='repeated step runs once')
+
+    if previous.op == step.op == 'rename-columns':
+        first, second = previous.params.get('rename_map', {}), step.params.get('rename_map', {})
+        # Only when the second map doesn't touch names the first one renamed away
+        if not set(second) & set(first):
+            return Step('rename-columns', {'rename_map': _compose_renames(first, second)}, sources,
+                        note='renames fused')
+
+    if previous.op == step.op == 'change-datatypes':
+        first, second = previous.params.get('dtype_map', {}), step.params.get('dtype_map', {})
+        if not set(first) & set(second):
+            params = {'dtype_map': {**first, **second}}
+            formats = {**previous.params.get('date_formats', {}), **step.params.get('date_formats', {})}
+            if formats:
+                params['date_formats'] = formats
+            return Step('change-datatypes', params, sources, note='type conversions fused')
+
+    return None
+
+
+def _fuse_adjacent(steps):
+    planned = []
+    for step in steps:
+        fused = _fuse(planned[-1], step) if planned else None
+        if fused is None:
+            planned.append(step)
+        else:
+            planned[-1] = fused
+    return planned
+
+
+def plan(steps):
+    """Rewrite parsed steps into an equivalent, cheaper sequence."""
+    return _fuse_adjacent(_hoist_null_filters(steps))
+
+
+def execute(df, steps):
+    """Run the steps on ``df``; returns the result and per-step timings."""
+    timings = []
+    for step in steps:
+        rows_in = len(df)
+        start = time.perf_counter()
+        df = step.run(df)
+        timing = step.describe()
+        timing.update({
+            'rows_in': rows_in,
+            'rows_out': len(df),
+            'ms': round((time.perf_counter() - start) * 1000, 3),
+        })
+        timings.append(timing)
+    return df, timings
+
+
+class RecipeStore:
+    """
+    Saved recipes, kept in a JSON file so they survive restarts. The file is
+    reread when another process has changed it, and changed under a file
+    lock, so server processes sharing it see each other's recipes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._recipes = {}
+        self._stamp = None
+
+    def _refresh(self):
+        """Reload the file if it changed since it was last read; call with ``_lock`` held."""
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+        stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if stamp != self._stamp:
+            with open(self.path) as f:
+                self._recipes = json.load(f)
+            self._stamp = stamp
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._recipes, f, indent=2)
+        os.replace(tmp_path, self.path)
+        stat = os.stat(self.path)
+        self._stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def create(self, name, steps):
+        parse_steps(steps)
+        recipe = {
+            'recipe_id': uuid.uuid4().hex,
+            'name': name or 'Untitled recipe',
+            'steps': steps,
+            'created_at': datetime.utcnow().isoformat(),
+        }
+        with self._lock, file_lock(self.path + '.lock'):
+            self._refresh()
+            self._recipes[recipe['recipe_id']] = recipe
+            self._save()
+        return recipe
+
+    def get(self, recipe_id):
+        with self._lock:
+            self._refresh()
+            recipe = self._recipes.get(recipe_id)
+        if recipe is None:
+            raise ApiError(f'Recipe {recipe_id} not found', 404)
+        return recipe
+
+    def delete(self, recipe_id):
+        with self._lock, file_lock(self.path + '.lock'):
+            self._refresh()
+            if self._recipes.pop(recipe_id, None) is None:
+                raise ApiError(f'Recipe {recipe_id} not found', 404)
+            self._save()
+
+    def list(self):
+        with self._lock:
+            self._refresh()
+            return list(self._recipes.values())
@@ -0,0 +1,96 @@
+"""
+Sampling profiler for slow requests.
+
+While enabled, one background thread samples the Python stack of every
+thread that is serving a request, every ``interval_ms``. When a request
+finishes after more than ``threshold_ms`` its samples are written to
+``output_dir`` as collapsed stacks (one ``frame;frame;... count`` line per
+distinct stack), the input format of flamegraph.pl, speedscope and
+inferno. Requests under the threshold just drop their samples.
+"""
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})'
+
+
+def collapse_stack(frame):
+    """A frame's stack as ``outermost;...;innermost``."""
+    labels = []
+    while frame is not None:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(labels))
+
+
+class SlowRequestProfiler:
+    def __init__(self, output_dir, threshold_ms, interval_ms=5, max_files=100):
+        self.output_dir = output_dir
+        self.threshold_ms = threshold_ms
+        self.interval = interval_ms / 1000
+        self.max_files = max_files
+        # {thread id: Counter of collapsed stacks} for threads serving a request
+        self._samples = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                threads = list(self._samples)
+            if not threads:
+                continue
+            frames = sys._current_frames()
+            stacks = {thread_id: collapse_stack(frames[thread_id]) for thread_id in threads if thread_id in frames}
+            with self._lock:
+                for thread_id, stack in stacks.items():
+                    if thread_id in self._samples:
+                        self._samples[thread_id][stack] += 1
+
+    def start_request(self):
+        with self._lock:
+            self._samples[threading.get_ident()] = Counter()
+            self._ensure_started()
+
+    def discard_request(self):
+        with self._lock:
+            self._samples.pop(threading.get_ident(), None)
+
+    def finish_request(self, name, seconds):
+        """Stop sampling the current request; returns the profile's path if it was slow enough to write one."""
+        with self._lock:
+            samples = self._samples.pop(threading.get_ident(), None)
+        if not samples or seconds * 1000 < self.threshold_ms:
+            return None
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        slug = re.sub(r'[^A-Za-z0-9]+', '-', name).strip('-')[:80]
+        path = os.path.join(self.output_dir, f'{datetime.utcnow():%Y%m%dT%H%M%S%f}-{slug}-{seconds * 1000:.0f}ms.folded')
+        with open(path, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write(f'{stack} {count}\n')
+        self._prune()
+        return path
+
+    def _prune(self):
+        """Keep the ``max_files`` most recent profiles."""
+        profiles = sorted(name for name in os.listdir(self.output_dir) if name.endswith('.folded'))
+        for name in profiles[:max(0, len(profiles) - self.max_files)]:
+            try:
+                os.remove(os.path.join(self.output_dir, name))
+            except OSError:
+                pass
@@ -0,0 +1,510 @@
+"""
+Filtered, sorted and projected row queries.
+
+A filter is a tree of conditions, as JSON
+
+    {"and": [{"column": "region", "op": "==", "value": "APAC"},
+             {"column": "revenue", "op": ">", "value": 10000}]}
+
+(a list is an "and"; "or" and "not" nest the same way) or as an
+expression string meaning the same:
+
+    region == 'APAC' and revenue > 10000
+
+Conditions are answered from per-column indexes rather than by comparing
+every row. A text, category or boolean column is factorized into codes
+ordered like its sorted distinct values, so a condition is evaluated once
+per distinct value and mapped to the rows through the codes; a numeric or
+date column keeps the permutation that sorts it, so a range is two binary
+searches. The same indexes give the rank of every row for sorting.
+
+Indexes of a stored dataset are memoized with its statistics, per
+(column, column version), and reused by later queries until a
+transformation changes the column. Null values only match "is_null": a
+comparison with a null is neither true nor false, so its "not" doesn't
+match the row either (as in SQL).
+"""
+import ast
+import operator
+import re
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_bool_dtype, is_datetime64_any_dtype, is_numeric_dtype
+
+from errors import ApiError
+
+COMPARISONS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+OPERATORS = (*COMPARISONS, 'in', 'not_in', 'between', 'contains', 'is_null', 'not_null')
+
+# Nesting depth beyond which a filter is refused rather than recursed into
+MAX_FILTER_DEPTH = 32
+
+
+# Parsing
+
+def _scalar(value, what):
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    raise ApiError(f'{what} must be a string, number or boolean')
+
+
+def _condition(column, op, value=None):
+    if not isinstance(column, str) or not column:
+        raise ApiError('Filter conditions need a "column"')
+    if op not in OPERATORS:
+        raise ApiError(f"Filter op must be one of {', '.join(OPERATORS)}")
+
+    if op in ('is_null', 'not_null'):
+        return {'column': column, 'op': op}
+    if op in ('in', 'not_in'):
+        if not isinstance(value, list):
+            raise ApiError(f'"{op}" needs a list of values')
+        return {'column': column, 'op': op, 'value': [_scalar(v, f'Values of {column!r}') for v in value]}
+    if op == 'between':
+        if not isinstance(value, list) or len(value) != 2 or None in value:
+            raise ApiError('"between" needs a [low, high] pair')
+        return {'column': column, 'op': op, 'value': [_scalar(v, f'Values of {column!r}') for v in value]}
+    if op == 'contains' and not isinstance(value, str):
+        raise ApiError('"contains" needs a text value')
+    if value is None:
+        # Comparing with null matches nothing; say what was probably meant
+        raise ApiError(f'Use "is_null" or "not_null" to test {column!r} for nulls')
+    return {'column': column, 'op': op, 'value': _scalar(value, f'The value for {column!r}')}
+
+
+def _boolean(op, children):
+    children = [child for child in children if child is not None]
+    if not children:
+        return None
+    return children[0] if len(children) == 1 else {op: children}
+
+
+def _from_json(spec, depth=0):
+    if depth > MAX_FILTER_DEPTH:
+        raise ApiError('Filter is nested too deeply')
+    if isinstance(spec, list):
+        return _boolean('and', [_from_json(child, depth + 1) for child in spec])
+    if not isinstance(spec, dict):
+        raise ApiError('Filter must be an object, a list of conditions or an expression string')
+
+    for op in ('and', 'or'):
+        if op in spec:
+            if not isinstance(spec[op], list):
+                raise ApiError(f'"{op}" needs a list of conditions')
+            return _boolean(op, [_from_json(child, depth + 1) for child in spec[op]])
+    if 'not' in spec:
+        child = _from_json(spec['not'], depth + 1)
+        return None if child is None else {'not': child}
+    return _condition(spec.get('column'), spec.get('op', '=='), spec.get('value'))
+
+
+_AST_COMPARISONS = {
+    ast.Eq: '==', ast.NotEq: '!=', ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>=',
+    ast.In: 'in', ast.NotIn: 'not_in',
+}
+
+# ``10000 < revenue`` is ``revenue > 10000``
+_FLIPPED = {'==': '==', '!=': '!=', '<': '>', '<=': '>=', '>': '<', '>=': '<='}
+
+
+def _scalar_or_none(value):
+    return value is None or isinstance(value, (str, int, float, bool))
+
+
+class _Expression:
+    """Turns a parsed expression string into a filter tree; only the filter grammar is accepted."""
+
+    def __init__(self, text, names):
+        self.text = text
+        self.names = names
+
+    def unsupported(self, node):
+        return ApiError(f'Unsupported filter expression: {ast.get_source_segment(self.text, node) or self.text}')
+
+    def column(self, node):
+        if isinstance(node, ast.Name):
+            return self.names.get(node.id, node.id)
+        return None
+
+    def value(self, node):
+        if isinstance(node, ast.Constant) and _scalar_or_none(node.value):
+            return node.value
+        if (isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub)
+                and isinstance(node.operand, ast.Constant) and isinstance(node.operand.value, (int, float))
+                and not isinstance(node.operand.value, bool)):
+            return -node.operand.value
+        if isinstance(node, (ast.List, ast.Tuple)):
+            return [self.value(element) for element in node.elts]
+        raise self.unsupported(node)
+
+    def comparison(self, left, op_node, right):
+        if isinstance(op_node, (ast.Is, ast.IsNot)):
+            column = self.column(left)
+            if column is None or not (isinstance(right, ast.Constant) and right.value is None):
+                raise self.unsupported(right)
+            return _condition(column, 'is_null' if isinstance(op_node, ast.Is) else 'not_null')
+
+        op = _AST_COMPARISONS.get(type(op_node))
+        if op is None:
+            raise self.unsupported(right)
+        column = self.column(left)
+        if column is not None:
+            return _condition(column, op, self.value(right))
+        column = self.column(right)
+        if column is None or op not in _FLIPPED:
+            raise self.unsupported(left)
+        return _condition(column, _FLIPPED[op], self.value(left))
+
+    def convert(self, node, depth=0):
+        if depth > MAX_FILTER_DEPTH:
+            raise ApiError('Filter is nested too deeply')
+        if isinstance(node, ast.BoolOp):
+            op = 'and' if isinstance(node.op, ast.And) else 'or'
+            return {op: [self.convert(child, depth + 1) for child in node.values]}
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return {'not': self.convert(node.operand, depth + 1)}
+        if isinstance(node, ast.Compare):
+            # Chained comparisons (10 < revenue <= 20) are an "and" of each pair
+            operands = [node.left, *node.comparators]
+            conditions = [self.comparison(operands[i], op, operands[i + 1]) for i, op in enumerate(node.ops)]
+            return _boolean('and', conditions)
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+            # contains(memo, 'fee'), between(revenue, 10, 20)
+            name, args = node.func.id, node.args
+            if name in ('contains', 'between') and args and self.column(args[0]) is not None:
+                values = [self.value(arg) for arg in args[1:]]
+                return _condition(self.column(args[0]), name, values[0] if name == 'contains' and values else values)
+        raise self.unsupported(node)
+
+
+def _from_expression(text):
+    # Backquoted names may hold spaces and punctuation: swap them for identifiers first
+    names = {}
+
+    def placeholder(match):
+        name = f'_column_{len(names)}'
+        names[name] = match.group(1)
+        return name
+
+    source = re.sub(r'`([^`]+)`', placeholder, text.strip())
+    try:
+        tree = ast.parse(source, mode='eval')
+    except SyntaxError as e:
+        raise ApiError(f'Invalid filter expression: {e.msg}')
+    return _Expression(source, names).convert(tree.body)
+
+
+def parse_filter(spec):
+    """
+    A request's filter (JSON tree or expression string) as a normalized
+    tree of ``{'and'|'or': [...]}``, ``{'not': ...}`` and
+    ``{'column', 'op', 'value'}`` nodes; None when there is no filter.
+    """
+    if spec is None or spec == '' or spec == []:
+        return None
+    if isinstance(spec, str):
+        return _from_expression(spec)
+    return _from_json(spec)
+
+
+def filter_columns(tree):
+    """The columns a parsed filter refers to."""
+    if tree is None:
+        return set()
+    if 'column' in tree:
+        return {tree['column']}
+    if 'not' in tree:
+        return filter_columns(tree['not'])
+    return set().union(*(filter_columns(child) for child in next(iter(tree.values()))))
+
+
+def parse_sort_keys(sort):
+    """``'-revenue,date'`` or ``['-revenue', 'date']`` as ``[('revenue', False), ('date', True)]``."""
+    if not sort:
+        return []
+    if isinstance(sort, str):
+        sort = sort.split(',')
+    if not isinstance(sort, list) or not all(isinstance(key, str) for key in sort):
+        raise ApiError('sort must be a column name or a list of them, "-" first for descending')
+    keys = []
+    for key in sort:
+        key = key.strip()
+        if key.startswith('-'):
+            keys.append((key[1:], False))
+        elif key:
+            keys.append((key, True))
+    return keys
+
+
+# Indexes
+
+def _factorize_sorted(values):
+    """``(codes, uniques)`` with ``uniques`` sorted (by their text when they can't be compared)."""
+    try:
+        codes, uniques = pd.factorize(values, sort=True)
+        return codes, np.asarray(uniques, dtype=object)
+    except TypeError:
+        codes, uniques = pd.factorize(values)
+        uniques = np.asarray(uniques, dtype=object)
+        order = np.argsort(uniques.astype(str), kind='stable')
+        ranks = np.empty_like(order)
+        ranks[order] = np.arange(len(order))
+        return np.append(ranks, -1)[codes], uniques[order]
+
+
+def _as_numbers(values):
+    return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype='float64')
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class CodeIndex:
+    """A column as codes into its sorted distinct values (-1 for null)."""
+
+    def __init__(self, series):
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            # Only the categories need sorting; rows map through their category codes
+            remap, self.uniques = _factorize_sorted(np.asarray(series.cat.categories, dtype=object))
+            self.codes = np.append(remap, -1)[series.cat.codes.to_numpy()]
+        else:
+            self.codes, self.uniques = _factorize_sorted(series)
+        self.codes.flags.writeable = False
+
+    @property
+    def distinct(self):
+        return len(self.uniques)
+
+    def ranks(self):
+        return self.codes
+
+    def _operands(self, values):
+        # Numbers against text compare with the text's numeric value, as /math does
+        if all(_is_number(value) for value in values) and self.uniques.size and not all(
+                _is_number(value) for value in self.uniques):
+            return _as_numbers(self.uniques)
+        return self.uniques
+
+    def _hits(self, op, value):
+        """Which distinct values satisfy the condition."""
+        if op in COMPARISONS:
+            operands = self._operands([value])
+            try:
+                return np.asarray(COMPARISONS[op](operands, value), dtype=bool)
+            except TypeError:
+                raise ApiError(f'Cannot compare the column with {value!r}')
+        if op in ('in', 'not_in'):
+            hits = pd.Series(self._operands(value)).isin(value).to_numpy()
+            return hits if op == 'in' else ~hits
+        if op == 'between':
+            return self._hits('>=', value[0]) & self._hits('<=', value[1])
+        if op == 'contains':
+            return pd.Series(self.uniques.astype(str)).str.contains(value, case=False, regex=False).to_numpy()
+        raise ApiError(f'Unsupported filter op {op}')
+
+    def mask(self, op, value=None):
+        if op in ('is_null', 'not_null'):
+            nulls = self.codes < 0
+            return nulls if op == 'is_null' else ~nulls
+        # Null rows have code -1, which picks the trailing False
+        return np.append(self._hits(op, value), False)[self.codes]
+
+
+class SortedIndex:
+    """A numeric or date column's non-null values in sorted order, with their row positions."""
+
+    def __init__(self, series):
+        self.dates = is_datetime64_any_dtype(series)
+        if self.dates:
+            if getattr(series.dt, 'tz', None) is not None:
+                series = series.dt.tz_convert('UTC').dt.tz_localize(None)
+            values = series.to_numpy(dtype='datetime64[ns]').view('int64')
+            valid = series.notna().to_numpy()
+        else:
+            values = series.to_numpy(dtype='float64', na_value=np.nan)
+            valid = ~np.isnan(values)
+        self.rows = len(values)
+        positions = np.flatnonzero(valid)
+        self.order = positions[np.argsort(values[positions], kind='stable')]
+        self.sorted = values[self.order]
+        self.nulls = np.flatnonzero(~valid)
+        self._ranks = None
+        for array in (self.order, self.sorted, self.nulls):
+            array.flags.writeable = False
+
+    @property
+    def distinct(self):
+        return int(np.count_nonzero(np.diff(self.sorted))) + 1 if self.sorted.size else 0
+
+    def ranks(self):
+        """Dense rank of every row's value (equal values share one), -1 for null."""
+        if self._ranks is None:
+            ranks = np.full(self.rows, -1, dtype=np.int64)
+            ranks[self.order] = np.r_[0, np.cumsum(np.diff(self.sorted) != 0)] if self.sorted.size else []
+            ranks.flags.writeable = False
+            self._ranks = ranks
+        return self._ranks
+
+    def _key(self, value):
+        if self.dates:
+            try:
+                timestamp = pd.Timestamp(value)
+            except (TypeError, ValueError):
+                raise ApiError(f'Cannot compare a date column with {value!r}')
+            if timestamp.tzinfo is not None:
+                timestamp = timestamp.tz_convert('UTC').tz_localize(None)
+            return timestamp.value
+        if isinstance(value, str):
+            try:
+                return float(value)
+            except ValueError:
+                raise ApiError(f'Cannot compare a numeric column with {value!r}')
+        return value
+
+    def _range(self, low, high, low_side='left', high_side='right'):
+        """Row positions with values in [low, high] (bounds None for open ends)."""
+        start = 0 if low is None else np.searchsorted(self.sorted, self._key(low), low_side)
+        stop = len(self.sorted) if high is None else np.searchsorted(self.sorted, self._key(high), high_side)
+        return self.order[start:max(start, stop)]
+
+    def _positions(self, op, value):
+        if op == '==':
+            return self._range(value, value)
+        if op == '<':
+            return self._range(None, value, high_side='left')
+        if op == '<=':
+            return self._range(None, value)
+        if op == '>':
+            return self._range(value, None, low_side='right')
+        if op == '>=':
+            return self._range(value, None)
+        if op == 'between':
+            return self._range(value[0], value[1])
+        if op == 'in':
+            ranges = [self._range(v, v) for v in value if v is not None]
+            return np.concatenate(ranges) if ranges else np.empty(0, dtype=np.intp)
+        raise ApiError(f'"{op}" does not apply to numeric or date columns')
+
+    def mask(self, op, value=None):
+        mask = np.zeros(self.rows, dtype=bool)
+        if op in ('is_null', 'not_null'):
+            mask[self.nulls] = True
+            return mask if op == 'is_null' else ~mask
+        if op in ('!=', 'not_in'):
+            mask[self._positions('==' if op == '!=' else 'in', value)] = True
+            mask[self.nulls] = True
+            return ~mask
+        mask[self._positions(op, value)] = True
+        return mask
+
+
+def build_index(series):
+    """The index suited to a column: sorted for numbers and dates, codes for the rest."""
+    if is_datetime64_any_dtype(series) or (is_numeric_dtype(series) and not is_bool_dtype(series)):
+        return SortedIndex(series)
+    return CodeIndex(series)
+
+
+class FrameIndexes:
+    """
+    Column indexes of one frame, built on first use. With a ``cache`` (a
+    dataset's ``stats_cache``) and the frame's ``column_versions``, they are
+    memoized there under ``(column, column version, 'index')``.
+    """
+
+    def __init__(self, df, cache=None, column_versions=None):
+        self.df = df
+        self.cache = cache
+        self.column_versions = column_versions or {}
+        self._indexes = {}
+
+    def index(self, column):
+        if column not in self.df.columns:
+            raise ApiError(f'Column {column} not found')
+        if column in self._indexes:
+            return self._indexes[column]
+
+        key = (column, self.column_versions.get(column, 0), 'index')
+        index = self.cache.get(key) if self.cache is not None else None
+        if index is None:
+            index = build_index(self.df[column])
+            if self.cache is not None:
+                self.cache[key] = index
+        self._indexes[column] = index
+        return index
+
+
+def dataset_indexes(entry, original=False):
+    """``FrameIndexes`` of a stored dataset's current (or original) frame, memoized on the entry."""
+    with entry.lock:
+        df = entry.frame(original)
+        versions = {col: entry.column_version(col, original) for col in df.columns}
+    return FrameIndexes(df, entry.stats_cache, versions)
+
+
+# Evaluation
+
+def _truth(indexes, tree):
+    """
+    ``(true, false)`` masks of a parsed filter. A condition on a null value
+    (other than "is_null"/"not_null") is neither, and stays so under "not";
+    "and"/"or" combine the masks as three-valued logic.
+    """
+    if 'column' in tree:
+        index = indexes.index(tree['column'])
+        true = index.mask(tree['op'], tree.get('value'))
+        if tree['op'] in ('is_null', 'not_null'):
+            return true, ~true
+        return true, ~true & index.mask('not_null')
+    if 'not' in tree:
+        true, false = _truth(indexes, tree['not'])
+        return false, true
+
+    op, children = next(iter(tree.items()))
+    true, false = _truth(indexes, children[0])
+    for child in children[1:]:
+        child_true, child_false = _truth(indexes, child)
+        if op == 'and':
+            true, false = true & child_true, false | child_false
+        else:
+            true, false = true | child_true, false & child_false
+    return true, false
+
+
+def row_mask(indexes, tree):
+    """Boolean mask of the rows matching a parsed filter."""
+    true, _ = _truth(indexes, tree)
+    return true
+
+
+def sort_positions(indexes, positions, sort_keys):
+    """``positions`` reordered by ``sort_keys``, nulls last, ties in row order."""
+    if not sort_keys or not len(positions):
+        return positions
+    keys = []
+    # np.lexsort sorts by its last key first
+    for column, ascending in reversed(sort_keys):
+        index = indexes.index(column)
+        ranks = index.ranks()[positions]
+        top = index.distinct
+        keys.append(np.where(ranks < 0, top + 1, ranks if ascending else top - ranks))
+    return positions[np.lexsort(keys)]
+
+
+def select_rows(indexes, tree=None, sort_keys=()):
+    """Row positions matching ``tree`` (every row when None), ordered by ``sort_keys``."""
+    if tree is None:
+        positions = np.arange(len(indexes.df))
+    else:
+        positions = np.flatnonzero(row_mask(indexes, tree))
+    return sort_positions(indexes, positions, sort_keys)
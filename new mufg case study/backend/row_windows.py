@@ -0,0 +1,113 @@
+"""
+Paged, sorted and filtered windows over a stored dataset.
+
+Sorting a column costs O(n log n), so the permutation (argsort positions)
+for each (column, direction) is cached on the dataset entry, as are the
+row positions of a filtered view. Once cached, every page is a positional
+slice of at most ``limit`` rows.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+from errors import ApiError
+
+DEFAULT_PAGE_ROWS = 100
+MAX_PAGE_ROWS = 1000
+
+# Filtered views are cached too, but only the most recent few per frame
+MAX_CACHED_VIEWS = 8
+
+
+def _cached_view(cache, key, compute):
+    views = cache.setdefault('views', OrderedDict())
+    if key in views:
+        views.move_to_end(key)
+        return views[key]
+    value = views[key] = compute()
+    while len(views) > MAX_CACHED_VIEWS:
+        views.popitem(last=False)
+    return value
+
+
+def parse_sort(sort):
+    """``'revenue'`` sorts ascending, ``'-revenue'`` descending."""
+    if not sort:
+        return None, True
+    if sort.startswith('-'):
+        return sort[1:], False
+    return sort, True
+
+
+def sort_permutation(df, cache, column, ascending=True):
+    """Row positions of ``df`` ordered by ``column``, nulls last, cached per direction."""
+    key = ('sort', column, ascending)
+    if key not in cache:
+        if column not in df.columns:
+            raise ApiError(f'Column {column} not found')
+
+        series = df[column].reset_index(drop=True)
+        try:
+            ordered = series.sort_values(ascending=ascending, kind='stable', na_position='last')
+        except TypeError:
+            # Mixed types that cannot be compared: order by their text instead
+            ordered = series.astype(str).where(series.notna()).sort_values(
+                ascending=ascending, kind='stable', na_position='last')
+        cache[key] = ordered.index.to_numpy()
+    return cache[key]
+
+
+def filter_mask(df, cache, text):
+    """
+    Boolean mask of rows matching a filter, cached per filter string.
+
+    ``'column:text'`` matches rows whose column contains ``text``; plain
+    ``'text'`` matches rows where any column does. Matching is
+    case-insensitive on the values' text form.
+    """
+    def compute():
+        column, sep, needle = text.partition(':')
+        if sep and column in df.columns:
+            columns = [column]
+        else:
+            columns, needle = list(df.columns), text
+
+        mask = np.zeros(len(df), dtype=bool)
+        for col in columns:
+            values = df[col]
+            mask |= (values.notna() & values.astype(str).str.contains(needle, case=False, regex=False)).to_numpy()
+        return mask
+
+    return _cached_view(cache, ('filter', text), compute)
+
+
+def view_positions(df, cache, sort=None, filter_text=None):
+    """Row positions, in display order, of the sorted and filtered view."""
+    column, ascending = parse_sort(sort)
+    if not filter_text:
+        return sort_permutation(df, cache, column, ascending) if column else np.arange(len(df))
+
+    def compute():
+        positions = sort_permutation(df, cache, column, ascending) if column else np.arange(len(df))
+        return positions[filter_mask(df, cache, filter_text)[positions]]
+
+    return _cached_view(cache, ('view', sort, filter_text), compute)
+
+
+def row_window(df, cache, offset=0, limit=DEFAULT_PAGE_ROWS, sort=None, filter_text=None):
+    """
+    Return ``(window_df, total_rows)`` for one page of the view.
+
+    ``total_rows`` counts the rows matching the filter; without sort or
+    filter the window is a plain positional slice.
+    """
+    if offset < 0:
+        raise ApiError('offset must be >= 0')
+    if not 0 < limit <= MAX_PAGE_ROWS:
+        raise ApiError(f'limit must be between 1 and {MAX_PAGE_ROWS}')
+
+    if not sort and not filter_text:
+        return df.iloc[offset:offset + limit], len(df)
+
+    positions = view_positions(df, cache, sort, filter_text)
+    return df.iloc[positions[offset:offset + limit]], len(positions)
@@ -0,0 +1,130 @@
+"""
+DataFrame -> JSON-ready Python structures, and Arrow IPC streams.
+
+Conversion happens column by column with vectorized pandas/numpy calls:
+nulls (NaN, NaT, None, pd.NA) become ``None`` and datetimes are formatted
+as ``DATETIME_FORMAT`` strings. Apart from object columns that mix
+datetimes with other values, only the null positions of a column are
+touched individually, never every cell.
+"""
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import infer_dtype, is_datetime64_any_dtype, is_object_dtype
+
+from errors import ApiError
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+ORIENTS = ('records', 'columns')
+
+
+def _datetime_values(series):
+    # strftime is the costly part, so format each distinct timestamp once
+    codes, uniques = pd.factorize(series)
+    formatted = np.append(uniques.strftime(DATETIME_FORMAT).to_numpy(dtype=object), None)
+    # factorize marks NaT with code -1, which picks the trailing None
+    return formatted[codes].tolist()
+
+
+def column_values(series):
+    """Return one column as a list of JSON-serializable values."""
+    if is_datetime64_any_dtype(series):
+        return _datetime_values(series)
+
+    if is_object_dtype(series):
+        # Object columns may hold Python datetimes/Timestamps (e.g. from Excel)
+        inferred = infer_dtype(series, skipna=True)
+        if inferred in ('datetime', 'datetime64'):
+            return _datetime_values(pd.to_datetime(series, errors='coerce'))
+        if inferred == 'mixed':
+            return [
+                value.strftime(DATETIME_FORMAT) if isinstance(value, datetime) else value
+                for value in _with_nulls_as_none(series)
+            ]
+
+    return _with_nulls_as_none(series)
+
+
+def _with_nulls_as_none(series):
+    values = series.tolist()
+    for position in np.flatnonzero(series.isna().to_numpy()):
+        values[position] = None
+    return values
+
+
+def frame_to_columns(df):
+    """``{'columns': [...], 'data': {column: [values...]}}`` for a DataFrame."""
+    columns = list(df.columns)
+    return {
+        'columns': columns,
+        'data': {col: column_values(df.iloc[:, i]) for i, col in enumerate(columns)}
+    }
+
+
+def frame_to_records(df):
+    """List of ``{column: value}`` dicts for a DataFrame, one per row."""
+    columns = list(df.columns)
+    values = [column_values(df.iloc[:, i]) for i in range(len(columns))]
+    return [dict(zip(columns, row)) for row in zip(*values)]
+
+
+def serialize_frame(df, orient='records'):
+    """Serialize ``df`` as row records (default) or in columnar form."""
+    if orient == 'records':
+        return frame_to_records(df)
+    if orient == 'columns':
+        return frame_to_columns(df)
+    raise ApiError(f"Unsupported orient '{orient}', expected one of {', '.join(ORIENTS)}")
+
+
+# Apache Arrow IPC stream transport, negotiated with Accept / Content-Type
+ARROW_STREAM_MIMETYPE = 'application/vnd.apache.arrow.stream'
+
+# Schema metadata keys: the JSON response body (minus its rows) travels with
+# the table, and request parameters travel with a posted table
+ARROW_RESPONSE_KEY = b'response'
+ARROW_PARAMS_KEY = b'params'
+
+
+def frame_to_arrow_table(df):
+    """``df`` as a pyarrow Table; object columns Arrow can't type are sent as text."""
+    import pyarrow as pa
+
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        converted = {}
+        for col in df.columns:
+            if is_object_dtype(df[col]):
+                try:
+                    pa.array(df[col], from_pandas=True)
+                except (pa.ArrowInvalid, pa.ArrowTypeError):
+                    converted[col] = df[col].astype(str).where(df[col].notna(), None)
+        return pa.Table.from_pandas(df.assign(**converted), preserve_index=False)
+
+
+def frame_to_arrow_stream(df, metadata=None):
+    """Encode ``df`` as Arrow IPC stream bytes, with ``metadata`` (bytes -> bytes) on the schema."""
+    import pyarrow as pa
+
+    table = frame_to_arrow_table(df)
+    if metadata:
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), **metadata})
+
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def arrow_stream_to_frame(data):
+    """Decode Arrow IPC stream bytes into ``(df, schema_metadata)``."""
+    import pyarrow as pa
+
+    try:
+        table = pa.ipc.open_stream(data).read_all()
+    except pa.ArrowInvalid as e:
+        raise ApiError(f'Invalid Arrow stream: {e}')
+    return table.to_pandas(), table.schema.metadata or {}
@@ -0,0 +1,434 @@
+"""
+Mergeable sketches for approximate statistics of very large datasets.
+
+A ``FrameSketch`` summarizes a frame in a few hundred kilobytes whatever
+its size: per column a ``ColumnSketch`` (rows and nulls, a HyperLogLog of
+its distinct values and, for number and date columns, a KLL quantile sketch
+and exact moments) plus a uniform ``RowSample`` of whole rows for previews
+and histograms. Sketches of two frames merge into the sketch of both
+together, so a dataset is sketched part by part (in parallel, or chunk by
+chunk while it is ingested) and the parts merged.
+
+Every estimate comes with its error bound: distinct counts within
+``HLL_SIGMAS`` relative standard errors (about 95% confidence), quantiles
+within the KLL sketch's normalized rank error (99%), and histogram counts
+within ``SAMPLE_SIGMAS`` standard errors of estimating a share from the
+sample. Counts, sums, averages, standard deviations, minimums and maximums
+are exact.
+
+Column sketches of stored datasets are memoized per (column, column
+version) in the entry's ``stats_cache`` and the row sample per version, so
+a transformation only gets the columns it changed sketched again.
+"""
+import math
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_bool_dtype, is_datetime64_any_dtype, is_numeric_dtype
+
+from column_store import concat_frames
+from config import SKETCH_HLL_PRECISION, SKETCH_KLL_K, SKETCH_SAMPLE_ROWS
+from dtypes import to_numeric
+from errors import ApiError
+
+HLL_SIGMAS = 2
+SAMPLE_SIGMAS = 2
+
+# Rows sketched at a time from a frame in memory
+CHUNK_ROWS = 1_000_000
+
+SAMPLE_CACHE_KEY = 'sketch_sample'
+
+
+def value_hashes(values):
+    """
+    uint64 hashes of the non-null values of a column, equal for equal
+    values whatever dtype a chunk holds them in (1 and 1.0, a category and
+    the same text).
+    """
+    values = values.dropna()
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        categories = value_hashes(pd.Series(values.cat.categories))
+        return categories[values.cat.codes.to_numpy()]
+    if is_datetime64_any_dtype(values):
+        keys = values.to_numpy(dtype='datetime64[ns]').view('int64')
+    elif is_bool_dtype(values) or is_numeric_dtype(values):
+        # -0.0 == 0.0
+        keys = values.to_numpy(dtype='float64') + 0.0
+    else:
+        keys = values.to_numpy(dtype=object)
+    return pd.util.hash_array(keys)
+
+
+class HyperLogLog:
+    """Distinct count sketch with ``2 ** precision`` one-byte registers."""
+
+    def __init__(self, precision=SKETCH_HLL_PRECISION):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8)
+
+    @property
+    def relative_error(self):
+        """Relative standard error of ``estimate``."""
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def update(self, hashes):
+        bits = 64 - self.precision
+        index = (hashes >> np.uint64(bits)).astype(np.intp)
+        rest = hashes & np.uint64((1 << bits) - 1)
+        # Position of the first 1 bit of the remaining bits; frexp's exponent is the bit length
+        _, bit_length = np.frexp(rest.astype(np.float64))
+        np.maximum.at(self.registers, index, (bits - bit_length + 1).astype(np.uint8))
+
+    def merge(self, other):
+        merged = HyperLogLog(self.precision)
+        merged.registers = np.maximum(self.registers, other.registers)
+        return merged
+
+    def estimate(self):
+        m = len(self.registers)
+        raw = 0.7213 / (1 + 1.079 / m) * m * m / np.sum(np.ldexp(1.0, -self.registers.astype(np.int32)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities
+            return m * math.log(m / zeros)
+        return float(raw)
+
+
+class KllSketch:
+    """
+    Quantile sketch: levels of sorted-then-halved items, an item at level
+    ``h`` standing for ``2 ** h`` values. Keeps O(k) items.
+    """
+
+    def __init__(self, k=SKETCH_KLL_K, seed=None):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+        self._rng = np.random.default_rng(seed)
+
+    @property
+    def rank_error(self):
+        """Normalized rank error of a quantile, at 99% confidence."""
+        return 2.296 / self.k ** 0.9723
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(int(math.ceil(self.k * (2 / 3) ** depth)), 8)
+
+    def _compress(self):
+        # Compact the lowest full level while the sketch holds more items than all its levels' capacity
+        while sum(map(len, self.levels)) > sum(self._capacity(level) for level in range(len(self.levels))):
+            level = next(level for level, items in enumerate(self.levels) if len(items) >= self._capacity(level))
+            if level + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            items = np.sort(self.levels[level])
+            # An odd item out stays at this level
+            keep, items = items[:len(items) % 2], items[len(items) % 2:]
+            promoted = items[self._rng.integers(2)::2]
+            self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            self.levels[level] = keep
+
+    def update(self, values):
+        """Add a float64 array of values (NaN are skipped)."""
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+        self.count += len(values)
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+
+    def merge(self, other):
+        merged = KllSketch(self.k, self._rng.integers(1 << 32))
+        merged.levels = [np.concatenate(pair) for pair in
+                         zip(*(levels + [np.empty(0)] * (max(len(self.levels), len(other.levels)) - len(levels))
+                               for levels in (self.levels, other.levels)))]
+        merged.count = self.count + other.count
+        merged.min = min(self.min, other.min)
+        merged.max = max(self.max, other.max)
+        merged._compress()
+        return merged
+
+    def quantiles(self, fractions):
+        """Values at each rank fraction (0..1), or None when empty."""
+        if not self.count:
+            return [None] * len(fractions)
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 1 << level) for level, items in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        items, ranks = items[order], np.cumsum(weights[order])
+        results = []
+        for fraction in fractions:
+            if fraction <= 0:
+                results.append(self.min)
+            elif fraction >= 1:
+                results.append(self.max)
+            else:
+                position = min(int(np.searchsorted(ranks, fraction * ranks[-1])), len(items) - 1)
+                results.append(float(items[position]))
+        return results
+
+
+class Moments:
+    """Exact count, sum, mean and sum of squared deviations, merged with Chan's formula."""
+
+    def __init__(self, count=0, total=0.0, mean=0.0, m2=0.0):
+        self.count = count
+        self.total = total
+        self.mean = mean
+        self.m2 = m2
+
+    @classmethod
+    def of(cls, values):
+        if not len(values):
+            return cls()
+        mean = float(values.mean())
+        return cls(len(values), float(values.sum()), mean, float(((values - mean) ** 2).sum()))
+
+    def merge(self, other):
+        count = self.count + other.count
+        if not count:
+            return Moments()
+        delta = other.mean - self.mean
+        return Moments(count, self.total + other.total, self.mean + delta * other.count / count,
+                       self.m2 + other.m2 + delta * delta * self.count * other.count / count)
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else None
+
+
+def column_kind(values):
+    """'number', 'datetime' or 'other': what a column's sketch can tell about it."""
+    if is_datetime64_any_dtype(values):
+        return 'datetime'
+    if is_numeric_dtype(values) and not is_bool_dtype(values):
+        return 'number'
+    return 'other'
+
+
+class ColumnSketch:
+    """Sketch of one column; quantiles and moments only for numbers (quantiles for dates too)."""
+
+    def __init__(self, kind, distinct, quantiles=None, moments=None, rows=0, nulls=0):
+        self.kind = kind
+        self.distinct = distinct
+        self.quantiles = quantiles
+        self.moments = moments
+        self.rows = rows
+        self.nulls = nulls
+
+    @classmethod
+    def build(cls, values, seed=None):
+        kind = column_kind(values)
+        distinct = HyperLogLog()
+        distinct.update(value_hashes(values))
+        nulls = int(values.isna().sum())
+        if kind == 'other':
+            return cls(kind, distinct, rows=len(values), nulls=nulls)
+
+        if kind == 'datetime':
+            numbers = values.dropna().to_numpy(dtype='datetime64[ns]').view('int64').astype('float64')
+            moments = None
+        else:
+            numbers = to_numeric(values).to_numpy(dtype='float64', na_value=np.nan)
+            numbers = numbers[~np.isnan(numbers)]
+            moments = Moments.of(numbers)
+        quantiles = KllSketch(seed=seed)
+        quantiles.update(numbers)
+        return cls(kind, distinct, quantiles, moments, len(values), nulls)
+
+    def merge(self, other):
+        distinct = self.distinct.merge(other.distinct)
+        rows, nulls = self.rows + other.rows, self.nulls + other.nulls
+        if self.kind != other.kind:
+            # Chunks disagreeing on the column's type (numbers in one, text in another)
+            return ColumnSketch('other', distinct, rows=rows, nulls=nulls)
+        quantiles = self.quantiles.merge(other.quantiles) if self.quantiles is not None else None
+        moments = self.moments.merge(other.moments) if self.moments is not None else None
+        return ColumnSketch(self.kind, distinct, quantiles, moments, rows, nulls)
+
+    def _value(self, value):
+        if value is None:
+            return None
+        if self.kind == 'datetime':
+            return pd.Timestamp(int(value)).isoformat()
+        return value
+
+    def describe(self, fractions):
+        """The estimates, with their error bounds, as a JSON-friendly dict."""
+        count = self.rows - self.nulls
+        estimate = min(self.distinct.estimate(), count)
+        error = HLL_SIGMAS * self.distinct.relative_error
+        stats = {
+            'rows': self.rows,
+            'count': count,
+            'null_count': self.nulls,
+            'distinct_count': {
+                'estimate': int(round(estimate)),
+                'lower': int(math.floor(estimate * (1 - error))),
+                'upper': int(min(math.ceil(estimate * (1 + error)), count)),
+                'relative_error': round(error, 6),
+            },
+        }
+        if self.moments is not None:
+            moments = self.moments
+            stats.update({
+                'numeric_count': moments.count,
+                'sum': moments.total,
+                'average': moments.mean if moments.count else None,
+                'std': moments.std,
+            })
+        if self.quantiles is not None:
+            sketch = self.quantiles
+            rank_error = sketch.rank_error
+            stats['min'] = self._value(sketch.min if sketch.count else None)
+            stats['max'] = self._value(sketch.max if sketch.count else None)
+            values = sketch.quantiles(fractions)
+            lower = sketch.quantiles([max(q - rank_error, 0.0) for q in fractions])
+            upper = sketch.quantiles([min(q + rank_error, 1.0) for q in fractions])
+            stats['quantiles'] = {
+                str(q): {'value': self._value(v), 'lower': self._value(lo), 'upper': self._value(hi)}
+                for q, v, lo, hi in zip(fractions, values, lower, upper)
+            }
+            stats['rank_error'] = round(rank_error, 6)
+        return stats
+
+
+class RowSample:
+    """A uniform sample of at most ``size`` of the ``seen`` rows of a frame."""
+
+    def __init__(self, rows, seen, size, seed=None):
+        self.rows = rows
+        self.seen = seen
+        self.size = size
+        self._rng = np.random.default_rng(seed)
+
+    @classmethod
+    def of(cls, df, size=SKETCH_SAMPLE_ROWS, seed=None):
+        sample = cls(None, len(df), size, seed)
+        sample.rows = df.sample(n=min(size, len(df)), random_state=sample._rng).reset_index(drop=True)
+        return sample
+
+    def merge(self, other):
+        seen = self.seen + other.seen
+        merged = RowSample(None, seen, self.size, self._rng.integers(1 << 32))
+        if seen <= self.size:
+            merged.rows = concat_frames([self.rows, other.rows])
+            merged.rows = merged.rows.sample(frac=1, random_state=merged._rng).reset_index(drop=True)
+            return merged
+        # How many of the merged sample's rows come from each side, as if drawn from all rows at once
+        taken = merged._rng.hypergeometric(self.seen, other.seen, self.size)
+        merged.rows = concat_frames([
+            self.rows.sample(n=taken, random_state=merged._rng),
+            other.rows.sample(n=self.size - taken, random_state=merged._rng),
+        ])
+        # Shuffled, so any first rows of it are a sample too
+        merged.rows = merged.rows.sample(frac=1, random_state=merged._rng).reset_index(drop=True)
+        return merged
+
+    def histogram(self, column, total, bins, low=None, high=None):
+        """
+        Estimated counts among ``total`` rows: per bin of a number column
+        (between ``low`` and ``high`` when given), or of its most frequent
+        values otherwise.
+        """
+        values = self.rows[column]
+        sampled = len(values)
+
+        def estimate(hits):
+            share = hits / sampled if sampled else 0.0
+            error = SAMPLE_SIGMAS * math.sqrt(share * (1 - share) / sampled) if sampled else 1.0
+            return {'count': int(round(share * total)), 'error': int(math.ceil(error * total))}
+
+        if column_kind(values) == 'number':
+            numbers = to_numeric(values).to_numpy(dtype='float64', na_value=np.nan)
+            numbers = numbers[~np.isnan(numbers)]
+            if not len(numbers) and low is None:
+                return {'bins': []}
+            value_range = (low if low is not None else numbers.min(), high if high is not None else numbers.max())
+            counts, edges = np.histogram(numbers, bins=bins, range=value_range)
+            return {'bins': [{'low': float(lo), 'high': float(hi), **estimate(int(hits))}
+                             for lo, hi, hits in zip(edges[:-1], edges[1:], counts)]}
+
+        counts = values.astype(object).where(values.notna(), None).value_counts(dropna=False).head(bins)
+        return {'values': [{'value': None if pd.isna(value) else str(value), **estimate(int(hits))}
+                           for value, hits in counts.items()]}
+
+
+class FrameSketch:
+    """Column sketches of a frame, by column name, and a sample of its rows (or None)."""
+
+    def __init__(self, columns, sample=None):
+        self.columns = columns
+        self.sample = sample
+
+    @classmethod
+    def build(cls, df, columns=None, sample_rows=SKETCH_SAMPLE_ROWS, seed=None):
+        """Sketch ``columns`` (default: all) of ``df``, with a sample of ``sample_rows`` rows if not 0."""
+        columns = list(df.columns) if columns is None else columns
+        seeds = np.random.SeedSequence(seed).spawn(len(columns) + 1)
+        sketches = {col: ColumnSketch.build(df[col], column_seed) for col, column_seed in zip(columns, seeds)}
+        sample = RowSample.of(df, sample_rows, seeds[-1]) if sample_rows else None
+        return cls(sketches, sample)
+
+    def merge(self, other):
+        columns = dict(self.columns)
+        for col, sketch in other.columns.items():
+            columns[col] = columns[col].merge(sketch) if col in columns else sketch
+        if self.sample is None or other.sample is None:
+            sample = self.sample or other.sample
+        else:
+            sample = self.sample.merge(other.sample)
+        return FrameSketch(columns, sample)
+
+
+def sketch_frame(df, columns=None, sample_rows=SKETCH_SAMPLE_ROWS, seed=0):
+    """``FrameSketch.build`` ``CHUNK_ROWS`` rows at a time, merging as it goes."""
+    sketch = None
+    for index, start in enumerate(range(0, max(len(df), 1), CHUNK_ROWS)):
+        chunk = FrameSketch.build(df.iloc[start:start + CHUNK_ROWS], columns, sample_rows, (seed, index))
+        sketch = chunk if sketch is None else sketch.merge(chunk)
+    return sketch
+
+
+def seed_sketches(entry, sketch):
+    """Memoize a sketch of a dataset's upload (built while it was ingested)."""
+    with entry.lock:
+        for col, column_sketch in sketch.columns.items():
+            entry.stats_cache[(col, 0, 'sketch')] = column_sketch
+        if sketch.sample is not None:
+            entry.versions[0].cache[SAMPLE_CACHE_KEY] = sketch.sample
+
+
+def dataset_sketch(entry, build, columns=None, sample=False, original=False):
+    """
+    The memoized sketch of ``columns`` (default: all) of a stored dataset,
+    with its row sample if ``sample``. ``build(columns, sample_rows)``
+    sketches the current (or original) version's columns that aren't
+    memoized yet. Returns ``(sketch, cached_columns)``.
+    """
+    with entry.lock:
+        df_columns = entry.node.shape_info()[1] if not original else entry.versions[0].shape_info()[1]
+        columns = list(df_columns) if columns is None else columns
+        missing = [col for col in columns if col not in df_columns]
+        if missing:
+            raise ApiError(f'Column {missing[0]} not found')
+        keys = {col: (col, entry.column_version(col, original), 'sketch') for col in columns}
+        cache = entry.cache(original)
+        sketches = {col: entry.stats_cache.get(key) for col, key in keys.items()}
+        row_sample = cache.get(SAMPLE_CACHE_KEY) if sample else None
+
+    todo = [col for col, sketch in sketches.items() if sketch is None]
+    if todo or (sample and row_sample is None):
+        built = build(todo, SKETCH_SAMPLE_ROWS if sample and row_sample is None else 0)
+        for col in todo:
+            sketches[col] = entry.stats_cache[keys[col]] = built.columns[col]
+        if sample and row_sample is None:
+            row_sample = cache[SAMPLE_CACHE_KEY] = built.sample
+    cached = [col for col in columns if col not in todo]
+    return FrameSketch(sketches, row_sample), cached
@@ -0,0 +1,90 @@
+"""
+Column statistics.
+
+All statistics of a column (sum, mean, min, max, count, std, null and
+distinct counts, quantiles) come from one numeric conversion of the column
+and vectorized reductions over the resulting array. Results for stored
+datasets are memoized per (column, column version), so they are reused
+until a transformation actually changes that column.
+"""
+import numpy as np
+from pandas.api.types import is_integer_dtype
+
+from dtypes import to_numeric
+from errors import ApiError
+
+DEFAULT_QUANTILES = (0.25, 0.5, 0.75)
+
+
+def _number(value):
+    """A JSON-friendly number: numpy scalars to Python, NaN to None."""
+    if value is None:
+        return None
+    value = value.item() if hasattr(value, 'item') else value
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def compute_column_stats(series, quantiles=DEFAULT_QUANTILES):
+    """Statistics for one column; numeric ones ignore values that are not numbers."""
+    numeric = to_numeric(series).dropna()
+    values = numeric.to_numpy(dtype='int64' if is_integer_dtype(numeric) else 'float64')
+    count = int(series.notna().sum())
+
+    stats = {
+        'count': count,
+        'null_count': len(series) - count,
+        'distinct_count': int(series.nunique(dropna=True)),
+        'numeric_count': int(values.size),
+        'sum': _number(values.sum()) if values.size else 0,
+        'average': None,
+        'min': None,
+        'max': None,
+        'std': None,
+        'quantiles': {str(q): None for q in quantiles},
+    }
+    if values.size:
+        stats['average'] = _number(values.mean())
+        stats['min'] = _number(values.min())
+        stats['max'] = _number(values.max())
+        if values.size > 1:
+            stats['std'] = _number(values.std(ddof=1))
+        if quantiles:
+            stats['quantiles'] = {
+                str(q): _number(v) for q, v in zip(quantiles, np.quantile(values, quantiles))
+            }
+    return stats
+
+
+def parse_quantiles(quantiles):
+    if quantiles is None:
+        return DEFAULT_QUANTILES
+    try:
+        quantiles = tuple(float(q) for q in quantiles)
+    except (TypeError, ValueError):
+        raise ApiError('quantiles must be a list of numbers')
+    if any(not 0 <= q <= 1 for q in quantiles):
+        raise ApiError('quantiles must be between 0 and 1')
+    return quantiles
+
+
+def column_stats(entry, column, quantiles=DEFAULT_QUANTILES, original=False):
+    """
+    Memoized statistics for a column of a stored dataset.
+
+    Returns ``(stats, cached)``.
+    """
+    with entry.lock:
+        df = entry.frame(original)
+        version = entry.column_version(column, original)
+    if column not in df.columns:
+        raise ApiError(f'Column {column} not found')
+
+    key = (column, version, tuple(quantiles))
+    stats = entry.stats_cache.get(key)
+    if stats is not None:
+        return stats, True
+
+    stats = entry.stats_cache[key] = compute_column_stats(df[column], quantiles)
+    return stats, False
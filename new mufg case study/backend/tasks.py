@@ -0,0 +1,105 @@
+"""
+Job functions run by the background job workers (see jobs.py).
+
+They are module-level so worker processes can import them, and take plain
+arguments: a frame is passed either as a DataFrame or, for a stored
+dataset, as the path of its persisted file, which the worker opens itself
+instead of having the frame pickled across.
+"""
+import os
+import shutil
+
+from config import EXCEL_ENGINE, JOB_CHUNK_ROWS
+from dtypes import optimize_frame
+from export import exporter, iter_chunks
+from financials import check_columns, merge_period_totals, period_totals, pl_report
+from ingest import CsvIngest
+from persistence import ORIGINAL_FILE, PARTS_DIR, open_persisted_frame, write_feather
+from query import FrameIndexes, filter_columns, select_rows
+from workbooks import read_sheet
+
+
+def open_frame(frame):
+    """A DataFrame from a job argument: a DataFrame, or the path of a persisted frame."""
+    if isinstance(frame, str):
+        return open_persisted_frame(frame).read()
+    return frame
+
+
+def _frame_parts(frame, columns):
+    """``(columns, parts, rows)``: a frame as chunks, reading a persisted one part by part."""
+    if isinstance(frame, str):
+        source = open_persisted_frame(frame)
+        return source.columns, source.iter_parts(columns), source.rows
+    return list(frame.columns), (chunk[columns] for chunk in iter_chunks(frame, JOB_CHUNK_ROWS)), len(frame)
+
+
+def period_pl_job(context, frame, date_col, revenue_col, cost_col, periods, fiscal_year_start=1, result_key=None,
+                  row_filter=None):
+    """
+    Period P&L aggregated chunk by chunk, with the totals so far as the
+    partial result; with a parsed ``row_filter`` only matching rows count.
+    """
+    columns = list(dict.fromkeys([date_col, revenue_col, cost_col, *sorted(filter_columns(row_filter))]))
+    available, parts, rows = _frame_parts(frame, columns)
+    check_columns(available, date_col, revenue_col, cost_col)
+    totals = {period: merge_period_totals([]) for period in periods}
+    done = 0
+    for part in parts:
+        matching = select_rows(FrameIndexes(part), row_filter) if row_filter is not None else None
+        chunk_totals = period_totals(part, date_col, revenue_col, cost_col, periods, fiscal_year_start,
+                                     rows=matching)
+        totals = {period: merge_period_totals([totals[period], chunk_totals[period]]) for period in periods}
+        done += len(part)
+        context.progress(done / rows if rows else 1.0, f'{done:,} of {rows:,} rows',
+                         partial=pl_report(totals, fiscal_year_start, result_key))
+    return {'success': True, **pl_report(totals, fiscal_year_start, result_key)}
+
+
+def ingest_upload_job(context, upload_path, filename, dataset_dir):
+    """
+    Parse an uploaded file into ``dataset_dir``: CSV through the chunked
+    ingest (as Parquet parts), Excel into a Feather file. Returns the name
+    of the file holding the dataset.
+    """
+    try:
+        if filename.lower().endswith('.csv'):
+            with open(upload_path, 'rb') as f:
+                ingest = CsvIngest(f, os.path.join(dataset_dir, PARTS_DIR))
+                for progress in ingest.run():
+                    context.progress(progress.get('fraction'), f"{progress['rows']:,} rows read")
+            return {'file': PARTS_DIR}
+
+        context.progress(0.0, 'parsing workbook')
+        df = optimize_frame(read_sheet(upload_path, engine=EXCEL_ENGINE))
+        context.progress(0.9, f'{len(df):,} rows parsed, saving')
+        os.makedirs(dataset_dir, exist_ok=True)
+        write_feather(df, os.path.join(dataset_dir, ORIGINAL_FILE))
+        return {'file': ORIGINAL_FILE}
+
+    except BaseException:
+        shutil.rmtree(dataset_dir, ignore_errors=True)
+        raise
+    finally:
+        os.remove(upload_path)
+
+
+def export_job(context, frame, file_format, output_path):
+    """Write an export file, reporting the rows written so far."""
+    df = open_frame(frame)
+    _, export = exporter(file_format)
+
+    def progress(done, total):
+        context.progress(done / total if total else 1.0, f'{done:,} of {total:,} rows written',
+                         partial={'rows_written': done})
+
+    tmp_path = output_path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            for block in export(df, progress=progress):
+                f.write(block)
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return {'format': file_format, 'rows': len(df), 'bytes': os.path.getsize(output_path)}
@@ -0,0 +1,111 @@
+"""
+Text cleanup on Arrow-backed string columns.
+
+Text columns are converted once to ``string[pyarrow]``, whose nulls are
+real nulls (None, NaN and pd.NA all become <NA>, and the text "nan" stays
+text), and then go through pyarrow compute kernels: regex replacements
+(RE2 syntax, ``\\1`` for groups), whitespace collapsing, stripping and case
+normalization, in that order. ``category`` columns are cleaned through
+their categories only and stay ``category``.
+"""
+import numpy as np
+import pandas as pd
+
+from errors import ApiError
+
+ARROW_STRING = 'string[pyarrow]'
+
+CASES = ('lower', 'upper', 'title')
+
+# Options of the trim-whitespaces step, and their defaults
+DEFAULT_OPTIONS = {
+    'columns': None,
+    'strip': True,
+    'case': None,
+    'collapse_whitespace': False,
+    'replace': [],
+}
+
+
+def _check_pattern(pattern, replacement):
+    """Compile ``pattern`` the way the kernel will, so a bad one fails before any data is touched."""
+    try:
+        pd.Series([''], dtype=ARROW_STRING).str.replace(pattern, replacement, regex=True)
+    except ValueError as e:
+        raise ApiError(f'Invalid replace pattern {pattern!r}: {e}')
+
+
+def parse_options(payload):
+    """
+    The text cleanup options given in ``payload`` (a request body or a
+    pipeline step), validated; options left at their default are omitted.
+    """
+    options = {}
+    columns = payload.get('columns')
+    if columns is not None:
+        if not isinstance(columns, list) or not all(isinstance(col, str) for col in columns):
+            raise ApiError('columns must be a list of column names')
+        options['columns'] = columns
+
+    for flag in ('strip', 'collapse_whitespace'):
+        value = payload.get(flag)
+        if value is None:
+            continue
+        if not isinstance(value, bool):
+            raise ApiError(f'{flag} must be true or false')
+        if value != DEFAULT_OPTIONS[flag]:
+            options[flag] = value
+
+    case = payload.get('case')
+    if case is not None:
+        if case not in CASES:
+            raise ApiError(f"case must be one of {', '.join(CASES)}")
+        options['case'] = case
+
+    replace = payload.get('replace')
+    if replace:
+        if not isinstance(replace, list):
+            raise ApiError('replace must be a list of {"pattern": ..., "replacement": ...} objects')
+        for rule in replace:
+            if (not isinstance(rule, dict) or not isinstance(rule.get('pattern'), str) or not rule['pattern']
+                    or not isinstance(rule.get('replacement', ''), str)):
+                raise ApiError('replace must be a list of {"pattern": ..., "replacement": ...} objects')
+            _check_pattern(rule['pattern'], rule.get('replacement', ''))
+        options['replace'] = [{'pattern': rule['pattern'], 'replacement': rule.get('replacement', '')}
+                              for rule in replace]
+    return options
+
+
+def is_idempotent(options):
+    """Whether cleaning twice with ``options`` gives the same text as cleaning once."""
+    # Stripping, collapsing and case changes are; a replacement may match its own output
+    return not options.get('replace')
+
+
+def _clean_strings(values, strip, case, collapse_whitespace, replace):
+    for rule in replace:
+        values = values.str.replace(rule['pattern'], rule['replacement'], regex=True)
+    if collapse_whitespace:
+        values = values.str.replace(r'\s+', ' ', regex=True)
+    if strip:
+        values = values.str.strip()
+    if case:
+        values = getattr(values.str, case)()
+    return values
+
+
+def clean_text(values, strip=True, case=None, collapse_whitespace=False, replace=()):
+    """
+    Cleaned copy of a text Series: ``string[pyarrow]``, or ``category`` for
+    a ``category`` Series (categories that clean to the same text merge).
+    """
+    options = (strip, case, collapse_whitespace, replace)
+    if not isinstance(values.dtype, pd.CategoricalDtype):
+        return _clean_strings(values.astype(ARROW_STRING), *options)
+
+    categories = _clean_strings(pd.Series(values.cat.categories, dtype=ARROW_STRING), *options)
+    remap, uniques = pd.factorize(categories)
+    # Null values have code -1, which picks the trailing -1
+    codes = np.append(remap, -1)[values.cat.codes.to_numpy()]
+    cleaned = pd.Categorical.from_codes(codes, categories=np.asarray(uniques, dtype=object))
+    return pd.Series(cleaned, index=values.index, name=values.name)
@@ -0,0 +1,195 @@
+"""
+Time bucketing for period reports.
+
+A date column is parsed once into int64 nanoseconds since the epoch
+(``NAT`` where a value is not a date). For stored datasets the parsed
+values are memoized per (column, column version), like column statistics,
+so repeated reports skip ``pd.to_datetime`` until a transformation changes
+the date column. Text dates are parsed with the format pandas infers from
+the column's first value (``infer_date_format``); parsing more rows of the
+same column later (appended ones) pins that format rather than inferring
+one from the new rows alone.
+
+Buckets are integer period codes derived with integer arithmetic and
+``datetime64`` unit casts, totals are summed per code with ``np.bincount``,
+and string labels are only built for the distinct codes that occur.
+Quarters and years can follow a fiscal year starting in any month.
+"""
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from errors import ApiError
+
+try:
+    from pandas.tseries.api import guess_datetime_format
+except ImportError:
+    # pandas < 2.2
+    from pandas._libs.tslibs.parsing import guess_datetime_format
+
+GRANULARITIES = ('day', 'week', 'month', 'quarter', 'year')
+
+NAT = np.iinfo(np.int64).min
+NS_PER_DAY = 86_400 * 10**9
+# 1970-01-01 was a Thursday; shifting by 3 days makes weeks start on Monday
+WEEK_SHIFT_DAYS = 3
+
+# Text values pd.to_datetime passes over when inferring a column's date format
+SKIPPED_DATE_STRINGS = ['', 'now', 'today', 'NaT', 'nat', 'NAT', 'nan', 'NaN', 'NAN']
+
+# Codes spanning up to this many buckets are summed by direct indexing, wider ones via np.unique
+MAX_DENSE_BUCKETS = 1 << 20
+
+
+def parse_granularities(granularities, default=('month',)):
+    """A list, or a comma-separated string, of granularity names."""
+    if not granularities:
+        return list(default)
+    if isinstance(granularities, str):
+        granularities = [g.strip() for g in granularities.split(',') if g.strip()]
+    unknown = [g for g in granularities if g not in GRANULARITIES]
+    if unknown:
+        raise ApiError(f"Unknown granularity '{unknown[0]}', expected one of {', '.join(GRANULARITIES)}")
+    return list(dict.fromkeys(granularities))
+
+
+def parse_fiscal_year_start(value):
+    """The month (1-12) a fiscal year starts in; 1 means calendar years."""
+    if value is None:
+        return 1
+    try:
+        month = int(value)
+    except (TypeError, ValueError):
+        raise ApiError('fiscal_year_start must be a month number (1-12)')
+    if not 1 <= month <= 12:
+        raise ApiError('fiscal_year_start must be a month number (1-12)')
+    return month
+
+
+def infer_date_format(series):
+    """
+    The format ``pd.to_datetime`` infers for a text date column, from its
+    first value that isn't null, empty or a null-like string such as 'NaT':
+    a strftime format, or 'mixed' when none fits and every value is parsed
+    on its own. None when that value isn't text.
+    """
+    candidates = series.notna() & ~series.isin(SKIPPED_DATE_STRINGS)
+    present = candidates.to_numpy(dtype=bool, na_value=False)
+    if not present.any():
+        return None
+    first = series.iloc[int(present.argmax())]
+    if not isinstance(first, str):
+        return None
+    with warnings.catch_warnings():
+        # pd.to_datetime warns about day-first formats itself when it parses the column
+        warnings.simplefilter('ignore', UserWarning)
+        return guess_datetime_format(first) or 'mixed'
+
+
+def parse_epoch(series, date_format=None):
+    """
+    A date column as int64 nanoseconds since the epoch, ``NAT`` where it
+    isn't a date; text is parsed with ``date_format`` if given.
+    """
+    dates = pd.to_datetime(series, errors='coerce', format=date_format)
+    if getattr(dates.dt, 'tz', None) is not None:
+        # Bucket by local wall-clock time
+        dates = dates.dt.tz_localize(None)
+    return dates.to_numpy(dtype='datetime64[ns]').view('int64')
+
+
+def date_index(entry, column, original=False):
+    """
+    Memoized ``parse_epoch`` of a column of a stored dataset.
+
+    Returns ``(epoch, cached)``; ``epoch`` is read-only.
+    """
+    with entry.lock:
+        df = entry.frame(original)
+        version = entry.column_version(column, original)
+    if column not in df.columns:
+        raise ApiError(f'Column {column} not found')
+
+    key = (column, version, 'epoch')
+    epoch = entry.stats_cache.get(key)
+    if epoch is not None:
+        return epoch, True
+
+    epoch = parse_epoch(df[column])
+    epoch.flags.writeable = False
+    entry.stats_cache[key] = epoch
+    return epoch, False
+
+
+def bucket_codes(epoch, granularity, fiscal_year_start=1):
+    """
+    ``(codes, valid)``: the period code of every valid date in ``epoch`` and
+    the mask of valid dates. Codes count periods from the one holding
+    1970-01-01 and sort chronologically.
+    """
+    valid = epoch != NAT
+    values = epoch[valid]
+    if granularity == 'day':
+        return values // NS_PER_DAY, valid
+    if granularity == 'week':
+        return (values // NS_PER_DAY + WEEK_SHIFT_DAYS) // 7, valid
+
+    # Months since 1970-01, shifted so fiscal years start at a multiple of 12
+    months = values.view('datetime64[ns]').astype('datetime64[M]').view('int64')
+    if granularity == 'month':
+        return months, valid
+    months = months - (fiscal_year_start - 1)
+    if granularity == 'quarter':
+        return months // 3, valid
+    if granularity == 'year':
+        return months // 12, valid
+    raise ApiError(f"Unknown granularity '{granularity}', expected one of {', '.join(GRANULARITIES)}")
+
+
+def bucket_labels(codes, granularity, fiscal_year_start=1):
+    """
+    Labels for period codes: '2024-03-31' (days, and weeks by their Monday),
+    '2024-03', '2024-Q1', '2024'. Fiscal quarters and years are prefixed
+    'FY' and named after the calendar year the fiscal year starts in.
+    """
+    codes = np.asarray(codes, dtype='int64')
+    if granularity == 'day':
+        return list(np.datetime_as_string(codes.astype('datetime64[D]')))
+    if granularity == 'week':
+        return list(np.datetime_as_string((codes * 7 - WEEK_SHIFT_DAYS).astype('datetime64[D]')))
+    if granularity == 'month':
+        return list(np.datetime_as_string(codes.astype('datetime64[M]')))
+
+    prefix = 'FY' if fiscal_year_start != 1 else ''
+    if granularity == 'quarter':
+        years, quarters = np.divmod(codes, 4)
+        return [f'{prefix}{1970 + year}-Q{quarter + 1}' for year, quarter in zip(years.tolist(), quarters.tolist())]
+    return [f'{prefix}{1970 + year}' for year in codes.tolist()]
+
+
+def bucket_sums(epoch, values, granularity, fiscal_year_start=1):
+    """
+    Sums of each array in ``values`` (``{name: float array}`` aligned with
+    ``epoch``) per period, as a frame indexed by period code in
+    chronological order. Rows without a valid date are left out and NaN
+    values count as 0; periods with no rows are not listed.
+    """
+    codes, valid = bucket_codes(epoch, granularity, fiscal_year_start)
+    weights = {name: np.nan_to_num(np.asarray(array, dtype='float64')[valid]) for name, array in values.items()}
+
+    if not len(codes):
+        return pd.DataFrame({name: np.empty(0) for name in values},
+                            index=pd.Index(np.empty(0, dtype='int64'), name=granularity))
+
+    low, high = int(codes.min()), int(codes.max())
+    if high - low < MAX_DENSE_BUCKETS:
+        positions = codes - low
+        present = np.flatnonzero(np.bincount(positions, minlength=high - low + 1))
+        index = present + low
+        sums = {name: np.bincount(positions, weights=w, minlength=high - low + 1)[present]
+                for name, w in weights.items()}
+    else:
+        index, positions = np.unique(codes, return_inverse=True)
+        sums = {name: np.bincount(positions, weights=w, minlength=len(index)) for name, w in weights.items()}
+    return pd.DataFrame(sums, index=pd.Index(index, name=granularity))
@@ -0,0 +1,130 @@
+"""
+Dataset transformations shared by the single-operation endpoints and the
+/pipeline endpoint. Each takes a DataFrame and returns a new one; the input
+frame is never modified.
+"""
+import pandas as pd
+
+from dtypes import to_numeric
+from errors import ApiError
+from expressions import evaluate_expressions, parse_expressions
+from text_cleaning import clean_text
+
+
+def remove_nulls(df):
+    # Remove rows with any null values
+    return df.dropna()
+
+
+def remove_duplicates(df):
+    # Remove duplicate rows
+    return df.drop_duplicates()
+
+
+def rename_columns(df, rename_map):
+    return df.rename(columns=rename_map)
+
+
+def convert_column(values, dtype, date_format=None):
+    """
+    ``values`` converted to 'date', 'int', 'float' or 'string' (unchanged for
+    any other name); raises when they can't be, as 'int' of fractional values.
+    """
+    if dtype == 'date':
+        return pd.to_datetime(values, errors='coerce', format=date_format)
+    elif dtype == 'int':
+        return to_numeric(values).astype('Int64')
+    elif dtype == 'float':
+        return to_numeric(values)
+    elif dtype == 'string':
+        return values.astype(str)
+    return values
+
+
+def change_datatypes(df, dtype_map, date_formats=None):
+    """
+    Convert columns to 'date', 'int', 'float' or 'string'. Dates are parsed
+    with ``date_formats[column]`` when given, otherwise with the format pandas
+    infers from the column's first non-null value.
+    """
+    # Shallow copy: columns are replaced, never modified, so the others stay shared
+    df = df.copy(deep=False)
+    date_formats = date_formats or {}
+
+    # Convert data types
+    for col, dtype in dtype_map.items():
+        if col in df.columns:
+            try:
+                df[col] = convert_column(df[col], dtype, date_formats.get(col))
+            except Exception:
+                # If conversion fails, keep original
+                pass
+    return df
+
+
+def text_columns(df):
+    """
+    Columns holding text: string dtypes, and object and category columns
+    whose values are strings (not numbers or booleans kept as objects or
+    categories).
+    """
+    def is_text(values):
+        if isinstance(values.dtype, pd.StringDtype):
+            return True
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            return pd.api.types.infer_dtype(values.cat.categories) == 'string'
+        return values.dtype == 'object' and pd.api.types.infer_dtype(values, skipna=True) == 'string'
+
+    return [col for col in df.columns if is_text(df[col])]
+
+
+def trim_whitespaces(df, columns=None, strip=True, case=None, collapse_whitespace=False, replace=()):
+    """
+    Clean the text ``columns`` (all text columns by default) with the Arrow
+    string kernels of ``text_cleaning``: strip, and optionally apply regex
+    replacements, collapse whitespace runs and normalize case. Nulls stay null.
+    """
+    if columns is None:
+        columns = text_columns(df)
+    else:
+        missing = [col for col in columns if col not in df.columns]
+        if missing:
+            raise ApiError(f"Columns not found: {', '.join(missing)}")
+        not_text = [col for col in columns if col not in text_columns(df[columns])]
+        if not_text:
+            raise ApiError(f"Not text columns: {', '.join(not_text)}")
+
+    df = df.copy(deep=False)
+    for col in columns:
+        df[col] = clean_text(df[col], strip, case, collapse_whitespace, replace)
+    return df
+
+
+COLUMN_OPERATIONS = {
+    'add': ('{column1}_plus_{column2}', lambda col1, col2: col1 + col2),
+    'subtract': ('{column1}_minus_{column2}', lambda col1, col2: col1 - col2),
+    'multiply': ('{column1}_times_{column2}', lambda col1, col2: col1 * col2),
+    # Division by zero gives null
+    'divide': ('{column1}_divided_by_{column2}', lambda col1, col2: col1.div(col2.where(col2 != 0))),
+}
+
+
+def column_operation(df, operation, column1, column2, result_column=None):
+    """Add ``column1 <operation> column2`` of two numeric columns as a new column."""
+    default_name, func = COLUMN_OPERATIONS[operation]
+    if result_column is None:
+        result_column = default_name.format(column1=column1, column2=column2)
+
+    if column1 not in df.columns or column2 not in df.columns:
+        raise ApiError('One or both columns not found')
+
+    # Convert to numeric
+    col1 = to_numeric(df[column1])
+    col2 = to_numeric(df[column2])
+
+    return df.assign(**{result_column: func(col1, col2)})
+
+
+def derive_columns(df, expressions):
+    """Add the columns ``expressions`` (``{result_column: expression}``, see expressions.py) compute."""
+    return df.assign(**evaluate_expressions(df, parse_expressions(expressions)))
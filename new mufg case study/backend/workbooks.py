@@ -0,0 +1,256 @@
+"""
+Excel workbook parsing: single uploads, and batches of files and sheets
+parsed in parallel.
+
+Sheets are read with the Rust ``calamine`` reader when the optional
+``python-calamine`` package is installed (``EXCEL_ENGINE=auto``), which is
+several times faster than openpyxl, and with ``pd.read_excel``'s default
+engine otherwise. Calamine's cells are converted the way ``pd.read_excel``
+types them, so both engines give the same frames: empty cells are nulls,
+whole-number columns without gaps are int64, date cells make datetime64
+columns and mixed columns keep whole numbers as ints.
+
+A batch is a list of (file, sheet) sources. Each is parsed on its own, in a
+pool of ``workers`` processes when there is more than one, and the sources'
+columns are compared in a schema report (``schema_report``) before they
+are concatenated or stored as separate datasets.
+"""
+import datetime
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from pandas.api.types import (
+    infer_dtype, is_bool_dtype, is_datetime64_any_dtype, is_numeric_dtype
+)
+
+from dtypes import optimize_frame
+from errors import ApiError
+
+try:
+    import python_calamine
+except ImportError:
+    python_calamine = None
+
+ENGINES = ('auto', 'calamine', 'pandas')
+
+EXCEL_EXTENSIONS = ('.xls', '.xlsx')
+
+# infer_dtype kinds of object columns, as the kinds schema_report compares
+_OBJECT_KINDS = {
+    'string': 'text', 'empty': None,
+    'integer': 'number', 'floating': 'number', 'mixed-integer-float': 'number', 'decimal': 'number',
+    'boolean': 'bool', 'datetime': 'datetime', 'datetime64': 'datetime', 'date': 'datetime',
+}
+
+
+def resolve_engine(engine):
+    """The engine ``engine`` (one of ENGINES) stands for: 'calamine' or 'pandas'."""
+    if engine not in ENGINES:
+        raise ApiError(f"engine must be one of {', '.join(ENGINES)}")
+    if engine == 'auto':
+        return 'calamine' if python_calamine is not None else 'pandas'
+    if engine == 'calamine' and python_calamine is None:
+        raise ApiError('The calamine engine needs the python-calamine package')
+    return engine
+
+
+def sheet_names(source, engine='auto'):
+    """Names of the sheets of a workbook (a path or a binary file object), in order."""
+    if resolve_engine(engine) == 'calamine':
+        return python_calamine.CalamineWorkbook.from_object(source).sheet_names
+    with pd.ExcelFile(source) as workbook:
+        return workbook.sheet_names
+
+
+def _column_label(value, position):
+    if value is None or value == '':
+        return f'Unnamed: {position}'
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _header(cells):
+    """Column labels from a header row, with pandas' names for blank and repeated ones."""
+    labels, seen = [], {}
+    for position, cell in enumerate(cells):
+        label = _column_label(cell, position)
+        if label in seen:
+            seen[label] += 1
+            label = f'{label}.{seen[label]}'
+        seen.setdefault(label, 0)
+        labels.append(label)
+    return labels
+
+
+def _whole_to_int(value):
+    return int(value) if isinstance(value, float) and value.is_integer() else value
+
+
+def _calamine_column(values):
+    """One column of calamine cells, typed the way ``pd.read_excel`` types it."""
+    empty = values.eq('')
+    values = values.mask(empty)
+    kinds = set(map(type, values[~empty]))
+    if not kinds:
+        # No values at all: a float column of NaN, like pandas'
+        return values.astype('float64') if len(values) else values
+    if kinds <= {float, int}:
+        numbers = values.astype('float64')
+        if not empty.any() and (numbers % 1 == 0).all():
+            return numbers.astype('int64')
+        return numbers
+    if kinds == {bool} and not empty.any():
+        return values.astype(bool)
+    if kinds <= {datetime.date, datetime.datetime}:
+        return pd.to_datetime(values)
+    return values.map(_whole_to_int)
+
+
+def _read_calamine(source, sheet):
+    workbook = python_calamine.CalamineWorkbook.from_object(source)
+    if isinstance(sheet, int):
+        rows = workbook.get_sheet_by_index(sheet).to_python()
+    else:
+        rows = workbook.get_sheet_by_name(sheet).to_python()
+    if not rows:
+        return pd.DataFrame()
+    columns = _header(rows[0])
+    cells = pd.DataFrame(rows[1:], columns=range(len(columns)), dtype=object)
+    df = pd.DataFrame({position: _calamine_column(cells[position]) for position in cells.columns})
+    return df.set_axis(columns, axis=1)
+
+
+def read_sheet(source, sheet=0, engine='auto'):
+    """
+    One sheet (by position or name) of a workbook, given as a path or a
+    binary file object, as a DataFrame with pandas' default dtypes.
+    """
+    if resolve_engine(engine) == 'calamine':
+        return _read_calamine(source, sheet)
+    return pd.read_excel(source, sheet_name=sheet)
+
+
+def _parse_source(path, sheet, engine, compact):
+    start = time.perf_counter()
+    df = read_sheet(path, sheet, engine)
+    if compact:
+        df = optimize_frame(df)
+    return df, (time.perf_counter() - start) * 1000
+
+
+def column_kind(values):
+    """
+    Coarse type of a column for comparing sources: 'number', 'bool',
+    'datetime', 'text' or 'mixed', or None when it holds no values.
+    """
+    if is_bool_dtype(values):
+        return 'bool'
+    if is_numeric_dtype(values):
+        return 'number'
+    if is_datetime64_any_dtype(values):
+        return 'datetime'
+    if isinstance(values.dtype, (pd.StringDtype, pd.CategoricalDtype)):
+        return 'text' if values.notna().any() else None
+    return _OBJECT_KINDS.get(infer_dtype(values, skipna=True), 'mixed')
+
+
+def schema_report(sources):
+    """
+    How the columns of ``sources`` (``(label, frame)`` pairs) line up:
+    for each column of their union, in first-seen order, the sources it is
+    missing from and, when they disagree, the kind of values (column_kind)
+    each source holds; column names that only differ by case or surrounding
+    whitespace are listed as possible matches.
+    """
+    present, kinds = {}, {}
+    for label, df in sources:
+        for column in df.columns:
+            present.setdefault(column, []).append(label)
+            kind = column_kind(df[column])
+            if kind is not None:
+                kinds.setdefault(column, {}).setdefault(kind, []).append(label)
+
+    labels = [label for label, _ in sources]
+    columns = []
+    for column, found_in in present.items():
+        report = {'name': column, 'sources': len(found_in),
+                  'missing_from': [label for label in labels if label not in found_in]}
+        column_kinds = kinds.get(column, {})
+        report['kind'] = next(iter(column_kinds)) if len(column_kinds) == 1 else ('mixed' if column_kinds else None)
+        if len(column_kinds) > 1:
+            report['kinds'] = column_kinds
+        columns.append(report)
+
+    normalized = {}
+    for column in present:
+        normalized.setdefault(str(column).strip().casefold(), []).append(column)
+    possible_matches = [names for names in normalized.values() if len(names) > 1]
+
+    aligned = not possible_matches and all(not c['missing_from'] and 'kinds' not in c for c in columns)
+    return {'aligned': aligned, 'columns': columns, 'possible_matches': possible_matches}
+
+
+class WorkbookReader:
+    """
+    Parses batches of workbook sheets, in this process or, with
+    ``workers`` > 0, in a pool of that many processes.
+    """
+
+    def __init__(self, workers=0, engine='auto'):
+        self.workers = workers
+        self.engine = engine
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _map(self, func, calls):
+        """``[func(*args) for args in calls]``, spread over the pool when there is one."""
+        if self.workers <= 0 or len(calls) < 2:
+            return [func(*args) for args in calls]
+
+        with self._lock:
+            if self._pool is None:
+                # Processes are only started on first use; spawn avoids forking the server
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        futures = [self._pool.submit(func, *args) for args in calls]
+        try:
+            return [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+    def sources(self, files, sheets='all'):
+        """
+        The (path, filename, sheet) sources of ``files`` (``(path, filename)``
+        pairs): their first sheet, every sheet (``sheets='all'``), or the
+        sheets named in a list, which every file must have.
+        """
+        sources = []
+        for path, filename in files:
+            if sheets == 'first':
+                names = sheet_names(path, self.engine)[:1]
+            elif sheets == 'all':
+                names = sheet_names(path, self.engine)
+            else:
+                available = sheet_names(path, self.engine)
+                missing = [name for name in sheets if name not in available]
+                if missing:
+                    raise ApiError(f"{filename} has no sheet {', '.join(map(repr, missing))}")
+                names = sheets
+            sources.extend((path, filename, name) for name in names)
+        return sources
+
+    def read(self, sources, compact=False):
+        """
+        Parse ``sources`` (from ``sources``). Returns a list of
+        ``(filename, sheet, frame, parse_ms)`` in the same order; with
+        ``compact`` the frames get compact dtypes in the workers.
+        """
+        engine = resolve_engine(self.engine)
+        results = self._map(_parse_source, [(path, sheet, engine, compact) for path, _, sheet in sources])
+        return [(filename, sheet, df, ms) for (_, filename, sheet), (df, ms) in zip(sources, results)]
@@ -1,15 +1,23 @@
 // API Base URL
 const API_BASE = 'http://localhost:5000';
 
-// Global state - FIXED: Maintain original and transformed datasets
-let originalDataset = [];
-let transformedDataset = [];
+// Global state - the dataset itself lives on the server; we keep its id and previews
+let datasetId = null;
+let originalDataset = { rows: 0, columns: [], preview: [] };
+let transformedDataset = { rows: 0, columns: [], preview: [] };
 let currentColumns = [];
 let activeView = 'transformed'; // 'original' or 'transformed'
 
+// Paging state for the preview table; rows are fetched one window at a time
+const PAGE_SIZE = 100;
+let pageOffset = 0;
+let pageSort = '';   // 'column' ascending, '-column' descending
+let pageFilter = '';
+
 // Initialize
 document.addEventListener('DOMContentLoaded', () => {
     initializeUpload();
+    initializePaging();
     initializeCleaning();
     initializeMath();
     initializeFinancial();
@@ -61,47 +69,118 @@ function initializeUpload() {
         uploadArea.classList.remove('dragover');
         const files = e.dataTransfer.files;
         if (files.length > 0) {
-            handleFileUpload(files[0]);
+            handleFileUpload(files);
         }
     });
     
     fileInput.addEventListener('change', (e) => {
         if (e.target.files.length > 0) {
-            handleFileUpload(e.target.files[0]);
+            handleFileUpload(e.target.files);
         }
     });
 }
 
-async function handleFileUpload(file) {
+// CSV files are ingested in chunks; the backend streams one JSON progress line per chunk
+async function streamCsvUpload(formData) {
+    const response = await fetch(`${API_BASE}/upload/stream`, {
+        method: 'POST',
+        body: formData
+    });
+    
+    if (!response.ok) {
+        const errorData = await response.json();
+        throw new Error(errorData.error || 'Upload failed');
+    }
+    
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        
+        const lines = buffer.split('\n');
+        buffer = lines.pop();
+        for (const line of lines) {
+            if (!line.trim()) continue;
+            const event = JSON.parse(line);
+            if (event.event === 'progress') {
+                const percent = event.fraction !== undefined ? ` ${Math.round(event.fraction * 100)}%` : '';
+                showToast(`Processing file...${percent} (${event.rows.toLocaleString()} rows)`, 'warning');
+            } else if (event.event === 'complete') {
+                return event;
+            } else if (event.event === 'error') {
+                throw new Error(event.error);
+            }
+        }
+    }
+    throw new Error('Upload ended unexpectedly');
+}
+
+// Several workbooks are stacked into one dataset (every sheet), with a column naming each row's file:sheet
+async function uploadWorkbookBatch(files) {
+    const formData = new FormData();
+    for (const file of files) {
+        formData.append('files', file);
+    }
+    formData.append('source_column', 'source');
+
+    const response = await fetch(`${API_BASE}/upload/batch`, {
+        method: 'POST',
+        body: formData
+    });
+    const data = await response.json();
+    if (!response.ok) {
+        throw new Error(data.error || 'Upload failed');
+    }
+    return data;
+}
+
+function schemaWarning(schema) {
+    const differing = schema.columns
+        .filter(column => column.missing_from.length > 0 || column.kinds)
+        .map(column => column.name);
+    return `Columns differ between sheets: ${differing.join(', ')}`;
+}
+
+async function handleFileUpload(files) {
+    const file = files[0];
     const formData = new FormData();
     formData.append('file', file);
     
     try {
-        showToast('Uploading file...', 'warning');
+        showToast(files.length > 1 ? `Uploading ${files.length} files...` : 'Uploading file...', 'warning');
         
-        const response = await fetch(`${API_BASE}/upload`, {
-            method: 'POST',
-            body: formData
-        });
-        
-        if (!response.ok) {
-            throw new Error('Upload failed');
+        let data;
+        if (files.length > 1) {
+            data = await uploadWorkbookBatch(files);
+        } else if (file.name.toLowerCase().endsWith('.csv')) {
+            data = await streamCsvUpload(formData);
+        } else {
+            const response = await fetch(`${API_BASE}/upload`, {
+                method: 'POST',
+                body: formData
+            });
+            
+            if (!response.ok) {
+                throw new Error('Upload failed');
+            }
+            
+            data = await response.json();
         }
         
-        const data = await response.json();
-        
-        // FIXED: Store both original and transformed (clone)
-        // Backend now returns both 'preview' (for display) and 'data' (full dataset)
-        const fullDataset = data.data || data.preview; // Use full dataset if available, fallback to preview
-        
-        originalDataset = JSON.parse(JSON.stringify(fullDataset)); // Deep clone
-        transformedDataset = JSON.parse(JSON.stringify(fullDataset)); // Deep clone
+        // The backend keeps the dataset; operations refer to it by dataset_id
+        datasetId = data.dataset_id;
+        originalDataset = { rows: data.rows, columns: data.columns, preview: data.preview };
+        transformedDataset = { rows: data.rows, columns: data.columns, preview: data.preview, version: data.version };
         currentColumns = data.columns;
+        document.getElementById('undoBtn').disabled = !data.can_undo;
+        document.getElementById('redoBtn').disabled = !data.can_redo;
         activeView = 'transformed'; // Default to transformed view
+        resetPaging();
         
-        // Display preview but store full dataset
-        const previewData = data.preview || fullDataset.slice(0, 100);
-        displayPreview(previewData, data.rows, data.columns.length);
+        displayPreview(data.preview, data.rows, data.columns.length, data.rows, data.columns);
         populateColumnSelects(data.columns);
         updateViewToggle(); // Show toggle buttons
         
@@ -114,25 +193,129 @@ async function handleFileUpload(file) {
             resultsSection.classList.remove('hidden');
         }
         
-        showToast('File uploaded successfully!', 'success');
+        if (data.schema && !data.schema.aligned) {
+            showToast(schemaWarning(data.schema), 'warning');
+        } else {
+            showToast('File uploaded successfully!', 'success');
+        }
     } catch (error) {
         showToast('Upload failed: ' + error.message, 'error');
     }
 }
 
-function displayPreview(data, rows, cols) {
+function initializePaging() {
+    document.getElementById('prevPageBtn').addEventListener('click', () => {
+        loadPage(Math.max(0, pageOffset - PAGE_SIZE));
+    });
+    document.getElementById('nextPageBtn').addEventListener('click', () => {
+        loadPage(pageOffset + PAGE_SIZE);
+    });
+
+    let filterTimer = null;
+    document.getElementById('rowFilter').addEventListener('input', (e) => {
+        clearTimeout(filterTimer);
+        filterTimer = setTimeout(() => {
+            pageFilter = e.target.value.trim();
+            loadPage(0);
+        }, 300);
+    });
+}
+
+function resetPaging() {
+    pageOffset = 0;
+    pageSort = '';
+    pageFilter = '';
+    document.getElementById('rowFilter').value = '';
+}
+
+// Fetch one window of rows of the active view from the backend
+// Row windows come back as Arrow IPC streams when the Arrow library loaded, JSON otherwise
+const ARROW_STREAM = 'application/vnd.apache.arrow.stream';
+
+function arrowValue(value, type) {
+    if (value === null || value === undefined) return null;
+    if (type.typeId === Arrow.Type.Timestamp || type.typeId === Arrow.Type.Date) {
+        return new Date(Number(value)).toISOString().slice(0, 19).replace('T', ' ');
+    }
+    return typeof value === 'bigint' ? Number(value) : value;
+}
+
+function arrowToResult(buffer) {
+    const table = Arrow.tableFromIPC(buffer);
+    const result = JSON.parse(table.schema.metadata.get('response'));
+    const fields = table.schema.fields;
+    result.rows = [];
+    for (const row of table) {
+        const record = {};
+        fields.forEach(field => {
+            record[field.name] = arrowValue(row[field.name], field.type);
+        });
+        result.rows.push(record);
+    }
+    return result;
+}
+
+async function fetchRows(url) {
+    if (!window.Arrow) {
+        const response = await fetch(url);
+        return { ok: response.ok, result: await response.json() };
+    }
+    const response = await fetch(url, { headers: { Accept: ARROW_STREAM } });
+    if (!response.ok || response.headers.get('Content-Type') !== ARROW_STREAM) {
+        return { ok: response.ok, result: await response.json() };
+    }
+    return { ok: true, result: arrowToResult(await response.arrayBuffer()) };
+}
+
+async function loadPage(offset) {
+    if (!datasetId) return;
+    
+    const params = new URLSearchParams({ offset: offset, limit: PAGE_SIZE });
+    if (pageSort) params.set('sort', pageSort);
+    if (pageFilter) params.set('filter', pageFilter);
+    if (activeView === 'original') params.set('view', 'original');
+    
+    try {
+        const { ok, result } = await fetchRows(`${API_BASE}/datasets/${datasetId}/rows?${params}`);
+        if (!ok) {
+            throw new Error(result.error || 'Could not load rows');
+        }
+        pageOffset = result.offset;
+        const dataToShow = activeView === 'original' ? originalDataset : transformedDataset;
+        displayPreview(result.rows, dataToShow.rows, result.columns.length, result.total_rows, result.columns);
+    } catch (error) {
+        showToast('Could not load rows: ' + error.message, 'error');
+    }
+}
+
+function sortBy(column) {
+    pageSort = pageSort === column ? `-${column}` : column;
+    loadPage(0);
+}
+
+function updatePager(total) {
+    const pageInfo = document.getElementById('pageInfo');
+    const first = total === 0 ? 0 : pageOffset + 1;
+    const last = Math.min(pageOffset + PAGE_SIZE, total);
+    pageInfo.textContent = `${first.toLocaleString()}-${last.toLocaleString()} of ${total.toLocaleString()}`;
+    document.getElementById('prevPageBtn').disabled = pageOffset === 0;
+    document.getElementById('nextPageBtn').disabled = pageOffset + PAGE_SIZE >= total;
+}
+
+function displayPreview(data, rows, cols, matchingRows, columns) {
     const preview = document.getElementById('datasetPreview');
     const table = document.getElementById('previewTable');
     const rowCount = document.getElementById('rowCount');
     const columnCount = document.getElementById('columnCount');
     
-    if (!data || data.length === 0) {
+    if (!data || (data.length === 0 && !pageFilter)) {
         preview.classList.add('hidden');
         return;
     }
     
+    const headers = columns || Object.keys(data[0]);
     const actualRows = rows || data.length;
-    const actualCols = cols || (data[0] ? Object.keys(data[0]).length : 0);
+    const actualCols = cols || headers.length;
     
     rowCount.textContent = `${actualRows} rows`;
     columnCount.textContent = `${actualCols} columns`;
@@ -140,22 +323,24 @@ function displayPreview(data, rows, cols) {
     // Clear table
     table.innerHTML = '';
     
-    // Create header
+    // Create header; clicking a column sorts by it (again to reverse)
     const thead = document.createElement('thead');
     const headerRow = document.createElement('tr');
-    Object.keys(data[0]).forEach(col => {
+    headers.forEach(col => {
         const th = document.createElement('th');
-        th.textContent = col;
+        th.className = 'sortable';
+        th.textContent = col + (pageSort === col ? ' ▲' : pageSort === `-${col}` ? ' ▼' : '');
+        th.addEventListener('click', () => sortBy(col));
         headerRow.appendChild(th);
     });
     thead.appendChild(headerRow);
     table.appendChild(thead);
     
-    // Create body (show first 100 rows for preview)
+    // Create body (one page of rows)
     const tbody = document.createElement('tbody');
-    data.slice(0, 100).forEach(row => {
+    data.slice(0, PAGE_SIZE).forEach(row => {
         const tr = document.createElement('tr');
-        Object.values(row).forEach(val => {
+        headers.map(col => row[col]).forEach(val => {
             const td = document.createElement('td');
             td.textContent = val !== null && val !== undefined ? val : '';
             tr.appendChild(td);
@@ -164,19 +349,116 @@ function displayPreview(data, rows, cols) {
     });
     table.appendChild(tbody);
     
+    updatePager(matchingRows !== undefined ? matchingRows : actualRows);
     preview.classList.remove('hidden');
 }
 
-// FIXED: Render table from active dataset
+// Render table from active dataset
 function renderTable() {
     const dataToShow = activeView === 'original' ? originalDataset : transformedDataset;
-    if (!dataToShow || dataToShow.length === 0) return;
+    if (!dataToShow || dataToShow.preview.length === 0) return;
+    
+    // Sorted/filtered views and later pages come from the backend
+    if (pageSort || pageFilter || pageOffset > 0) {
+        loadPage(pageOffset);
+        return;
+    }
     
-    const rows = dataToShow.length;
-    const cols = dataToShow[0] ? Object.keys(dataToShow[0]).length : 0;
-    // Show preview (first 100 rows) but display total row count
-    const previewData = dataToShow.slice(0, 100);
-    displayPreview(previewData, rows, cols);
+    // First page is the preview the backend already sent, with the total row count
+    displayPreview(dataToShow.preview, dataToShow.rows, dataToShow.columns.length, dataToShow.rows, dataToShow.columns);
+}
+
+// Positions of the rows a delta dropped, from either of its encodings
+function droppedPositions(dropped) {
+    const positions = [];
+    if (dropped.encoding === 'runs') {
+        dropped.runs.forEach(([start, length]) => {
+            for (let i = start; i < start + length; i++) positions.push(i);
+        });
+    } else {
+        const bytes = atob(dropped.bitmap);
+        for (let i = 0; i < dropped.length; i++) {
+            if (bytes.charCodeAt(i >> 3) & (1 << (i & 7))) positions.push(i);
+        }
+    }
+    return positions;
+}
+
+// Bring a preview (row records) up to date in place from a delta response;
+// returns false when the delta was not computed against these rows
+function applyDelta(preview, delta) {
+    if (preview.length !== delta.window_rows) return false;
+    if (delta.columns) {
+        Object.entries(delta.columns).forEach(([column, values]) => {
+            preview.forEach((row, i) => { row[column] = values[i]; });
+        });
+    }
+    if (delta.dropped_rows) {
+        // Remove from the end so earlier positions stay valid
+        droppedPositions(delta.dropped_rows).reverse().forEach(position => preview.splice(position, 1));
+        preview.push(...delta.appended_rows);
+    }
+    return true;
+}
+
+// Apply a dataset response from the backend (metadata + preview, or a delta) as the transformed dataset
+async function applyDatasetResult(result) {
+    if (result.delta) {
+        const patched = transformedDataset.version === result.parent_version
+            && applyDelta(transformedDataset.preview, result.delta);
+        // Out of step with the server: fetch the full preview instead
+        result.preview = patched ? transformedDataset.preview : (await fetchDataset()).preview;
+    }
+    if (!result.dataset_id || !Array.isArray(result.preview)) {
+        throw new Error('Invalid response format');
+    }
+    transformedDataset = { rows: result.rows, columns: result.columns, preview: result.preview, version: result.version };
+    currentColumns = result.columns;
+    document.getElementById('undoBtn').disabled = !result.can_undo;
+    document.getElementById('redoBtn').disabled = !result.can_redo;
+    populateColumnSelects(result.columns);
+    activeView = 'transformed'; // Switch to transformed view
+    resetPaging();
+    renderTable();
+    updateViewToggle();
+}
+
+async function fetchDataset() {
+    const response = await fetch(`${API_BASE}/datasets/${datasetId}`);
+    const result = await response.json();
+    if (!response.ok) {
+        throw new Error(result.error || 'Could not load dataset');
+    }
+    return result;
+}
+
+// Undo/redo move between versions kept on the server
+async function stepHistory(direction) {
+    if (!datasetId) return;
+    try {
+        const response = await postJSON(`/datasets/${datasetId}/${direction}`, {});
+        const result = await response.json();
+        if (!response.ok) {
+            throw new Error(result.error || `Could not ${direction}`);
+        }
+        await applyDatasetResult(result);
+    } catch (error) {
+        showToast(error.message, 'error');
+    }
+}
+
+// JSON request bodies at least this long are sent gzip-compressed where the browser supports it
+const COMPRESS_REQUEST_CHARS = 16 * 1024;
+
+async function postJSON(path, payload) {
+    const headers = { 'Content-Type': 'application/json' };
+    let body = JSON.stringify(payload);
+    if (body.length >= COMPRESS_REQUEST_CHARS && typeof CompressionStream !== 'undefined') {
+        const compressed = new Blob([body]).stream().pipeThrough(new CompressionStream('gzip'));
+        body = await new Response(compressed).blob();
+        headers['Content-Encoding'] = 'gzip';
+    }
+    return fetch(`${API_BASE}${path}`, { method: 'POST', headers, body });
 }
 
 function populateColumnSelects(columns) {
@@ -207,6 +489,7 @@ function populateColumnSelects(columns) {
 // FIXED: View Toggle Functions (global for onclick)
 window.showOriginal = function() {
     activeView = 'original';
+    resetPaging();
     renderTable();
     updateViewToggle();
     showToast('Viewing: Original Dataset', 'success');
@@ -214,6 +497,7 @@ window.showOriginal = function() {
 
 window.showTransformed = function() {
     activeView = 'transformed';
+    resetPaging();
     renderTable();
     updateViewToggle();
     showToast('Viewing: Transformed Dataset', 'success');
@@ -259,8 +543,7 @@ function initializeCleaning() {
 }
 
 async function handleCleaningOperation(operation) {
-    // FIXED: Use transformedDataset instead of currentData
-    if (!transformedDataset || transformedDataset.length === 0) {
+    if (!datasetId) {
         showToast('Please upload a dataset first', 'error');
         return;
     }
@@ -268,22 +551,15 @@ async function handleCleaningOperation(operation) {
     try {
         let response;
         
-        // FIXED: Always use transformedDataset for operations
+        // Operations run on the server-side dataset
         switch(operation) {
             case 'remove-null':
-                response = await fetch(`${API_BASE}/clean/remove-null`, {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ data: transformedDataset })
-                });
+                // Only the dropped rows come back; the preview is patched in place
+                response = await postJSON('/clean/remove-null', { dataset_id: datasetId, delta: true });
                 break;
                 
             case 'remove-duplicate':
-                response = await fetch(`${API_BASE}/clean/remove-duplicate`, {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ data: transformedDataset })
-                });
+                response = await postJSON('/clean/remove-duplicate', { dataset_id: datasetId, delta: true });
                 break;
                 
             case 'rename-columns':
@@ -295,12 +571,8 @@ async function handleCleaningOperation(operation) {
                 return;
                 
             case 'trim-whitespaces':
-                response = await fetch(`${API_BASE}/clean/trim-whitespaces`, {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ data: transformedDataset })
-                });
-                break;
+                showTrimWhitespacesModal();
+                return;
         }
         
         if (response) {
@@ -310,21 +582,8 @@ async function handleCleaningOperation(operation) {
             }
             
             const result = await response.json();
-            
-            // FIXED: Store transformed data back to transformedDataset
-            if (result.data && Array.isArray(result.data)) {
-                transformedDataset = JSON.parse(JSON.stringify(result.data)); // Deep clone
-                if (result.columns) {
-                    currentColumns = result.columns;
-                    populateColumnSelects(result.columns);
-                }
-                activeView = 'transformed'; // Switch to transformed view
-                renderTable(); // Use renderTable function
-                updateViewToggle();
-                showToast('Operation completed successfully!', 'success');
-            } else {
-                throw new Error('Invalid response format');
-            }
+            await applyDatasetResult(result);
+            showToast('Operation completed successfully!', 'success');
         }
     } catch (error) {
         showToast('Operation failed: ' + error.message, 'error');
@@ -366,14 +625,9 @@ function showRenameColumnsModal() {
         }
         
         try {
-            // FIXED: Use transformedDataset
-            const response = await fetch(`${API_BASE}/clean/rename-columns`, {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ 
-                    data: transformedDataset,
-                    rename_map: renameMap
-                })
+            const response = await postJSON('/clean/rename-columns', {
+                dataset_id: datasetId,
+                rename_map: renameMap
             });
             
             if (!response.ok) {
@@ -382,24 +636,80 @@ function showRenameColumnsModal() {
             }
             
             const result = await response.json();
+            await applyDatasetResult(result);
+            modal.classList.add('hidden');
+            showToast('Columns renamed successfully!', 'success');
+        } catch (error) {
+            showToast('Rename failed: ' + error.message, 'error');
+        }
+    });
+}
+
+function showTrimWhitespacesModal() {
+    const modal = document.getElementById('cleaningModal');
+    const modalBody = document.getElementById('modalBody');
+    const inputStyle = 'width: 100%; padding: 0.75rem; border: 2px solid #e2e8f0; border-radius: 8px;';
+    
+    modalBody.innerHTML = `
+        <h3>Trim Whitespaces</h3>
+        <div style="margin-top: 1rem;">
+            <label style="display: block; margin-bottom: 1rem;">
+                <input type="checkbox" id="trimStrip" checked> Strip leading and trailing whitespace
+            </label>
+            <label style="display: block; margin-bottom: 1rem;">
+                <input type="checkbox" id="trimCollapse"> Collapse repeated whitespace to one space
+            </label>
+            <div style="margin-bottom: 1rem;">
+                <label style="display: block; margin-bottom: 0.5rem; font-weight: 600;">Case</label>
+                <select id="trimCase" style="${inputStyle}">
+                    <option value="">Keep</option>
+                    <option value="lower">lowercase</option>
+                    <option value="upper">UPPERCASE</option>
+                    <option value="title">Title Case</option>
+                </select>
+            </div>
+            <div style="margin-bottom: 1rem;">
+                <label style="display: block; margin-bottom: 0.5rem; font-weight: 600;">Replace (regular expression)</label>
+                <input type="text" id="trimPattern" placeholder="Pattern, e.g. [^0-9A-Za-z ]" style="${inputStyle} margin-bottom: 0.5rem;">
+                <input type="text" id="trimReplacement" placeholder="Replacement (\\1 for groups)" style="${inputStyle}">
+            </div>
+            <button id="applyTrim" class="btn-primary" style="width: 100%; margin-top: 1rem;">Apply Cleanup</button>
+        </div>
+    `;
+    
+    modal.classList.remove('hidden');
+    
+    document.getElementById('applyTrim').addEventListener('click', async () => {
+        const body = {
+            dataset_id: datasetId,
+            strip: document.getElementById('trimStrip').checked,
+            collapse_whitespace: document.getElementById('trimCollapse').checked,
+            // Only the changed text columns come back; the preview is patched in place
+            delta: true
+        };
+        const caseOption = document.getElementById('trimCase').value;
+        if (caseOption) {
+            body.case = caseOption;
+        }
+        const pattern = document.getElementById('trimPattern').value;
+        if (pattern) {
+            body.replace = [{ pattern, replacement: document.getElementById('trimReplacement').value }];
+        }
+        
+        try {
+            const response = await postJSON('/clean/trim-whitespaces', body);
             
-            // FIXED: Store transformed data
-            if (result.data && Array.isArray(result.data)) {
-                transformedDataset = JSON.parse(JSON.stringify(result.data)); // Deep clone
-                if (result.columns) {
-                    currentColumns = result.columns;
-                    populateColumnSelects(result.columns);
-                }
-                activeView = 'transformed';
-                renderTable();
-                updateViewToggle();
-                modal.classList.add('hidden');
-                showToast('Columns renamed successfully!', 'success');
-            } else {
-                throw new Error('Invalid response format');
+            if (!response.ok) {
+                const errorData = await response.json();
+                throw new Error(errorData.error || 'Cleanup failed');
             }
+            
+            const result = await response.json();
+            await applyDatasetResult(result);
+            modal.classList.add('hidden');
+            showToast('Text cleaned successfully!', 'success');
         } catch (error) {
-            showToast('Rename failed: ' + error.message, 'error');
+            showToast('Cleanup failed: ' + error.message, 'error');
         }
     });
 }
@@ -436,14 +746,9 @@ function showChangeDataTypesModal() {
         });
         
         try {
-            // FIXED: Use transformedDataset
-            const response = await fetch(`${API_BASE}/clean/change-datatypes`, {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ 
-                    data: transformedDataset,
-                    dtype_map: dtypeMap
-                })
+            const response = await postJSON('/clean/change-datatypes', {
+                dataset_id: datasetId,
+                dtype_map: dtypeMap
             });
             
             if (!response.ok) {
@@ -452,28 +757,24 @@ function showChangeDataTypesModal() {
             }
             
             const result = await response.json();
-            
-            // FIXED: Store transformed data
-            if (result.data && Array.isArray(result.data)) {
-                transformedDataset = JSON.parse(JSON.stringify(result.data)); // Deep clone
-                if (result.columns) {
-                    currentColumns = result.columns;
-                    populateColumnSelects(result.columns);
-                }
-                activeView = 'transformed';
-                renderTable();
-                updateViewToggle();
-                modal.classList.add('hidden');
-                showToast('Data types changed successfully!', 'success');
-            } else {
-                throw new Error('Invalid response format');
-            }
+            await applyDatasetResult(result);
+            modal.classList.add('hidden');
+            showToast('Data types changed successfully!', 'success');
         } catch (error) {
             showToast('Data type change failed: ' + error.message, 'error');
         }
     });
 }
 
+// Aggregations run server-side on the rows matching the filter expression, if one is entered
+function withRowFilter(payload, inputId) {
+    const filter = document.getElementById(inputId).value.trim();
+    if (filter) {
+        payload.filter = filter;
+    }
+    return payload;
+}
+
 // Step 3: Mathematical Operations
 function initializeMath() {
     // Single column operations
@@ -486,21 +787,16 @@ function initializeMath() {
             return;
         }
         
-        // FIXED: Use transformedDataset
-        if (!transformedDataset || transformedDataset.length === 0) {
+        if (!datasetId) {
             showToast('Please upload a dataset first', 'error');
             return;
         }
         
         try {
-            const response = await fetch(`${API_BASE}/math/${operation}`, {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ 
-                    data: transformedDataset,
-                    column: column
-                })
-            });
+            const response = await postJSON(`/math/${operation}`, withRowFilter({
+                dataset_id: datasetId,
+                column: column
+            }, 'mathFilter'));
             
             if (!response.ok) {
                 const errorData = await response.json();
@@ -526,7 +822,7 @@ function initializeMath() {
             return;
         }
         
-        if (!transformedDataset || transformedDataset.length === 0) {
+        if (!datasetId) {
             showToast('Please upload a dataset first', 'error');
             return;
         }
@@ -536,21 +832,19 @@ function initializeMath() {
                            operation === 'subtract' ? 'subtract' :
                            operation === 'multiply' ? 'multiply' : 'divide';
             
+            // Only the new column comes back; the preview is patched in place
             const payload = {
-                data: transformedDataset,
+                dataset_id: datasetId,
                 column1: column1,
-                column2: column2
+                column2: column2,
+                delta: true
             };
             
             if (resultColumnName) {
                 payload.result_column = resultColumnName;
             }
             
-            const response = await fetch(`${API_BASE}/math/${endpoint}`, {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify(payload)
-            });
+            const response = await postJSON(`/math/${endpoint}`, payload);
             
             if (!response.ok) {
                 const errorData = await response.json();
@@ -558,25 +852,47 @@ function initializeMath() {
             }
             
             const result = await response.json();
-            
-            // FIXED: Store transformed data
-            if (result.data && Array.isArray(result.data)) {
-                transformedDataset = JSON.parse(JSON.stringify(result.data)); // Deep clone
-                if (result.columns) {
-                    currentColumns = result.columns;
-                    populateColumnSelects(result.columns);
-                }
-                activeView = 'transformed';
-                renderTable();
-                updateViewToggle();
-                showToast(`${operation.charAt(0).toUpperCase() + operation.slice(1)} operation completed!`, 'success');
-            } else {
-                throw new Error('Invalid response format');
-            }
+            await applyDatasetResult(result);
+            showToast(`${operation.charAt(0).toUpperCase() + operation.slice(1)} operation completed!`, 'success');
         } catch (error) {
             showToast('Operation failed: ' + error.message, 'error');
         }
     });
+
+    // Derived column from an expression over several columns, in one request
+    document.getElementById('applyExpressionBtn').addEventListener('click', async () => {
+        const expression = document.getElementById('expressionText').value.trim();
+        const resultColumnName = document.getElementById('expressionColumnName').value.trim();
+
+        if (!expression) {
+            showToast('Please enter an expression', 'error');
+            return;
+        }
+
+        if (!datasetId) {
+            showToast('Please upload a dataset first', 'error');
+            return;
+        }
+
+        try {
+            const response = await postJSON('/math/expression', {
+                dataset_id: datasetId,
+                expressions: { [resultColumnName || expression]: expression },
+                delta: true
+            });
+
+            if (!response.ok) {
+                const errorData = await response.json();
+                throw new Error(errorData.error || 'Expression failed');
+            }
+
+            const result = await response.json();
+            await applyDatasetResult(result);
+            showToast('Expression column added!', 'success');
+        } catch (error) {
+            showToast('Expression failed: ' + error.message, 'error');
+        }
+    });
 }
 
 function displayMathResult(operation, value, column) {
@@ -627,8 +943,7 @@ function initializeFinancial() {
 }
 
 async function handleFinancialOperation(operation) {
-    // FIXED: Use transformedDataset
-    if (!transformedDataset || transformedDataset.length === 0) {
+    if (!datasetId) {
         showToast('Please upload a dataset first', 'error');
         return;
     }
@@ -640,9 +955,9 @@ async function handleFinancialOperation(operation) {
     
     try {
         let response;
-        const payload = {
-            data: transformedDataset
-        };
+        const payload = withRowFilter({
+            dataset_id: datasetId
+        }, 'financialFilter');
         
         switch(operation) {
             case 'gross-profit':
@@ -652,11 +967,7 @@ async function handleFinancialOperation(operation) {
                 }
                 payload.revenue_column = revenueCol;
                 payload.cost_column = costCol;
-                response = await fetch(`${API_BASE}/advanced/pl/gross-profit`, {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify(payload)
-                });
+                response = await postJSON('/advanced/pl/gross-profit', payload);
                 break;
                 
             case 'net-profit':
@@ -667,11 +978,7 @@ async function handleFinancialOperation(operation) {
                 payload.revenue_column = revenueCol;
                 payload.cost_column = costCol;
                 payload.tax_column = taxCol;
-                response = await fetch(`${API_BASE}/advanced/pl/net-profit`, {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify(payload)
-                });
+                response = await postJSON('/advanced/pl/net-profit', payload);
                 break;
                 
             case 'monthly-pl':
@@ -682,11 +989,7 @@ async function handleFinancialOperation(operation) {
                 payload.revenue_column = revenueCol;
                 payload.cost_column = costCol;
                 payload.date_column = dateCol;
-                response = await fetch(`${API_BASE}/advanced/pl/monthly`, {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify(payload)
-                });
+                response = await postJSON('/advanced/pl/monthly', payload);
                 break;
                 
             case 'quarterly-pl':
@@ -697,11 +1000,7 @@ async function handleFinancialOperation(operation) {
                 payload.revenue_column = revenueCol;
                 payload.cost_column = costCol;
                 payload.date_column = dateCol;
-                response = await fetch(`${API_BASE}/advanced/pl/quarterly`, {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify(payload)
-                });
+                response = await postJSON('/advanced/pl/quarterly', payload);
                 break;
         }
         
@@ -715,51 +1014,26 @@ async function handleFinancialOperation(operation) {
     }
 }
 
-// Download transformed dataset as Excel
+// Download the transformed dataset; the browser saves the streamed export
+// straight to disk instead of holding it in memory as a blob
 function initializeDownload() {
     const btn = document.getElementById('downloadTransformedBtn');
     if (!btn) return;
 
-    btn.addEventListener('click', async () => {
-        if (!transformedDataset || transformedDataset.length === 0) {
+    btn.addEventListener('click', () => {
+        if (!datasetId) {
             showToast('No transformed dataset to download', 'error');
             return;
         }
 
-        try {
-            const response = await fetch(`${API_BASE}/download/transformed`, {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ data: transformedDataset })
-            });
+        const format = document.getElementById('downloadFormat').value;
+        const a = document.createElement('a');
+        a.href = `${API_BASE}/datasets/${datasetId}/export?format=${format}`;
+        document.body.appendChild(a);
+        a.click();
+        a.remove();
 
-            if (!response.ok) {
-                let errorMsg = 'Download failed';
-                try {
-                    const errData = await response.json();
-                    if (errData && errData.error) {
-                        errorMsg = errData.error;
-                    }
-                } catch (_) {
-                    // ignore JSON parse error
-                }
-                throw new Error(errorMsg);
-            }
-
-            const blob = await response.blob();
-            const url = window.URL.createObjectURL(blob);
-            const a = document.createElement('a');
-            a.href = url;
-            a.download = 'transformed_dataset.xlsx';
-            document.body.appendChild(a);
-            a.click();
-            a.remove();
-            window.URL.revokeObjectURL(url);
-
-            showToast('Transformed dataset downloaded.', 'success');
-        } catch (error) {
-            showToast('Download failed: ' + error.message, 'error');
-        }
+        showToast('Download started.', 'success');
     });
 }
 